@@ -11,8 +11,9 @@ from PyQt5.QtCore import QTimer
 from gui.left_half.left_half import LeftHalf
 from gui.right_half.right_half import RightHalf
 from gui.shortcuts import init_shortcuts, init_menu
-from input_output.contours_io import write_contours
+from input_output.contours_io import finish_save, write_contours
 from gating.contour_based_gating import ContourBasedGating
+from report.report import MetricsCache
 from segmentation.predict import Predict
 
 
@@ -25,6 +26,14 @@ class Master(QMainWindow):
         self.autosave_interval = config.save.autosave_interval
         self.contour_based_gating = ContourBasedGating(self)
         self.predictor = Predict(self)
+        self.segmentation_job = None  # running background segmentation
+        self.nifti_export_job = None  # running background NIfTi export
+        self.load_job = None  # longitudinal view and full contours loading in the background
+        self.save_job = None  # running background autosave
+        self.revision = 0  # increased by every edit of data
+        self.saved_revision = 0  # revision written to the contour file, autosave skips unchanged data
+        self.dirty_frames = set()  # frames edited since the last save (None if all frames changed)
+        self.metrics = MetricsCache(self)  # frames whose metrics in data match their contour
         self.image_displayed = False
         self.contours_drawn = False
         self.hide_contours = False
@@ -71,6 +80,20 @@ class Master(QMainWindow):
         timer.timeout.connect(self.auto_save)
         timer.start(self.autosave_interval)  # autosave interval in milliseconds
 
+    def mark_dirty(self, frames=None):
+        """Records an edit of data (of the given frames or of all frames), the next autosave writes the contour file"""
+        self.revision += 1
+        if frames is None or self.dirty_frames is None:
+            self.dirty_frames = None
+        else:
+            self.dirty_frames.update(frames)
+
+    def mark_saved(self):
+        """Data matches the contour file, e.g. after reading it"""
+        self.saved_revision = self.revision
+        self.dirty_frames = set()
+
     def auto_save(self):
-        if self.image_displayed:
-            write_contours(self)
+        finish_save(self)  # outcome of the previous autosave
+        if self.image_displayed and self.revision != self.saved_revision:
+            write_contours(self, background=True)
@@ -6,11 +6,11 @@ from loguru import logger
 from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsTextItem
 from PyQt5.QtCore import Qt, QLineF, QPointF
 from PyQt5.QtGui import QPixmap, QImage, QColor, QFont, QPen
-from shapely.geometry import Polygon
 
-from gui.utils.geometry import Point, Spline, get_qt_pen
+from gui.utils.geometry import Point, Spline, full_contour, get_qt_pen
 from gui.right_half.longitudinal_view import Marker
-from report.report import compute_polygon_metrics, farthest_points, closest_points
+from input_output.image_source import DicomFrameSource
+from report.polygon_metrics import stack_contours
 from segmentation.segment import downsample
 
 
@@ -24,6 +24,7 @@ class IVUSDisplay(QGraphicsView):
         self.main_window = main_window
         config = main_window.config
         self.n_interactive_points = config.display.n_interactive_points
+        self.knot_spacing = config.display.knot_spacing
         self.n_points_contour = config.display.n_points_contour
         self.image_size = config.display.image_size
         self.windowing_sensitivity = config.display.windowing_sensitivity
@@ -58,26 +59,42 @@ class IVUSDisplay(QGraphicsView):
         self.setScene(self.graphics_scene)
 
     def set_data(self, lumen, images):
+        """Shows the current frame right away, full contours and longitudinal view are filled in by BackgroundLoad"""
         num_frames = images.shape[0]
         self.image_width = images.shape[1]
         self.scaling_factor = self.image_size / images.shape[1]
         self.main_window.data['lumen'] = lumen
-        self.full_contours = [
-            (
-                Spline(
-                    [lumen[0][frame], lumen[1][frame]], self.n_points_contour, self.contour_thickness, 'green'
-                ).get_unscaled_contour(
-                    scaling_factor=1
-                )  # data is not yet scaled at read, hence scaling_factor=1
-                if lumen[0][frame]
-                else None
-            )
-            for frame in range(num_frames)
-        ]
+        self.full_contours = [None] * num_frames
         self.images = images
-        self.main_window.longitudinal_view.set_data(self.images, self.full_contours)
+        self.main_window.longitudinal_view.set_data(self.images)
         self.display_image(update_image=True, update_contours=True, update_phase=True)
 
+    def set_full_contours(self, start, contours):
+        """Adds full contours computed in the background, frames drawn or edited in the meantime are kept"""
+        lumen = self.main_window.data['lumen']
+        for frame, contour in enumerate(contours, start):
+            if self.full_contours[frame] is None and lumen[0][frame]:
+                self.full_contours[frame] = contour
+            self.main_window.longitudinal_view.lview_contour(frame, self.full_contours[frame], update=True)
+
+    def complete_contours(self):
+        """Full contours of all frames, including frames the background loader has not reached yet"""
+        lumen = self.main_window.data['lumen']
+        for frame, contour in enumerate(self.full_contours):
+            if contour is None and lumen[0][frame]:
+                self.full_contours[frame] = full_contour(lumen, frame, self.n_points_contour)
+
+        return self.full_contours
+
+    def update_contours(self, frames):
+        """Updates full contours and longitudinal view for the given frames, e.g. after a segmentation batch"""
+        lumen = self.main_window.data['lumen']
+        for frame in frames:
+            self.full_contours[frame] = full_contour(lumen, frame, self.n_points_contour)
+            self.main_window.longitudinal_view.lview_contour(frame, self.full_contours[frame], update=True)
+        if self.frame in frames and not self.contour_mode and self.active_point_index is None:
+            self.display_image(update_contours=True)
+
     def display_image(self, update_image=False, update_contours=False, update_phase=False):
         """Clears scene and displays current image and contours"""
         image_types = (QGraphicsPixmapItem, Marker)
@@ -94,6 +111,9 @@ class IVUSDisplay(QGraphicsView):
             lower_bound = self.window_level - self.window_width / 2
             upper_bound = self.window_level + self.window_width / 2
 
+            if isinstance(self.images, DicomFrameSource):
+                self.images.read_ahead(self.frame)  # decode neighbouring frames while the user looks at this one
+
             # Clip and normalize pixel values
             normalised_data = np.clip(self.images[self.frame, :, :], lower_bound, upper_bound)
             normalised_data = ((normalised_data - lower_bound) / (upper_bound - lower_bound) * 255).astype(np.uint8)
@@ -143,15 +163,15 @@ class IVUSDisplay(QGraphicsView):
                 self.draw_measure()
                 self.draw_reference()
                 if self.main_window.data['lumen'][0][self.frame] and self.current_contour.full_contour[0] is not None:
-                    lumen_x, lumen_y = self.current_contour.get_unscaled_contour(self.scaling_factor)
-                    polygon = Polygon([(x, y) for x, y in zip(lumen_x, lumen_y)])
-                    lumen_area, lumen_circumf, _, _ = compute_polygon_metrics(self.main_window, polygon, self.frame)
-                    longest_distance, farthest_point_x, farthest_point_y = farthest_points(
-                        self.main_window, polygon.exterior.coords, self.frame
-                    )
-                    shortest_distance, closest_point_x, closest_point_y = closest_points(
-                        self.main_window, polygon, self.frame
-                    )
+                    if self.main_window.metrics.stale([self.frame]):  # else unchanged since the last redraw
+                        contour = stack_contours([self.current_contour.get_unscaled_contour(self.scaling_factor)])
+                        self.main_window.metrics.update([self.frame], contour)
+                    data = self.main_window.data
+                    lumen_area, lumen_circumf = data['lumen_area'][self.frame], data['lumen_circumf'][self.frame]
+                    longest_distance = data['longest_distance'][self.frame]
+                    farthest_point_x, farthest_point_y = (point[self.frame] for point in data['farthest_point'])
+                    shortest_distance = data['shortest_distance'][self.frame]
+                    closest_point_x, closest_point_y = (point[self.frame] for point in data['nearest_point'])
                     if not self.main_window.hide_special_points:
                         self.graphics_scene.addLine(
                             QLineF(
@@ -273,6 +293,7 @@ class IVUSDisplay(QGraphicsView):
                         downsampled = downsample(
                             ([self.new_spline.full_contour[0].tolist()], [self.new_spline.full_contour[1].tolist()]),
                             self.n_interactive_points,
+                            self.knot_spacing,
                         )
                         self.main_window.data['lumen'][0][self.frame] = [
                             point / self.scaling_factor for point in downsampled[0]
@@ -280,6 +301,7 @@ class IVUSDisplay(QGraphicsView):
                         self.main_window.data['lumen'][1][self.frame] = [
                             point / self.scaling_factor for point in downsampled[1]
                         ]
+                        self.main_window.mark_dirty([self.frame])
 
                     self.stop_contour()
                     return
@@ -294,6 +316,7 @@ class IVUSDisplay(QGraphicsView):
         self.points_to_draw = []
         self.main_window.data['lumen'][0][self.frame] = []
         self.main_window.data['lumen'][1][self.frame] = []
+        self.main_window.mark_dirty([self.frame])
         self.display_image(update_contours=True)  # clear previous contour
 
     def stop_contour(self):
@@ -338,6 +361,8 @@ class IVUSDisplay(QGraphicsView):
             )
             length = round(line.length() * self.main_window.metadata["resolution"] / self.scaling_factor, 2)
             self.main_window.data['measure_lengths'][self.frame][index] = length
+            if new:  # not just redrawn
+                self.main_window.mark_dirty([self.frame])
             length_text = QGraphicsTextItem(f'{length} mm')
             length_text.setPos(point.x(), point.y())
             self.graphics_scene.addItem(length_text)
@@ -350,6 +375,7 @@ class IVUSDisplay(QGraphicsView):
         if self.contour_mode:
             self.stop_contour()
         self.main_window.data['measures'][self.frame][index] = None  # reset this measure
+        self.main_window.mark_dirty([self.frame])
         self.main_window.setCursor(Qt.CrossCursor)
         self.measure_index = index
         self.display_image(update_contours=True)
@@ -372,6 +398,7 @@ class IVUSDisplay(QGraphicsView):
         self.reference_mode = True
         self.main_window.setCursor(Qt.CrossCursor)
         self.main_window.data['reference'][self.frame] = None
+        self.main_window.mark_dirty([self.frame])
         self.display_image(update_contours=True)
 
     def update_display(self):
@@ -393,6 +420,7 @@ class IVUSDisplay(QGraphicsView):
                 self.add_measure(pos)
             elif self.reference_mode:
                 self.main_window.data['reference'][self.frame] = [pos.x(), pos.y()]
+                self.main_window.mark_dirty([self.frame])
                 self.reference_mode = False
                 self.main_window.setCursor(Qt.ArrowCursor)
                 self.display_image(update_contours=True)
@@ -449,6 +477,7 @@ class IVUSDisplay(QGraphicsView):
                 self.main_window.data['lumen'][1][self.frame] = [
                     point / self.scaling_factor for point in self.current_contour.knot_points[1]
                 ]
+                self.main_window.mark_dirty([self.frame])
                 self.display_image(update_contours=True)
                 self.main_window.longitudinal_view.lview_contour(
                     self.frame, self.full_contours[self.frame], update=True
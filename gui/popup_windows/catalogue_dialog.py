@@ -0,0 +1,67 @@
+import os
+
+from PyQt5.QtWidgets import (
+    QAbstractItemView,
+    QDialog,
+    QDialogButtonBox,
+    QLineEdit,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+)
+
+CATALOGUE_COLUMNS = [
+    ('Patient', lambda pullback: pullback['patient_name'] or pullback['patient_id']),
+    ('File', lambda pullback: os.path.basename(pullback['path'])),
+    ('Frames', lambda pullback: pullback['num_frames']),
+    ('Manufacturer', lambda pullback: pullback['manufacturer']),
+    ('Contours', lambda pullback: pullback['contour_version'] or pullback['xml_version']),
+    ('Report', lambda pullback: 'yes' if pullback['report_file'] else ''),
+]
+
+
+class CatalogueDialog(QDialog):
+    """Lists the catalogued pullbacks, filtered by patient or file name"""
+
+    def __init__(self, main_window, pullbacks):
+        super().__init__(main_window)
+        self.setWindowTitle('Open from Catalogue')
+        self.resize(900, 600)
+        self.pullbacks = pullbacks
+        self.filter = QLineEdit(self)
+        self.filter.setPlaceholderText('Filter')
+        self.table = QTableWidget(len(pullbacks), len(CATALOGUE_COLUMNS), self)
+        self.table.setHorizontalHeaderLabels([name for name, _ in CATALOGUE_COLUMNS])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        for row, pullback in enumerate(pullbacks):
+            for column, (_, value) in enumerate(CATALOGUE_COLUMNS):
+                item = QTableWidgetItem('' if value(pullback) is None else str(value(pullback)))
+                item.setToolTip(pullback['path'])
+                self.table.setItem(row, column, item)
+        self.table.resizeColumnsToContents()
+        buttonBox = QDialogButtonBox(QDialogButtonBox.Open | QDialogButtonBox.Cancel, self)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.filter)
+        layout.addWidget(self.table)
+        layout.addWidget(buttonBox)
+
+        self.filter.textChanged.connect(self.filter_rows)
+        self.table.cellDoubleClicked.connect(self.accept)
+        buttonBox.accepted.connect(self.accept)
+        buttonBox.rejected.connect(self.reject)
+
+    def filter_rows(self, text):
+        text = text.lower()
+        for row, pullback in enumerate(self.pullbacks):
+            fields = (pullback['patient_name'], pullback['patient_id'], pullback['path'])
+            self.table.setRowHidden(row, not any(text in (field or '').lower() for field in fields))
+
+    def selected_file(self):
+        """Path of the selected pullback or None"""
+        rows = self.table.selectionModel().selectedRows()
+        if not rows or self.table.isRowHidden(rows[0].row()):
+            return None
+        return self.pullbacks[rows[0].row()]['path']
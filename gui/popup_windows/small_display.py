@@ -1,11 +1,11 @@
+import numpy as np
 from loguru import logger
 from PyQt5.QtWidgets import QMainWindow, QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsLineItem
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPixmap, QImage, QPen
-from shapely.geometry import Polygon
 
 from gui.utils.geometry import Spline, Point
-from report.report import farthest_points, closest_points
+from report.polygon_metrics import stack_contours
 
 
 class SmallDisplay(QMainWindow):
@@ -75,12 +75,16 @@ class SmallDisplay(QMainWindow):
                 ]
                 [self.scene.addItem(point) for point in self.contour_points]
                 self.scene.addItem(current_contour)
-                polygon = Polygon(
-                    [(x, y) for x, y in zip(current_contour.full_contour[0], current_contour.full_contour[1])]
-                )
-                self.view.centerOn(polygon.centroid.x, polygon.centroid.y)
-                _, farthest_x, farthest_y = farthest_points(self.main_window, polygon.exterior.coords, frame)
-                _, closest_x, closest_y = closest_points(self.main_window, polygon, frame)
+                if self.main_window.metrics.stale([frame]):
+                    contour = stack_contours([current_contour.get_unscaled_contour(self.scaling_factor)])
+                    self.main_window.metrics.update([frame], contour)
+                scaled = {  # metrics are stored unscaled
+                    key: [np.multiply(point[frame], self.scaling_factor) for point in self.main_window.data[key]]
+                    for key in ['lumen_centroid', 'farthest_point', 'nearest_point']
+                }
+                self.view.centerOn(*scaled['lumen_centroid'])
+                farthest_x, farthest_y = scaled['farthest_point']
+                closest_x, closest_y = scaled['nearest_point']
                 self.scene.addLine(
                     farthest_x[0],
                     farthest_y[0],
@@ -23,22 +23,27 @@ class LongitudinalView(QGraphicsView):
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setScene(self.graphics_scene)
 
-    def set_data(self, images, contours):
+    def set_data(self, images):
+        """Empty longitudinal view, columns and contours are added by the background loader as they become available"""
         self.graphics_scene.clear()
         self.num_frames = images.shape[0]
         self.points_on_marker = [None] * self.num_frames
         self.image_height = images.shape[1]
+        self.lview_image = np.zeros((self.image_height, self.num_frames), dtype=np.uint8)
+        self.image = QGraphicsPixmapItem()
+        self.graphics_scene.addItem(self.image)
+        self.update_image()
 
-        slice = images[:, :, self.image_height // 2]
-        slice = np.transpose(slice, (1, 0)).copy()  # need .copy() to avoid QImage TypeError
+    def set_columns(self, start, columns):
+        """Adds the central columns (frames, rows) of consecutive frames starting at start"""
+        self.lview_image[:, start : start + len(columns)] = np.transpose(columns, (1, 0))
+        self.update_image()
+
+    def update_image(self):
         longitudinal_image = QImage(
-            slice.data, self.num_frames, self.image_height, self.num_frames, QImage.Format_Grayscale8
+            self.lview_image.data, self.num_frames, self.image_height, self.num_frames, QImage.Format_Grayscale8
         )
-        image = QGraphicsPixmapItem(QPixmap.fromImage(longitudinal_image))
-        self.graphics_scene.addItem(image)
-
-        for frame, contour in enumerate(contours):
-            self.lview_contour(frame, contour)
+        self.image.setPixmap(QPixmap.fromImage(longitudinal_image))  # QPixmap copies, buffer can be updated later
 
     def update_marker(self, frame):
         [self.graphics_scene.removeItem(item) for item in self.graphics_scene.items() if isinstance(item, Marker)]
@@ -105,6 +105,7 @@ def toggle_diastolic_frame(main_window, state_true, drag=False):
             if frame not in main_window.gated_frames_dia:
                 bisect.insort_left(main_window.gated_frames_dia, frame)
                 main_window.data['phases'][frame] = 'D'
+                main_window.mark_dirty([frame])
                 main_window.contour_based_gating.update_color(main_window.diastole_color_plt)
                 main_window.contour_based_gating.current_phase = 'D'
                 plt.draw()
@@ -120,6 +121,7 @@ def toggle_diastolic_frame(main_window, state_true, drag=False):
                     main_window.data['phases'][frame] == 'D'
                 ):  # do not reset when function is called from toggle_systolic_frame
                     main_window.data['phases'][frame] = '-'
+                    main_window.mark_dirty([frame])
                     if not drag:
                         main_window.contour_based_gating.update_color()
             except ValueError:
@@ -137,6 +139,7 @@ def toggle_systolic_frame(main_window, state_true, drag=False):
             if frame not in main_window.gated_frames_sys:
                 bisect.insort_left(main_window.gated_frames_sys, frame)
                 main_window.data['phases'][frame] = 'S'
+                main_window.mark_dirty([frame])
                 main_window.contour_based_gating.update_color(main_window.systole_color_plt)
                 main_window.contour_based_gating.current_phase = 'S'
             try:  # frame cannot be diastolic and systolic at the same time
@@ -151,6 +154,7 @@ def toggle_systolic_frame(main_window, state_true, drag=False):
                     main_window.data['phases'][frame] == 'S'
                 ):  # do not reset when function is called from toggle_diastolic_frame
                     main_window.data['phases'][frame] = '-'
+                    main_window.mark_dirty([frame])
                     if not drag:
                         main_window.contour_based_gating.update_color()
             except ValueError:
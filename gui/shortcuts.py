@@ -1,3 +1,4 @@
+import os
 import time
 
 from loguru import logger
@@ -6,12 +7,14 @@ from PyQt5.QtGui import QKeySequence, QDesktopServices
 from PyQt5.QtWidgets import QShortcut, QApplication
 from PyQt5.QtCore import Qt, QUrl
 
+from gui.popup_windows.catalogue_dialog import CatalogueDialog
 from gui.popup_windows.frame_range_dialog import FrameRangeDialog
 from gui.popup_windows.message_boxes import ErrorMessage
 from gui.popup_windows.video_player import VideoPlayer
 from gui.utils.contours_gui import new_contour, new_measure
+from input_output.catalogue import Catalogue, catalogue_file
 from input_output.metadata import MetadataWindow
-from input_output.read_image import read_image
+from input_output.read_image import open_image, read_image
 from input_output.contours_io import write_contours
 from segmentation.save_as_nifti import save_as_nifti
 from segmentation.segment import segment
@@ -39,6 +42,8 @@ def init_menu(main_window):
     file_menu = main_window.menu_bar.addMenu('File')
     open_action = file_menu.addAction('Open File', partial(read_image, main_window))
     open_action.setShortcut('Ctrl+O')
+    open_catalogue_action = file_menu.addAction('Open from Catalogue', partial(open_from_catalogue, main_window))
+    open_catalogue_action.setShortcut('Ctrl+Shift+O')
     file_menu.addSeparator()
     save_contours = file_menu.addAction('Save Contours', partial(write_contours, main_window))
     save_contours.setShortcut('Ctrl+S')
@@ -96,6 +101,23 @@ def init_menu(main_window):
     help_menu.addAction('About', partial(open_url, main_window))
 
 
+def open_from_catalogue(main_window):
+    """Opens a pullback chosen from the catalogue (built with input_output/catalogue.py) without scanning directories"""
+    file_name = catalogue_file(main_window.config)
+    if not os.path.isfile(file_name):
+        ErrorMessage(main_window, f'No catalogue found at {file_name}\nRun python3 -m input_output.catalogue first')
+        return
+    catalogue = Catalogue(file_name)
+    try:
+        pullbacks = catalogue.pullbacks()
+    finally:
+        catalogue.close()
+    dialog = CatalogueDialog(main_window, pullbacks)
+    if dialog.exec_() and dialog.selected_file() is not None:
+        open_image(main_window, dialog.selected_file())
+        main_window.status_bar.showMessage(main_window.waiting_status)
+
+
 def remove_contours(main_window):
     if main_window.image_displayed:
         dialog = FrameRangeDialog(main_window)
@@ -105,6 +127,7 @@ def remove_contours(main_window):
             for frame in range(lower_limit, upper_limit):
                 main_window.data['lumen'][0][frame] = []
                 main_window.data['lumen'][1][frame] = []
+            main_window.mark_dirty(range(lower_limit, upper_limit))
             main_window.longitudinal_view.remove_contours(lower_limit, upper_limit)
             main_window.display.update_display()
             main_window.status_bar.showMessage(main_window.waiting_status)
@@ -113,6 +136,7 @@ def remove_contours(main_window):
 def reset_phases(main_window):
     if main_window.image_displayed:
         main_window.data['phases'] = ['-'] * main_window.metadata['num_frames']
+        main_window.mark_dirty()
         main_window.gated_frames = []
         main_window.gated_frames_dia = []
         main_window.gated_frames_sys = []
@@ -188,6 +212,7 @@ def delete_contour(main_window):
         main_window.tmp_lumen_y = main_window.data['lumen'][1][main_window.display.frame]
         main_window.data['lumen'][0][main_window.display.frame] = []
         main_window.data['lumen'][1][main_window.display.frame] = []
+        main_window.mark_dirty([main_window.display.frame])
         main_window.display.display_image(update_contours=True)
 
 
@@ -195,6 +220,7 @@ def undo_delete(main_window):
     if main_window.image_displayed and main_window.tmp_lumen_x:
         main_window.data['lumen'][0][main_window.display.frame] = main_window.tmp_lumen_x
         main_window.data['lumen'][1][main_window.display.frame] = main_window.tmp_lumen_y
+        main_window.mark_dirty([main_window.display.frame])
         main_window.tmp_lumen_x = []
         main_window.tmp_lumen_y = []
     main_window.display.stop_contour()
@@ -72,15 +72,7 @@ class Spline(QGraphicsPathItem):
 
     def interpolate(self, points):
         """Interpolates the spline points at n_points points along spline"""
-        points = np.array(points)
-        try:
-            tck, u = splprep(points, u=None, s=0.0, per=1)
-        except ValueError:
-            return (None, None)
-        u_new = np.linspace(u.min(), u.max(), self.n_points)
-        x_new, y_new = splev(u_new, tck, der=0)
-
-        return (x_new, y_new)
+        return interpolate_spline(points, self.n_points)
 
     def update(self, pos, index, path_index=None):
         """Updates the stored spline everytime it is moved
@@ -128,6 +120,28 @@ class Spline(QGraphicsPathItem):
         return self.full_contour[0] / scaling_factor, self.full_contour[1] / scaling_factor
 
 
+def interpolate_spline(points, n_points):
+    """Interpolates a closed spline through the knot points at n_points points, (None, None) if not possible"""
+    points = np.array(points)
+    try:
+        tck, u = splprep(points, u=None, s=0.0, per=1)
+    except ValueError:
+        return (None, None)
+    u_new = np.linspace(u.min(), u.max(), n_points)
+    x_new, y_new = splev(u_new, tck, der=0)
+
+    return (x_new, y_new)
+
+
+def full_contour(lumen, frame, n_points_contour):
+    """Interpolated contour of a frame (same points as Spline without Qt item), None if there is no valid contour"""
+    if not lumen[0][frame]:
+        return None
+    contour = interpolate_spline([lumen[0][frame], lumen[1][frame]], n_points_contour + 1)
+
+    return None if contour[0] is None else contour
+
+
 def get_qt_pen(color, thickness):
     try:
         color = getattr(Qt, color)
@@ -0,0 +1,162 @@
+import os
+import re
+import time
+import tempfile
+import tracemalloc
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from loguru import logger
+
+from version import version_file_str
+from input_output.read_xml import parse_xml
+from input_output.write_xml import header_tree, write_xml
+
+
+def legacy_read_xml(path, frames=[]):
+    """Previous reader (ElementTree.parse, points as lazy maps), kept for comparison"""
+    root = ET.parse(path).getroot()
+    lumen_points = []
+    phases = []
+    for child in root:
+        for image_state in child.iter('ImageState'):
+            dim_z = image_state.find('NumberOfFrames').text
+            if not frames:
+                frames = range(int(dim_z))
+        for image_calibration in child.iter('ImageCalibration'):
+            res_x = image_calibration.find('XCalibration').text
+        for _ in child.iter('FrameState'):
+            for frame in child.iter('Fm'):
+                frame_number = int(frame.find('Num').text)
+                lumen_subpoints = []
+                if frame_number in frames:
+                    try:
+                        phase = frame.find('Phase').text
+                        phase = '-' if phase is None else phase
+                    except AttributeError:
+                        phase = '-'
+                    phases.append(phase)
+                    for pts in frame.iter('Ctr'):
+                        for point in pts:
+                            if point.tag == 'Type':
+                                if point.text == 'L':
+                                    contour = 'L'
+                            elif point.tag == 'p':
+                                if contour == 'L':
+                                    lumen_subpoints.append(point.text)
+                    lumen_points.append(lumen_subpoints)
+    x = [list(map(lambda point: int(point.split(',')[0]), points)) for points in lumen_points]
+    y = [list(map(lambda point: int(point.split(',')[1]), points)) for points in lumen_points]
+
+    return (x, y), phases, res_x
+
+
+def legacy_write_xml(x, y, dims, resolution, speed, phases, out_path):
+    """Previous writer (one SubElement per point, full tree serialised at once), kept for comparison"""
+    root = header_tree(dims, resolution, speed, out_path)
+    frame_state = root.find('FrameState')
+    for frame_index in range(dims[0]):
+        frame = ET.SubElement(frame_state, 'Fm')
+        ET.SubElement(frame, 'Num').text = str(frame_index)
+        phase = ET.SubElement(frame, 'Phase')
+        try:
+            phase.text = phases[frame_index]
+        except IndexError:
+            phase.text = '-'
+        try:
+            contour = ET.SubElement(frame, 'Ctr')
+            num_points = ET.SubElement(contour, 'Npts')
+            num_points.text = str(len(x[frame_index]))
+            ET.SubElement(contour, 'Type').text = 'L'
+            ET.SubElement(contour, 'HandDrawn').text = 'T'
+            for k in range(len(x[frame_index])):
+                p = ET.SubElement(contour, 'p')
+                p.text = str(int(x[frame_index][k])) + ',' + str(int(y[frame_index][k]))
+        except IndexError:
+            pass
+    ET.ElementTree(root).write(out_path + f'_contours_{version_file_str}.xml')
+
+
+def synthetic_contours(num_frames=10000, num_points=500, seed=0):
+    """Noisy circles with a few empty frames, as written by the GUI"""
+    random = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, num_points)
+    x, y = [], []
+    for frame in range(num_frames):
+        if frame % 50 == 0:
+            x.append([])
+            y.append([])
+            continue
+        radius = 100 + random.normal(0, 5, num_points)
+        x.append((256 + radius * np.cos(angles)).astype(int).tolist())
+        y.append((256 + radius * np.sin(angles)).astype(int).tolist())
+    phases = random.choice(['D', 'S', '-'], num_frames).tolist()
+
+    return x, y, phases
+
+
+def measure(function, *args):
+    """
+    Result, time and peak memory of a reader or writer, run in a fresh process so neither version pays for objects
+    left behind by the other (memory is traced in a second run, tracing slows down parsing)
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(measure_in_process, function, *args).result()
+
+
+def measure_in_process(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start_time
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, seconds, peak / 2**20
+
+
+def benchmark_read_xml(num_frames=10000, num_points=500):
+    """Compares the streaming reader with the previous reader on a synthetic contour file"""
+    x, y, phases = synthetic_contours(num_frames, num_points)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, 'synthetic')
+        write_xml(x, y, (num_frames, 512, 512), 0.01, 0.5, phases, out_path)
+        del x, y
+        path = os.path.join(tmp_dir, os.listdir(tmp_dir)[0])
+        logger.info(f'Synthetic file with {num_frames} frames: {os.path.getsize(path) / 2**20:.0f} MB')
+        legacy, legacy_seconds, legacy_peak = measure(legacy_read_xml, path)
+        streamed, seconds, peak = measure(parse_xml, path)
+
+    assert streamed[0] == legacy[0] and streamed[1] == legacy[1] and streamed[2] == float(legacy[2])
+    logger.info(f'Previous reader: {legacy_seconds:.2f} s, peak memory {legacy_peak:.0f} MB')
+    logger.info(
+        f'Streaming reader: {seconds:.2f} s, peak memory {peak:.0f} MB '
+        f'(speed-up {legacy_seconds / seconds:.1f}x, identical contours and phases)'
+    )
+
+
+def benchmark_write_xml(num_frames=10000, num_points=500):
+    """Compares the streaming writer with the previous writer, outputs must be identical (apart from the date)"""
+    x, y, phases = synthetic_contours(num_frames, num_points)
+    dims = (num_frames, 512, 512)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        outputs = []
+        for name, write in (('Previous writer', legacy_write_xml), ('Streaming writer', write_xml)):
+            out_path = os.path.join(tmp_dir, write.__name__, 'synthetic')
+            os.makedirs(os.path.dirname(out_path))
+            _, write_seconds, write_peak = measure(write, x, y, dims, 0.01, 0.5, phases, out_path)
+            with open(out_path + f'_contours_{version_file_str}.xml', 'rb') as in_file:
+                outputs.append(re.sub(rb'<Date>[^<]*</Date>', b'', in_file.read()))
+            logger.info(f'{name}: {write_seconds:.2f} s, peak memory {write_peak:.0f} MB')
+
+    assert outputs[0] == outputs[1]
+    logger.info('Streaming writer output is byte-identical')
+
+
+if __name__ == '__main__':
+    benchmark_read_xml()
+    benchmark_write_xml()
@@ -0,0 +1,245 @@
+import os
+import re
+import time
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import hydra
+import pydicom as dcm
+import SimpleITK as sitk
+from omegaconf import DictConfig
+from loguru import logger
+from tqdm import tqdm
+
+from input_output.metadata import read_pullback_rate, read_resolution
+
+DICOM = 'dicom'
+NIFTI = 'nifti'
+OTHER = 'other'  # recorded as well, so unchanged files are not read again
+PULLBACK_COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('directory', 'TEXT'),
+    ('file_type', 'TEXT'),
+    ('size', 'INTEGER'),
+    ('mtime', 'REAL'),
+    ('patient_id', 'TEXT'),
+    ('patient_name', 'TEXT'),
+    ('study_uid', 'TEXT'),
+    ('series_uid', 'TEXT'),
+    ('num_frames', 'INTEGER'),
+    ('rows', 'INTEGER'),
+    ('columns', 'INTEGER'),
+    ('transfer_syntax', 'TEXT'),
+    ('pullback_rate', 'REAL'),
+    ('resolution', 'REAL'),
+    ('manufacturer', 'TEXT'),
+    ('model', 'TEXT'),
+    ('contour_file', 'TEXT'),  # newest JSON or npz contour file (by version, as read_contours picks it)
+    ('contour_version', 'TEXT'),
+    ('xml_file', 'TEXT'),
+    ('xml_version', 'TEXT'),
+    ('report_file', 'TEXT'),
+    ('report_mtime', 'REAL'),  # reports are not versioned
+    ('error', 'TEXT'),
+]
+SIDECAR = re.compile(r'_contours_(?P<version>[\d_]+)\.(?P<extension>json|npz|xml)$|_report\.txt$')
+SKIPPED_EXTENSIONS = ('.json', '.xml', '.txt', '.csv', '.jsonl', '.sqlite', '.npy', '.npz', '.png', '.jpg', '.lock')
+
+
+class Catalogue:
+    """
+    SQLite catalogue of the pullbacks in a directory tree, built from file headers only (no pixel data is read).
+
+    Every file is recorded with its type (DICOM, NIfTi or other), DICOM metadata and the contour, XML and report files
+    stored next to it. Scans are incremental: headers are only read again if size or modification time of a file
+    changed, contour and report files are updated from the directory listing on every scan.
+    """
+
+    def __init__(self, catalogue_file):
+        self.catalogue_file = catalogue_file
+        self.connection = sqlite3.connect(catalogue_file)
+        self.connection.row_factory = sqlite3.Row
+        columns = ', '.join(f'"{name}" {column_type}' for name, column_type in PULLBACK_COLUMNS)
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS pullbacks ({columns})')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pullbacks_directory ON pullbacks (directory)')
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, input_dir, num_workers=None):
+        """Updates the catalogue with all files below input_dir, directories are scanned in a process pool"""
+        start_time = time.perf_counter()
+        input_dir = os.path.abspath(input_dir)
+        directories = [directory for directory, _, files in os.walk(input_dir) if files]
+        known = {}  # (size, mtime) of catalogued files by directory, only changed files are read again
+        for row in self.connection.execute(
+            'SELECT directory, path, size, mtime FROM pullbacks WHERE directory = ? OR substr(directory, 1, ?) = ?',
+            (input_dir, len(input_dir) + 1, os.path.join(input_dir, '')),
+        ):
+            known.setdefault(row['directory'], {})[row['path']] = (row['size'], row['mtime'])
+
+        num_read = 0
+        scanned = set()
+        # spawn instead of fork, the GUI may scan while other threads are running
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(scan_directory, directory, known.get(directory, {})) for directory in directories]
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Scanning', unit='dirs'):
+                records, sidecars, num_directory_read = future.result()
+                num_read += num_directory_read
+                scanned.update(sidecars)
+                with self.connection:
+                    self.upsert(records)
+                    self.connection.executemany(
+                        'UPDATE pullbacks SET contour_file = ?, contour_version = ?, xml_file = ?, xml_version = ?, '
+                        'report_file = ?, report_mtime = ? WHERE path = ?',
+                        [(*sidecar, path) for path, sidecar in sidecars.items()],
+                    )
+
+        removed = [path for files in known.values() for path in files if path not in scanned]
+        with self.connection:  # files deleted since the last scan
+            self.connection.executemany('DELETE FROM pullbacks WHERE path = ?', [(path,) for path in removed])
+        logger.info(
+            f'Scanned {len(scanned)} files in {len(directories)} directories in {time.perf_counter() - start_time:.1f} s '
+            f'({num_read} new or changed, {len(removed)} removed), catalogue {self.catalogue_file}'
+        )
+
+    def upsert(self, records):
+        names = [name for name, _ in PULLBACK_COLUMNS]
+        columns = ', '.join(f'"{name}"' for name in names)  # quoted, rows and columns are SQL keywords
+        self.connection.executemany(
+            f'INSERT OR REPLACE INTO pullbacks ({columns}) VALUES ({", ".join("?" * len(names))})',
+            [tuple(record.get(name) for name in names) for record in records],
+        )
+
+    def pullbacks(self, input_dir=None, where=None, parameters=()):
+        """Catalogued DICOM and NIfTi pullbacks, optionally below input_dir and filtered by an SQL condition"""
+        conditions = ['file_type IN (?, ?)']
+        query_parameters = [DICOM, NIFTI]
+        if input_dir is not None:
+            input_dir = os.path.abspath(input_dir)
+            conditions.append('(directory = ? OR substr(directory, 1, ?) = ?)')
+            query_parameters += [input_dir, len(input_dir) + 1, os.path.join(input_dir, '')]
+        if where is not None:
+            conditions.append(f'({where})')
+            query_parameters += list(parameters)
+        query = f'SELECT * FROM pullbacks WHERE {" AND ".join(conditions)} ORDER BY path'
+
+        return [dict(row) for row in self.connection.execute(query, query_parameters)]
+
+
+def scan_directory(directory, known):
+    """Returns records of new or changed files, contour/report files of all files and the number of headers read"""
+    entries = {entry.name: entry for entry in os.scandir(directory) if entry.is_file()}
+    records = []
+    sidecars = {}
+    for name, entry in entries.items():
+        if SIDECAR.search(name) or name.lower().endswith(SKIPPED_EXTENSIONS) or name.endswith('.tmp'):
+            continue
+        path = os.path.join(directory, name)
+        stat = entry.stat()
+        if known.get(path) != (stat.st_size, stat.st_mtime):
+            record = read_header(path)
+            record.update(path=path, directory=directory, size=stat.st_size, mtime=stat.st_mtime)
+            records.append(record)
+        sidecars[path] = find_sidecars(path, entries)
+
+    return records, sidecars, len(records)
+
+
+def find_sidecars(path, entries):
+    """Newest contour JSON and XML (with version) and report file of a pullback, from the directory listing"""
+    stem = os.path.basename(os.path.splitext(path)[0])  # contours are saved without the extension of the pullback
+    if stem.endswith('.nii'):  # .nii.gz
+        stem = stem[:-4]
+    def order(name):  # same choice as read_contours: highest version, then the last written format
+        modified = entries[name].stat().st_mtime
+        journal = name[: -len('.npz')] + '_journal.jsonl'
+        if name.endswith('.npz') and journal in entries:  # autosaves of a store only append to its journal
+            modified = max(modified, entries[journal].stat().st_mtime)
+        return os.path.splitext(name)[0], modified
+
+    newest = {'json': None, 'xml': None}
+    for name in entries:
+        if name.startswith(f'{stem}_contours_'):
+            match = SIDECAR.search(name)
+            extension = 'xml' if match and match['extension'] == 'xml' else 'json'  # npz store replaces JSON
+            if match and match['version'] and (newest[extension] is None or order(name) > order(newest[extension])):
+                newest[extension] = name
+    report = entries.get(f'{stem}_report.txt')
+
+    return (
+        newest['json'] and os.path.join(os.path.dirname(path), newest['json']),
+        newest['json'] and version_from_name(newest['json']),
+        newest['xml'] and os.path.join(os.path.dirname(path), newest['xml']),
+        newest['xml'] and version_from_name(newest['xml']),
+        report and report.path,
+        report and report.stat().st_mtime,
+    )
+
+
+def version_from_name(name):
+    """Version of a contour file, e.g. 0.7.3 for ..._contours_0_7_3.json"""
+    return SIDECAR.search(name)['version'].replace('_', '.')
+
+
+def read_header(path):
+    """Header-only record of a DICOM or NIfTi file, other files are recorded with their type only"""
+    if path.endswith(('.nii', '.nii.gz')):
+        try:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(path)
+            reader.ReadImageInformation()
+        except RuntimeError as error:
+            return {'file_type': OTHER, 'error': str(error)}
+        size = reader.GetSize()
+        return {
+            'file_type': NIFTI,
+            'num_frames': size[2] if len(size) > 2 else 1,
+            'rows': size[1],
+            'columns': size[0],
+            'resolution': reader.GetSpacing()[0],
+        }
+
+    try:
+        header = dcm.dcmread(path, force=True, stop_before_pixels=True)
+        if not header.get('Rows'):  # force=True reads anything, only images count as pullbacks
+            return {'file_type': OTHER}
+        transfer_syntax = header.file_meta.get('TransferSyntaxUID')
+        return {
+            'file_type': DICOM,
+            'patient_id': str(header.get('PatientID', '')),
+            'patient_name': str(header.get('PatientName', '')),
+            'study_uid': header.get('StudyInstanceUID'),
+            'series_uid': header.get('SeriesInstanceUID'),
+            'num_frames': int(header.get('NumberOfFrames', 1) or 1),
+            'rows': int(header.Rows),
+            'columns': int(header.Columns),
+            'transfer_syntax': None if transfer_syntax is None else str(transfer_syntax),
+            'pullback_rate': read_pullback_rate(header),  # None if missing (asked for when opened in the GUI)
+            'resolution': read_resolution(header),
+            'manufacturer': header.get('Manufacturer'),
+            'model': header.get('ManufacturerModelName'),
+        }
+    except Exception as error:  # any unreadable file is recorded as other file type instead of ending the scan
+        return {'file_type': OTHER, 'error': f'{error!r}'}
+
+
+def catalogue_file(config):
+    """Configured catalogue file, defaults to catalogue.sqlite in segmentation.input_dir"""
+    return config.catalogue.catalogue_file or os.path.join(config.segmentation.input_dir, 'catalogue.sqlite')
+
+
+@hydra.main(version_base=None, config_path='..', config_name='config')
+def build_catalogue(config: DictConfig) -> None:
+    """Scans segmentation.input_dir into the catalogue (incremental, only new or changed files are read)"""
+    catalogue = Catalogue(catalogue_file(config))
+    try:
+        catalogue.scan(config.segmentation.input_dir, config.catalogue.n_workers)
+    finally:
+        catalogue.close()
+
+
+if __name__ == '__main__':
+    build_catalogue()
@@ -0,0 +1,220 @@
+"""
+Compact binary contour store, an alternative to the JSON contour files (save.contour_format: 'npz').
+
+The data dict is stored column by column in an uncompressed .npz file:
+
+    store_version               ()          int, layout version
+    generation                  ()          str, random id of this write, journal records of other stores are ignored
+    lumen_offsets               (n + 1,)    int64, knots of frame i are lumen_x/y[offsets[i]:offsets[i + 1]]
+    lumen_x, lumen_y            (k,)        float64, knot points of all frames
+    phases                      (n,)        uint8, ASCII code of the phase ('-', 'D' or 'S')
+    <metric>                    (n,)        float32, e.g. lumen_area (see METRIC_KEYS)
+    lumen_centroid              (n, 2)      float32, x and y, NaN if not computed
+    farthest_point, nearest_point (n, 2, 2) float32, x and y of both points, NaN if not computed
+    measures                    (n, 2, 4)   float64, both measures (x1, y1, x2, y2), NaN if not (fully) drawn
+    measure_lengths             (n, 2)      float32
+    reference                   (n, 2)      float64, NaN if not set
+    other                       ()          str, JSON of all entries not matching this layout
+
+Edits of single frames are appended to a JSONL journal next to the store (one line per save with the generation of
+the store and the complete entries of the changed frames) which is replayed on reading. The store is rewritten and
+the journal removed once the journal exceeds its size limit or on a manual save. Records of an older store (journal
+left behind by a crash right after rewriting the store) are skipped, they would revert frames to older values.
+"""
+
+import os
+import json
+import threading
+import uuid
+from itertools import chain
+
+import numpy as np
+
+STORE_VERSION = 1
+METRIC_KEYS = [
+    'plaque_frames',
+    'lumen_area',
+    'lumen_circumf',
+    'longest_distance',
+    'shortest_distance',
+    'elliptic_ratio',
+    'vector_length',
+    'vector_angle',
+]
+POINT_KEYS = {'lumen_centroid': (), 'farthest_point': (2,), 'nearest_point': (2,)}  # shape of x and y per frame
+PAIRED_KEYS = ['lumen', *POINT_KEYS]  # stored in data as (x, y), each a list over frames
+FRAME_KEYS = ['phases', *METRIC_KEYS, 'measures', 'measure_lengths', 'reference']  # lists over frames
+
+
+def journal_file(store_file):
+    return os.path.splitext(store_file)[0] + '_journal.jsonl'
+
+
+def write_store(data, store_file):
+    """Writes the store via a temporary file, then removes the journal (its edits are contained in the store)"""
+    tmp_file_name = f'{store_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_file_name, 'wb') as out_file:  # file object, np.savez would append .npz to the name
+            np.savez(out_file, **encode(data), generation=np.array(uuid.uuid4().hex))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_file_name, store_file)
+    finally:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+    try:
+        os.remove(journal_file(store_file))
+    except FileNotFoundError:
+        pass
+
+
+def read_store(store_file):
+    """Data dict as read from a JSON contour file, with the edits of the journal applied"""
+    with np.load(store_file, allow_pickle=False) as arrays:
+        data = decode(arrays)
+        generation = str(arrays['generation']) if 'generation' in arrays else None  # None for older stores
+    try:
+        with open(journal_file(store_file)) as in_file:
+            for line in in_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # partially written line, e.g. after a crash
+                    continue
+                if record.get('generation') != generation:  # journal of an older store
+                    continue
+                for frame, values in record['frames'].items():
+                    set_frame_values(data, int(frame), values)
+    except FileNotFoundError:
+        pass
+
+    return data
+
+
+def journal_record(data, frames):
+    """Complete entries of the given frames for the journal (serialised right away, data keeps changing)"""
+    return json.dumps({frame: frame_values(data, frame) for frame in sorted(frames)})
+
+
+def store_generation(store_file):
+    with np.load(store_file, allow_pickle=False) as arrays:  # only the directory and this entry are read
+        return str(arrays['generation']) if 'generation' in arrays else None
+
+
+def append_journal(store_file, record):
+    """Appends a journal record to the journal of the store as it is on disk now"""
+    record = f'{{"generation": {json.dumps(store_generation(store_file))}, "frames": {record}}}\n'
+    with open(journal_file(store_file), 'ab+') as out_file:
+        if out_file.tell() > 0:
+            out_file.seek(-1, os.SEEK_END)
+            if out_file.read(1) != b'\n':  # partial line of a failed write, must not swallow this record
+                out_file.write(b'\n')
+        out_file.write(record.encode())  # single write per line, a crash leaves at most one partial line
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+
+def frame_values(data, frame):
+    values = {key: [data[key][0][frame], data[key][1][frame]] for key in PAIRED_KEYS if key in data}
+    values.update({key: data[key][frame] for key in FRAME_KEYS if key in data})
+
+    return values
+
+
+def set_frame_values(data, frame, values):
+    for key, value in values.items():
+        if key in PAIRED_KEYS:
+            data[key][0][frame], data[key][1][frame] = value
+        else:
+            data[key][frame] = value
+
+
+def encode(data):
+    """Columns of the data dict, entries not matching the layout are kept as JSON"""
+    arrays = {'store_version': np.array(STORE_VERSION)}
+    other = {}
+    for key, value in data.items():
+        try:
+            arrays.update(encode_entry(key, value))
+        except (KeyError, TypeError, ValueError):  # e.g. entries added in later versions
+            other[key] = value
+    arrays['other'] = np.array(json.dumps(other))
+
+    return arrays
+
+
+def encode_entry(key, value):
+    if key == 'lumen':
+        x, y = value
+        if [len(frame) for frame in x] != [len(frame) for frame in y]:
+            raise ValueError('Number of x and y knots differs')
+        return {
+            'lumen_offsets': np.cumsum([0] + [len(frame) for frame in x], dtype=np.int64),
+            'lumen_x': np.array(list(chain.from_iterable(x)), dtype=np.float64),
+            'lumen_y': np.array(list(chain.from_iterable(y)), dtype=np.float64),
+        }
+    if key == 'phases':
+        phases = np.frombuffer(''.join(value).encode('ascii'), dtype=np.uint8)
+        if len(phases) != len(value):
+            raise ValueError('Phases must be single characters')
+        return {key: phases}
+    if key in METRIC_KEYS:
+        metric = np.array(value)
+        if metric.dtype.kind not in 'biuf':  # e.g. None or strings, kept as they are
+            raise TypeError(f'{key} is not numeric')
+        return {key: metric.astype(np.float32).reshape(len(value))}
+    if key in POINT_KEYS:
+        shape = POINT_KEYS[key]
+        points = np.full((len(value[0]), 2, *shape), np.nan, dtype=np.float32)
+        for frame, (x, y) in enumerate(zip(*value)):
+            if not (isinstance(x, list) and not x):  # empty list if not computed
+                points[frame] = x, y
+        return {key: points}
+    if key == 'measures':
+        measures = np.full((len(value), 2, 4), np.nan)
+        for frame, frame_measures in enumerate(value):
+            for index, measure in enumerate(frame_measures):
+                if measure is not None:
+                    measures[frame, index, : len(measure)] = measure
+        return {key: measures}
+    if key == 'measure_lengths':
+        return {key: np.array(value, dtype=np.float32).reshape(len(value), 2)}
+    if key == 'reference':
+        reference = [[np.nan, np.nan] if point is None else point for point in value]
+        return {key: np.array(reference, dtype=np.float64).reshape(len(value), 2)}
+    raise KeyError(key)
+
+
+def decode(arrays):
+    data = json.loads(str(arrays['other']))
+    if 'lumen_offsets' in arrays:
+        offsets = arrays['lumen_offsets'].tolist()
+        data['lumen'] = [
+            [values[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+            for values in (arrays['lumen_x'].tolist(), arrays['lumen_y'].tolist())
+        ]
+    if 'phases' in arrays:
+        data['phases'] = list(arrays['phases'].tobytes().decode('ascii'))
+    for key in METRIC_KEYS + ['measure_lengths']:
+        if key in arrays:
+            data[key] = arrays[key].tolist()
+    for key in POINT_KEYS:
+        if key in arrays:  # only frames with computed points are converted, most are usually empty
+            points = arrays[key]
+            present = np.flatnonzero(~np.isnan(points).reshape(len(points), -1).all(axis=1))
+            data[key] = ([[] for _ in range(len(points))], [[] for _ in range(len(points))])
+            for frame, (x, y) in zip(present.tolist(), points[present].tolist()):
+                data[key][0][frame], data[key][1][frame] = x, y
+    if 'measures' in arrays:
+        measures = arrays['measures']
+        completed = ~np.isnan(measures[..., 2])
+        data['measures'] = [[None, None] for _ in range(len(measures))]
+        for frame, index in zip(*[indices.tolist() for indices in np.nonzero(~np.isnan(measures[..., 0]))]):
+            data['measures'][frame][index] = measures[frame, index, : 4 if completed[frame, index] else 2].tolist()
+    if 'reference' in arrays:
+        reference = arrays['reference']
+        present = np.flatnonzero(~np.isnan(reference[:, 0]))
+        data['reference'] = [None] * len(reference)
+        for frame, point in zip(present.tolist(), reference[present].tolist()):
+            data['reference'][frame] = point
+
+    return data
@@ -1,27 +1,37 @@
 import os
 import json
 import glob
+import time
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from loguru import logger
 
 from version import version_file_str
 from gui.popup_windows.message_boxes import ErrorMessage
+from input_output.contour_store import append_journal, journal_file, journal_record, read_store, write_store
 from input_output.read_xml import read_xml
 from input_output.write_xml import write_xml
 
 
 def read_contours(main_window, file_name=None):
-    """Reads contours saved in json/xml format and displays the contours in the graphics scene"""
+    """Reads contours saved in json/npz/xml format and displays the contours in the graphics scene"""
     success = False
-    json_files = glob.glob(f'{file_name}_contours*.json')
+    json_files = glob.glob(f'{file_name}_contours*.json') + glob.glob(f'{file_name}_contours*.npz')
     xml_files = glob.glob(f'{file_name}_contours*.xml')
 
     if not main_window.config.save.use_xml_files and json_files:  # json files have priority over xml unless desired
-        newest_json = max(json_files)  # find file with most recent version
+        newest_json = max(  # find file with most recent version, the last written if both formats exist
+            json_files, key=lambda name: (os.path.splitext(name)[0], last_written(name))
+        )
         logger.info(f'Current version is {version_file_str}, file found with most recent version is {newest_json}')
-        with open(newest_json, 'r') as in_file:
-            main_window.data = json.load(in_file)
+        if newest_json.endswith('.npz'):
+            main_window.data = read_store(newest_json)
+        else:
+            with open(newest_json, 'r') as in_file:
+                main_window.data = json.load(in_file)
         if 'measures' not in main_window.data:  # added in version 0.4.5
             main_window.data['measures'] = [[None, None] for _ in range(main_window.metadata['num_frames'])]
         if 'reference' not in main_window.data:  # added in version 0.7.3
@@ -32,7 +42,6 @@ def read_contours(main_window, file_name=None):
         newest_xml = max(xml_files)  # find file with most recent version
         logger.info(f'Current version is {version_file_str}, file found with most recent version is {newest_xml}')
         read_xml(main_window, newest_xml)
-        main_window.data['lumen'] = map_to_list(main_window.data['lumen'])
         for key in [
             'lumen_area',
             'lumen_circumf',
@@ -60,45 +69,139 @@ def read_contours(main_window, file_name=None):
     return success
 
 
-def write_contours(main_window):
-    """Writes contours to a json/xml file"""
+def write_contours(main_window, background=False):
+    """
+    Writes contours to a json/npz/xml file.
+
+    A snapshot of the data is taken on the GUI thread, serialising and writing run in a background thread for
+    autosave. Contours are written to a temporary file which then atomically replaces the contour file. With the npz
+    store, autosaves of a few changed frames are appended to its journal instead.
+    """
 
     if not main_window.image_displayed:
         ErrorMessage(main_window, 'Cannot write contours before reading input file')
         return
 
-    if main_window.config.save.use_xml_files:
-        # reformat data for compatibility with write_xml function
-        x, y = [], []
-        for frame in range(main_window.metadata['num_frames']):
-            if frame < len(main_window.data['lumen'][0]):
-                new_x_lumen = main_window.data['lumen'][0][frame]
-                new_y_lumen = main_window.data['lumen'][1][frame]
+    if not finish_save(main_window, wait=not background):  # an older snapshot must not replace this one
+        return  # previous autosave still writing, the next one catches up
+    start_time = time.perf_counter()
+    revision = main_window.revision
+    frames = main_window.dirty_frames  # None if all frames changed
+    main_window.dirty_frames = set()
+    use_xml_files = main_window.config.save.use_xml_files
+    use_store = not use_xml_files and main_window.config.save.contour_format == 'npz'
+    num_frames = main_window.metadata['num_frames']
+    store_file = main_window.file_name + f'_contours_{version_file_str}.npz'
+    if (
+        use_store
+        and background
+        and frames is not None
+        and len(frames) * 10 < num_frames
+        and journal_fits(store_file, main_window.config.save.journal_max_mb)
+    ):
+        record = journal_record(main_window.data, frames)  # only the changed frames, small enough for the GUI thread
+        snapshot = None
+    else:
+        record = None
+        snapshot = pickle.dumps(main_window.data, protocol=pickle.HIGHEST_PROTOCOL)  # far cheaper than json
+    snapshot_time = time.perf_counter() - start_time
+    shape, resolution, pullback_rate = (
+        main_window.images.shape,
+        main_window.metadata['resolution'],
+        main_window.metadata.get('pullback_rate'),
+    )
+    file_name = main_window.file_name
+
+    def save():
+        start_time = time.perf_counter()
+        try:
+            if record is not None:
+                append_journal(store_file, record)
+            elif use_store:
+                write_store(pickle.loads(snapshot), store_file)  # also compacts the journal
+            elif use_xml_files:
+                data = pickle.loads(snapshot)
+                # reformat data for compatibility with write_xml function
+                x, y = [], []
+                for frame in range(num_frames):
+                    if frame < len(data['lumen'][0]):
+                        x.append(data['lumen'][0][frame])
+                        y.append(data['lumen'][1][frame])
+                    else:
+                        x.append([])
+                        y.append([])
+                write_xml(x, y, shape, resolution, pullback_rate, data['phases'], file_name)
             else:
-                new_x_lumen = []
-                new_y_lumen = []
-
-            x.append(new_x_lumen)
-            y.append(new_y_lumen)
-
-        write_xml(
-            x,
-            y,
-            main_window.images.shape,
-            main_window.metadata['resolution'],
-            main_window.ivusPullbackRate,
-            main_window.data['phases'],
-            main_window.file_name,
+                write_json(pickle.loads(snapshot), file_name + f'_contours_{version_file_str}.json')
+        except Exception as error:  # e.g. disk full
+            logger.error(f'Could not save contours: {error}')
+            return file_name, revision, frames, False
+        changed = 'all frames' if frames is None else f'{len(frames)} changed frames'
+        changed += ', journal' if record is not None else ''
+        logger.info(
+            f'Saved contours ({changed}) in {time.perf_counter() - start_time:.2f} s, '
+            f'snapshot took {snapshot_time * 1000:.0f} ms on the GUI thread'
         )
+        return file_name, revision, frames, True
+
+    if background:
+        pool = ThreadPoolExecutor(1, thread_name_prefix='autosave')
+        main_window.save_job = pool.submit(save)  # outcome is applied on the GUI thread by finish_save
+        pool.shutdown(wait=False)  # the thread still finishes the save, also on exit
+    elif not apply_save(main_window, *save()):
+        ErrorMessage(main_window, 'Could not save contours, see the log for details')
+
+
+def finish_save(main_window, wait=False):
+    """Applies the outcome of the previous autosave on the GUI thread, returns False if it is still running"""
+    if main_window.save_job is None:
+        return True
+    if not wait and not main_window.save_job.done():
+        return False
+    apply_save(main_window, *main_window.save_job.result())
+    main_window.save_job = None
+    return True
+
+
+def apply_save(main_window, file_name, revision, frames, success):
+    """Records a finished save, ignored if another pullback was opened meanwhile"""
+    if file_name != main_window.file_name:
+        return success
+    if success:
+        main_window.saved_revision = max(main_window.saved_revision, revision)  # reopening keeps later revisions
     else:
-        with open(os.path.join(main_window.file_name + f'_contours_{version_file_str}.json'), 'w') as out_file:
-            json.dump(main_window.data, out_file)
-
+        main_window.mark_dirty(frames)  # changes are written again on the next save
+    return success
 
-def map_to_list(contours):
-    """Converts map to list"""
-    x, y = contours
-    x = [list(x[i]) for i in range(len(x))]
-    y = [list(y[i]) for i in range(len(y))]
 
-    return (x, y)
+def last_written(file_name):
+    """Modification time of a contour file, autosaves of a store only append to its journal"""
+    modified = os.path.getmtime(file_name)
+    if file_name.endswith('.npz') and os.path.exists(journal_file(file_name)):
+        modified = max(modified, os.path.getmtime(journal_file(file_name)))
+
+    return modified
+
+
+def write_json(data, file_name):
+    """Writes data via a temporary file, a crash while writing never leaves a partial contour file behind"""
+    tmp_file_name = f'{file_name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_file_name, 'w') as out_file:
+            out_file.write(json.dumps(data))  # dumps uses the C encoder, dump does not
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_file_name, file_name)
+    finally:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+
+
+def journal_fits(store_file, journal_max_mb):
+    """Whether edits can be appended to the journal of an existing store, otherwise the store is rewritten"""
+    if not os.path.exists(store_file):
+        return False
+    try:
+        return os.path.getsize(journal_file(store_file)) < journal_max_mb * 1024 * 1024
+    except FileNotFoundError:
+        return True
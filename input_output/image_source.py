@@ -0,0 +1,319 @@
+import os
+import time
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom as dcm
+from loguru import logger
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+
+PIXEL_MODULE = [
+    'SamplesPerPixel',
+    'PhotometricInterpretation',
+    'PlanarConfiguration',
+    'Rows',
+    'Columns',
+    'BitsAllocated',
+    'BitsStored',
+    'HighBit',
+    'PixelRepresentation',
+]
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'  # (7FE0,0010) little endian
+NIFTI_DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4'}
+
+
+def open_dicom(file_name, cache_size=256, read_ahead=16, decode_threads=None):
+    """
+    Returns the DICOM (header only if memory-mapped) and its grayscale frames (frames, rows, cols).
+
+    Uncompressed pixel data is memory-mapped read-only without copying, compressed pixel data is decoded on demand.
+    """
+    header, pixel_data_offset = read_dicom_header(file_name)
+    images = dicom_memmap(file_name, header, pixel_data_offset)
+    if images is not None:
+        return header, images
+
+    dicom = dcm.dcmread(file_name, force=True)
+    return dicom, DicomFrameSource(dicom, cache_size, read_ahead, decode_threads)
+
+
+def read_dicom_header(file_name):
+    """DICOM without pixel data and the file offset of the pixel data element"""
+    with open(file_name, 'rb') as dicom_file:
+        header = dcm.dcmread(dicom_file, force=True, stop_before_pixels=True)
+        return header, dicom_file.tell()
+
+
+def dicom_memmap(file_name, header, pixel_data_offset):
+    """Read-only memmap of uncompressed little endian pixel data (channel 0 for RGB), None if not applicable"""
+    transfer_syntax = header.file_meta.get('TransferSyntaxUID')
+    if (
+        transfer_syntax is None
+        or transfer_syntax.is_compressed
+        or transfer_syntax.is_deflated
+        or not transfer_syntax.is_little_endian
+        or header.get('BitsAllocated') not in (8, 16)
+        or header.get('PhotometricInterpretation') in ('YBR_FULL_422', 'YBR_PARTIAL_422')  # subsampled chroma
+        or header.get('PixelRepresentation') == 1
+        and header.get('BitsStored') != header.get('BitsAllocated')  # pydicom sign-extends these
+    ):
+        return None
+
+    with open(file_name, 'rb') as dicom_file:
+        dicom_file.seek(pixel_data_offset)
+        element_header = dicom_file.read(12)
+    if not element_header.startswith(PIXEL_DATA_TAG):
+        return None
+    if transfer_syntax.is_implicit_VR:
+        length, data_offset = struct.unpack('<I', element_header[4:8])[0], pixel_data_offset + 8
+    else:  # OB/OW have a 4 byte length after 2 reserved bytes
+        length, data_offset = struct.unpack('<I', element_header[8:12])[0], pixel_data_offset + 12
+
+    num_frames = int(header.get('NumberOfFrames', 1) or 1)
+    rows, cols = int(header.Rows), int(header.Columns)
+    samples = int(header.get('SamplesPerPixel', 1))
+    dtype = np.dtype(f'<{"i" if header.get("PixelRepresentation") == 1 else "u"}{header.BitsAllocated // 8}')
+    if length == 0xFFFFFFFF or length < num_frames * rows * cols * samples * dtype.itemsize:
+        return None
+
+    if samples == 1:
+        return np.memmap(file_name, dtype, 'r', data_offset, (num_frames, rows, cols))
+    if header.get('PlanarConfiguration', 0) == 0:  # pixel interleaved, strided view of channel 0
+        return np.memmap(file_name, dtype, 'r', data_offset, (num_frames, rows, cols, samples))[..., 0]
+    return np.memmap(file_name, dtype, 'r', data_offset, (num_frames, samples, rows, cols))[:, 0]
+
+
+def nifti_memmap(file_name):
+    """Read-only memmap (frames, rows, cols) of an uncompressed .nii file, None if not applicable"""
+    if not file_name.endswith('.nii'):
+        return None
+    try:
+        with open(file_name, 'rb') as nifti_file:
+            header = nifti_file.read(540)
+    except OSError:
+        return None
+    if len(header) < 348:
+        return None
+
+    for byte_order in '<>':
+        header_size = struct.unpack(f'{byte_order}i', header[:4])[0]
+        if header_size == 348:  # NIfTI-1
+            dims = struct.unpack(f'{byte_order}8h', header[40:56])
+            datatype = struct.unpack(f'{byte_order}h', header[70:72])[0]
+            vox_offset = int(struct.unpack(f'{byte_order}f', header[108:112])[0])
+            slope, intercept = struct.unpack(f'{byte_order}2f', header[112:120])
+            break
+        if header_size == 540 and len(header) == 540:  # NIfTI-2
+            dims = struct.unpack(f'{byte_order}8q', header[16:80])
+            datatype = struct.unpack(f'{byte_order}h', header[12:14])[0]
+            vox_offset = struct.unpack(f'{byte_order}q', header[168:176])[0]
+            slope, intercept = struct.unpack(f'{byte_order}2d', header[176:192])
+            break
+    else:
+        return None
+
+    if (
+        datatype not in NIFTI_DTYPES
+        or dims[0] not in (3, 4)
+        or dims[0] == 4
+        and dims[4] != 1
+        or slope not in (0, 1)  # scaled data is rescaled by SimpleITK
+        or intercept != 0
+    ):
+        return None
+    cols, rows, num_frames = dims[1:4]  # x varies fastest, same order as sitk.GetArrayFromImage
+    dtype = np.dtype(byte_order + NIFTI_DTYPES[datatype])
+
+    return np.memmap(file_name, dtype, 'r', vox_offset, (num_frames, rows, cols))
+
+
+def decode_volume(dicom, decode_threads=None):
+    """Decodes all frames of an encapsulated (compressed) DICOM in parallel into a grayscale volume"""
+    num_frames = int(dicom.get('NumberOfFrames', 1) or 1)
+    frame_data = list(generate_pixel_data_frame(dicom.PixelData, num_frames))
+    first_frame = decode_frame(dicom, frame_data[0])
+    volume = np.empty((num_frames, *first_frame.shape), dtype=first_frame.dtype)  # preallocated, filled in place
+    volume[0] = first_frame
+    decode_in_parallel(
+        lambda frame: decode_frame(dicom, frame_data[frame]), range(1, num_frames), volume[1:], decode_threads
+    )
+
+    return volume
+
+
+def decode_in_parallel(decode, frames, out, decode_threads=None):
+    """Writes decode(frame) of every frame to out in frame order using a thread pool, returns out"""
+    start_time = time.perf_counter()
+
+    def decode_into(index):
+        out[index] = decode(frames[index])
+
+    # threads share the compressed data without copying it to worker processes, the C decoders (Pillow, pylibjpeg,
+    # GDCM) run in parallel as far as they release the GIL
+    with ThreadPoolExecutor(decode_threads or os.cpu_count(), thread_name_prefix='decode') as pool:
+        for _ in pool.map(decode_into, range(len(frames))):  # re-raises decoding errors
+            pass
+    seconds = max(time.perf_counter() - start_time, 1e-6)
+    log = logger.info if len(frames) >= 100 else logger.debug  # e.g. whole pullbacks, not a few frames for inference
+    log(
+        f'Decoded {len(frames)} frames in {seconds:.2f} s ({len(frames) / seconds:.0f} frames/s, '
+        f'{out.nbytes / 2**20 / seconds:.0f} MB/s)'
+    )
+
+    return out
+
+
+def decode_frame(dicom, pixel_data):
+    """Decodes the pixel data of a single frame with the usual pydicom pixel handlers, channel 0 for RGB input"""
+    image = single_frame_dataset(dicom, pixel_data).pixel_array
+    if image.ndim == 3:  # 3 channel input
+        image = np.ascontiguousarray(image[:, :, 0])
+
+    return image
+
+
+def single_frame_dataset(dicom, pixel_data):
+    """Dataset holding only the given frame of dicom"""
+    dataset = Dataset()
+    dataset.file_meta = dicom.file_meta
+    for keyword in PIXEL_MODULE:
+        if keyword in dicom:
+            setattr(dataset, keyword, dicom.data_element(keyword).value)
+    dataset.NumberOfFrames = 1
+    if dicom.file_meta.TransferSyntaxUID.is_compressed:
+        dataset.PixelData = encapsulate([pixel_data])
+        dataset['PixelData'].is_undefined_length = True
+    else:
+        dataset.PixelData = pixel_data
+
+    return dataset
+
+
+class DicomFrameSource:
+    """
+    Array-like (frames, rows, cols) view of a multi-frame DICOM which decodes frames on demand.
+
+    Decoded grayscale frames (channel 0 for RGB input) are kept in a bounded LRU cache, a read-ahead thread decodes
+    the frames around the current slider position. Indexing returns NumPy arrays, np.asarray() decodes all frames.
+    Selections of several frames are decoded in parallel.
+    """
+
+    def __init__(self, dicom, cache_size=256, read_ahead=16, decode_threads=None):
+        self.dicom = dicom
+        self.cache_size = cache_size
+        self.read_ahead_frames = read_ahead
+        self.decode_threads = decode_threads
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.compressed = dicom.file_meta.TransferSyntaxUID.is_compressed
+        num_frames = int(dicom.get('NumberOfFrames', 1) or 1)
+        self.shape = (num_frames, int(dicom.Rows), int(dicom.Columns))
+        self.ndim = 3
+        if self.compressed:  # encapsulated byte stream of every frame, split once without decoding
+            self.frame_data = list(generate_pixel_data_frame(dicom.PixelData, num_frames))
+        self.dtype = self.frame(0).dtype
+
+        self.closed = False
+        self.read_ahead_centre = None
+        self.read_ahead_condition = threading.Condition()
+        self.read_ahead_thread = threading.Thread(target=self.read_ahead_loop, name='read_ahead', daemon=True)
+        self.read_ahead_thread.start()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        images = self[:]
+        return images if dtype is None else images.astype(dtype)
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        if isinstance(index, (int, np.integer)):
+            return self.frame(int(index))[rest]
+
+        frames = np.arange(self.shape[0])[index]  # slices, lists and arrays of frame indices
+        # large selections (e.g. the whole longitudinal view) would only flush the cache
+        return self.read(frames, rest, cache=len(frames) <= self.cache_size)
+
+    def read(self, frames, rest=(), cache=True):
+        """Decodes the given frames (indexed by rest within each frame), several frames are decoded in parallel"""
+        images = np.empty((len(frames), *np.empty(self.shape[1:], dtype=bool)[rest].shape), dtype=self.dtype)
+        if len(frames) == 1:
+            images[0] = self.frame(int(frames[0]), cache)[rest]
+            return images
+
+        return decode_in_parallel(
+            lambda frame: self.frame(int(frame), cache)[rest], frames, images, self.decode_threads
+        )
+
+    def frame(self, frame, cache=True):
+        """Decoded grayscale frame, from cache if available"""
+        if frame < 0:
+            frame += self.shape[0]
+        with self.cache_lock:
+            if frame in self.cache:
+                self.cache.move_to_end(frame)
+                return self.cache[frame]
+        image = self.decode(frame)
+        if cache:
+            self.add_to_cache(frame, image)
+
+        return image
+
+    def add_to_cache(self, frame, image):
+        image.flags.writeable = False  # cached frames are shared
+        with self.cache_lock:
+            self.cache[frame] = image
+            self.cache.move_to_end(frame)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def decode(self, frame):
+        """Decodes a single frame without touching the other frames"""
+        if self.compressed:
+            pixel_data = self.frame_data[frame]
+        else:
+            frame_size = len(self.dicom.PixelData) // self.shape[0]
+            pixel_data = self.dicom.PixelData[frame * frame_size : (frame + 1) * frame_size]
+
+        return decode_frame(self.dicom, pixel_data)
+
+    def read_ahead(self, frame):
+        """Requests decoding of the frames around frame in the background"""
+        with self.read_ahead_condition:
+            self.read_ahead_centre = frame
+            self.read_ahead_condition.notify()
+
+    def close(self):
+        """Stops the read-ahead thread and releases the cache"""
+        with self.read_ahead_condition:
+            self.closed = True
+            self.read_ahead_condition.notify()
+        with self.cache_lock:
+            self.cache.clear()
+
+    def read_ahead_loop(self):
+        while True:
+            with self.read_ahead_condition:
+                while self.read_ahead_centre is None and not self.closed:
+                    self.read_ahead_condition.wait()
+                if self.closed:
+                    return
+                centre, self.read_ahead_centre = self.read_ahead_centre, None
+
+            offsets = np.arange(1, self.read_ahead_frames + 1)
+            frames = np.column_stack([centre + offsets, centre - offsets]).ravel()  # nearest frames first
+            for frame in frames[(frames >= 0) & (frames < self.shape[0])]:
+                if self.read_ahead_centre is not None:  # slider moved on, start over from the new position
+                    break
+                if frame not in self.cache:
+                    try:
+                        self.frame(int(frame))
+                    except Exception as error:  # reported when the frame is requested in the foreground
+                        logger.debug(f'Read-ahead of frame {frame} failed: {error}')
@@ -24,8 +24,9 @@ class MetadataWindow(QMainWindow):
         y = sum([self.table.rowHeight(i) for i in range(self.table.rowCount())])
         self.setFixedSize(x, y)
 
-def parse_dicom(main_window):
-    """Parses DICOM metadata"""
+def parse_dicom(main_window, cached_metadata=None):
+    """Parses DICOM metadata, values found in cached_metadata (e.g. entered when the pullback was cached) are reused"""
+    cached_metadata = cached_metadata or {}
     if len(main_window.dicom.PatientName.encode('ascii')) > 0:
         patient_name = main_window.dicom.PatientName.original_string.decode('utf-8')
     else:
@@ -41,12 +42,8 @@ def parse_dicom(main_window):
     else:
         gender = 'Unknown'
 
-    if main_window.dicom.get('IVUSPullbackRate'):
-        pullback_rate = float(main_window.dicom.IVUSPullbackRate)
-    # check Boston private tag
-    elif main_window.dicom.get(0x000B1001):
-        pullback_rate = float(main_window.dicom[0x000B1001].value)
-    else:
+    pullback_rate = cached_metadata.get('pullback_rate') or read_pullback_rate(main_window.dicom)
+    if pullback_rate is None:
         pullback_rate, _ = QInputDialog.getText(
             main_window,
             'Pullback Speed',
@@ -56,26 +53,16 @@ def parse_dicom(main_window):
         )
         pullback_rate = float(pullback_rate)
 
-    if main_window.dicom.get('FrameTimeVector'):
-        frame_time_vector = main_window.dicom.get('FrameTimeVector')
-        frame_time_vector = [float(frame) for frame in frame_time_vector]
-        pullback_time = np.cumsum(frame_time_vector) / 1000  # assume in ms
-        pullback_length = pullback_time * float(pullback_rate)
+    if cached_metadata.get('pullback_length') is not None:
+        pullback_length = np.array(cached_metadata['pullback_length'])
     else:
-        pullback_length = np.zeros((main_window.images.shape[0],))
+        pullback_length = read_pullback_length(main_window.dicom, pullback_rate, main_window.images.shape[0])
 
+    main_window.metadata['pullback_rate'] = pullback_rate
     main_window.metadata['pullback_length'] = pullback_length
 
-    if main_window.dicom.get('SequenceOfUltrasoundRegions'):
-        if main_window.dicom.SequenceOfUltrasoundRegions[0].PhysicalUnitsXDirection == 3:
-            # pixels are in cm, convert to mm
-            resolution = main_window.dicom.SequenceOfUltrasoundRegions[0].PhysicalDeltaX * 10
-        else:
-            # assume mm
-            resolution = main_window.dicom.SequenceOfUltrasoundRegions[0].PhysicalDeltaX
-    elif main_window.dicom.get('PixelSpacing'):
-        resolution = float(main_window.dicom.PixelSpacing[0])
-    else:
+    resolution = cached_metadata.get('resolution') or read_resolution(main_window.dicom)
+    if resolution is None:
         resolution, _ = QInputDialog.getText(
             main_window,
             'Pixel Spacing',
@@ -127,3 +114,34 @@ def parse_dicom(main_window):
     main_window.metadata_table.resizeRowsToContents()
     main_window.metadata_table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
     main_window.metadata_table.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+
+
+def read_pullback_rate(dicom):
+    """Pullback speed (mm/s), None if not stored in the DICOM"""
+    if dicom.get('IVUSPullbackRate'):
+        return float(dicom.IVUSPullbackRate)
+    if dicom.get(0x000B1001):  # Boston private tag
+        return float(dicom[0x000B1001].value)
+    return None
+
+
+def read_pullback_length(dicom, pullback_rate, num_frames):
+    """Cumulative pullback length (mm) of every frame, zeros if the DICOM has no frame time vector"""
+    if dicom.get('FrameTimeVector'):
+        frame_time_vector = [float(frame) for frame in dicom.get('FrameTimeVector')]
+        pullback_time = np.cumsum(frame_time_vector) / 1000  # assume in ms
+        return pullback_time * float(pullback_rate)
+    return np.zeros((num_frames,))
+
+
+def read_resolution(dicom):
+    """Pixel spacing (mm), None if not stored in the DICOM"""
+    if dicom.get('SequenceOfUltrasoundRegions'):
+        if dicom.SequenceOfUltrasoundRegions[0].PhysicalUnitsXDirection == 3:
+            # pixels are in cm, convert to mm
+            return dicom.SequenceOfUltrasoundRegions[0].PhysicalDeltaX * 10
+        # assume mm
+        return dicom.SequenceOfUltrasoundRegions[0].PhysicalDeltaX
+    if dicom.get('PixelSpacing'):
+        return float(dicom.PixelSpacing[0])
+    return None
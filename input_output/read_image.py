@@ -1,15 +1,19 @@
 import os
+import time
 
-import pydicom as dcm
 import SimpleITK as sitk
 import numpy as np
 import matplotlib.pyplot as plt
 from loguru import logger
 from PyQt5.QtWidgets import QFileDialog
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, pyqtSlot
 
 from gui.popup_windows.message_boxes import ErrorMessage
+from gui.utils.geometry import full_contour
+from input_output.image_source import DicomFrameSource, nifti_memmap
 from input_output.metadata import parse_dicom
-from input_output.contours_io import read_contours
+from input_output.volume_cache import create_volume_cache, open_dicom_cached, volume_metadata
+from input_output.contours_io import read_contours, write_contours
 
 
 def read_image(main_window):
@@ -17,7 +21,8 @@ def read_image(main_window):
     Reads DICOM or NIfTi images.
 
     Reads the DICOM/NIfTi images and metadata. Places metatdata in a table.
-    Images are displayed in the graphics scene.
+    Images are displayed in the graphics scene as soon as the current frame is available, the longitudinal view and
+    full contours are filled in by a background worker.
     """
     main_window.status_bar.showMessage('Reading image file...')
     options = QFileDialog.Options()
@@ -27,68 +32,188 @@ def read_image(main_window):
     )
 
     if file_name:
-        main_window.gating_display.fig.clear()
-        plt.draw()
-        try:  # DICOM
-            main_window.dicom = dcm.read_file(file_name, force=True)
-            main_window.images = main_window.dicom.pixel_array
-            if main_window.images.ndim == 4:  # 3 channel input
-                main_window.images = main_window.images[:, :, :, 0]
-            parse_dicom(main_window)
-        except AttributeError:
-            try:  # NIfTi
+        open_image(main_window, file_name)
+    main_window.status_bar.showMessage(main_window.waiting_status)
+
+
+def open_image(main_window, file_name):
+    """Opens the given DICOM or NIfTi pullback, e.g. chosen in the file dialog or the catalogue"""
+    if main_window.segmentation_job is not None or main_window.nifti_export_job is not None:
+        # both write results of the current pullback, stop them first (the segmented frames are kept)
+        ErrorMessage(main_window, 'Cannot open another file while automatic segmentation or NIfTi export is running')
+        return
+    main_window.status_bar.showMessage('Reading image file...')
+    start_time = time.perf_counter()
+    if main_window.load_job is not None:
+        main_window.load_job.cancel()  # stop loading the previous pullback
+    if main_window.image_displayed and main_window.revision != main_window.saved_revision:
+        write_contours(main_window)  # edits of the previous pullback since the last autosave
+    main_window.metrics.invalidate()  # metrics read from the contour file are computed again once
+    main_window.gating_display.fig.clear()
+    plt.draw()
+    if isinstance(main_window.images, DicomFrameSource):
+        main_window.images.close()  # stop read-ahead of the previous pullback
+    try:  # DICOM, memory-mapped if uncompressed or cached, otherwise frames are decoded on demand
+        volume_cache = create_volume_cache(main_window.config)
+        main_window.dicom, main_window.images, cached_metadata, cache_key = open_dicom_cached(
+            file_name,
+            volume_cache,
+            main_window.config.display.frame_cache_size,
+            main_window.config.display.read_ahead,
+            main_window.config.display.decode_threads,
+        )
+        if main_window.config.segmentation.preload_model and main_window.dicom.get('Rows'):
+            main_window.predictor.preload((main_window.dicom.Rows, main_window.dicom.Columns))
+        parse_dicom(main_window, cached_metadata)
+        if cache_key is not None and cached_metadata is None:  # decode all frames for the next open
+            volume_cache.put_in_background(cache_key, main_window.images, volume_metadata(main_window.metadata))
+    except AttributeError:
+        try:  # NIfTi
+            main_window.images = nifti_memmap(file_name)
+            if main_window.images is None:  # compressed or scaled
                 main_window.images = sitk.GetArrayFromImage(sitk.ReadImage(file_name))
-                main_window.file_name = main_window.file_name.split('_')[0]  # remove _img.nii suffix
-            except:
-                ErrorMessage(
-                    main_window, 'File is not a valid IVUS file and could not be loaded (DICOM or NIfTi supported)'
-                )
-                return None
-
-        main_window.file_name = os.path.splitext(file_name)[0]  # remove file extension
-        main_window.metadata['num_frames'] = main_window.images.shape[0]
-        main_window.display_slider.setMaximum(main_window.metadata['num_frames'] - 1)
-
-        success = read_contours(main_window, main_window.file_name)
-        if success:
-            main_window.segmentation = True
-            try:
-                main_window.gated_frames_dia = [
-                    frame
-                    for frame in range(main_window.metadata['num_frames'])
-                    if main_window.data['phases'][frame] == 'D'
-                ]
-                main_window.gated_frames_sys = [
-                    frame
-                    for frame in range(main_window.metadata['num_frames'])
-                    if main_window.data['phases'][frame] == 'S'
-                ]
-                main_window.gated_frames = main_window.gated_frames_dia
-            except KeyError:  # old contour files may not have phases attribute
-                pass
-        else:  # initialise empty containers
-            for key in [
-                'plaque_frames',
-                'lumen_area',
-                'lumen_circumf',
-                'longest_distance',
-                'shortest_distance',
-                'elliptic_ratio',
-                'vector_length',
-                'vector_angle',
-            ]:
-                main_window.data[key] = [0] * main_window.metadata['num_frames']
-            main_window.data['phases'] = ['-'] * main_window.metadata['num_frames']
-            for key in ['lumen_centroid', 'farthest_point', 'nearest_point', 'lumen']:
-                main_window.data[key] = (
-                    [[] for _ in range(main_window.metadata['num_frames'])],
-                    [[] for _ in range(main_window.metadata['num_frames'])],
-                )
-            main_window.data['measures'] = [[None, None] for _ in range(main_window.metadata['num_frames'])]
-            main_window.data['measure_lengths'] = [[np.nan, np.nan] for _ in range(main_window.metadata['num_frames'])]
-            main_window.data['reference'] = [None] * main_window.metadata['num_frames']
-            main_window.display.set_data(main_window.data['lumen'], main_window.images)
-
-        main_window.image_displayed = True
-        main_window.display_slider.setValue(main_window.metadata['num_frames'] - 1)
+            main_window.file_name = main_window.file_name.split('_')[0]  # remove _img.nii suffix
+        except:
+            ErrorMessage(
+                main_window, 'File is not a valid IVUS file and could not be loaded (DICOM or NIfTi supported)'
+            )
+            return None
+
+    main_window.file_name = os.path.splitext(file_name)[0]  # remove file extension
+    main_window.metadata['num_frames'] = main_window.images.shape[0]
+    main_window.display_slider.setMaximum(main_window.metadata['num_frames'] - 1)
+
+    success = read_contours(main_window, main_window.file_name)
+    if success:
+        main_window.segmentation = True
+        try:
+            main_window.gated_frames_dia = [
+                frame for frame in range(main_window.metadata['num_frames']) if main_window.data['phases'][frame] == 'D'
+            ]
+            main_window.gated_frames_sys = [
+                frame for frame in range(main_window.metadata['num_frames']) if main_window.data['phases'][frame] == 'S'
+            ]
+            main_window.gated_frames = main_window.gated_frames_dia
+        except KeyError:  # old contour files may not have phases attribute
+            pass
+    else:  # initialise empty containers
+        for key in [
+            'plaque_frames',
+            'lumen_area',
+            'lumen_circumf',
+            'longest_distance',
+            'shortest_distance',
+            'elliptic_ratio',
+            'vector_length',
+            'vector_angle',
+        ]:
+            main_window.data[key] = [0] * main_window.metadata['num_frames']
+        main_window.data['phases'] = ['-'] * main_window.metadata['num_frames']
+        for key in ['lumen_centroid', 'farthest_point', 'nearest_point', 'lumen']:
+            main_window.data[key] = (
+                [[] for _ in range(main_window.metadata['num_frames'])],
+                [[] for _ in range(main_window.metadata['num_frames'])],
+            )
+        main_window.data['measures'] = [[None, None] for _ in range(main_window.metadata['num_frames'])]
+        main_window.data['measure_lengths'] = [[np.nan, np.nan] for _ in range(main_window.metadata['num_frames'])]
+        main_window.data['reference'] = [None] * main_window.metadata['num_frames']
+        main_window.display.set_data(main_window.data['lumen'], main_window.images)
+
+    main_window.image_displayed = True
+    main_window.mark_saved()  # nothing to autosave until the first edit
+    main_window.display_slider.setValue(main_window.metadata['num_frames'] - 1)
+    main_window.load_job = BackgroundLoad(main_window)
+    logger.info(f'Time to first frame: {time.perf_counter() - start_time:.2f} s')
     main_window.status_bar.showMessage(main_window.waiting_status)
+
+
+class LoadWorker(QObject):
+    """Reads the central column of every frame for the longitudinal view and interpolates the full contours"""
+
+    chunk_loaded = pyqtSignal(int, object, object)  # first frame, central columns (frames, rows), full contours
+    finished = pyqtSignal(bool)  # True if all frames were loaded
+    failed = pyqtSignal(str)
+
+    def __init__(self, images, lumen, n_points_contour, chunk_size=64):
+        super().__init__()
+        self.images = images
+        self.lumen = lumen
+        self.n_points_contour = n_points_contour
+        self.chunk_size = chunk_size
+        self.cancelled = False
+
+    def run(self):
+        completed = False
+        try:
+            num_frames = self.images.shape[0]
+            column = self.images.shape[1] // 2
+            for start in range(0, num_frames, self.chunk_size):
+                if self.cancelled:
+                    break
+                stop = min(start + self.chunk_size, num_frames)
+                if isinstance(self.images, DicomFrameSource):  # keep the cached frames around the slider position
+                    columns = self.images.read(range(start, stop), (slice(None), column), cache=False)
+                else:
+                    columns = np.array(self.images[start:stop, :, column])
+                contours = [full_contour(self.lumen, frame, self.n_points_contour) for frame in range(start, stop)]
+                self.chunk_loaded.emit(start, columns, contours)
+            else:
+                completed = True
+        except Exception as error:  # reported in the GUI instead of ending the thread silently
+            logger.exception(error)
+            self.failed.emit(str(error))
+        self.finished.emit(completed)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BackgroundLoad(QObject):
+    """Owns the loading thread and adds longitudinal view columns and full contours in the main thread"""
+
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.start_time = time.perf_counter()
+        self.num_frames = main_window.images.shape[0]
+        lumen = main_window.data['lumen']
+        lumen = ([list(x) for x in lumen[0]], [list(y) for y in lumen[1]])  # the user can edit while loading
+
+        self.thread = QThread()
+        self.worker = LoadWorker(main_window.images, lumen, main_window.config.display.n_points_contour)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.chunk_loaded.connect(self.chunk_loaded)
+        self.worker.failed.connect(self.failed)
+        self.worker.finished.connect(self.finished)
+        self.worker.finished.connect(self.thread.quit, Qt.DirectConnection)  # finished slot waits for the thread
+        self.thread.start()
+
+    @pyqtSlot(int, object, object)
+    def chunk_loaded(self, start, columns, contours):
+        if self.worker.cancelled:  # queued before another pullback was opened
+            return
+        self.main_window.longitudinal_view.set_columns(start, columns)
+        self.main_window.display.set_full_contours(start, contours)
+        if self.main_window.hide_contours:
+            self.main_window.longitudinal_view.hide_lview_contours()
+
+    @pyqtSlot(str)
+    def failed(self, message):
+        ErrorMessage(self.main_window, f'Loading the longitudinal view failed: {message}')
+
+    @pyqtSlot(bool)
+    def finished(self, completed):
+        self.thread.wait()
+        if self.main_window.load_job is self:
+            self.main_window.load_job = None
+        if completed:
+            logger.info(
+                f'Loaded longitudinal view and contours of {self.num_frames} frames in '
+                f'{time.perf_counter() - self.start_time:.2f} s'
+            )
+
+    def cancel(self):
+        self.worker.cancel()
+        self.thread.quit()
+        self.thread.wait()
@@ -1,60 +1,72 @@
 import xml.etree.ElementTree as ET
 
+import numpy as np
 
-def read_xml(main_window, path, frames=[]):
-    tree = ET.parse(path)  # current version
-    root = tree.getroot()
-    root.attrib
-    lumen_points = []
-    frame_list = []
-    phases = []
-    lumen = {}
-
-    for child in root:
-        for image_state in child.iter('ImageState'):
-            dim_z = image_state.find('NumberOfFrames').text
-            if not frames:
-                frames = range(int(dim_z))
-
-        for image_calibration in child.iter('ImageCalibration'):
-            res_x = image_calibration.find('XCalibration').text
-
-        for _ in child.iter('FrameState'):
-            for frame in child.iter('Fm'):
-                frame_number = int(frame.find('Num').text)
-                lumen_subpoints = []
-                if frame_number in frames:
-                    try:
-                        phase = frame.find('Phase').text
-                        phase = '-' if phase is None else phase
-                    except AttributeError:  # old contour files may not have phase attribute
-                        phase = '-'
-                    phases.append(phase)
-                    for pts in frame.iter('Ctr'):
-                        frame_list.append(frame_number)
-                        for child in pts:
-                            if child.tag == 'Type':
-                                if child.text == 'L':
-                                    contour = 'L'
-                            # add each point
-                            elif child.tag == 'p':
-                                if contour == 'L':
-                                    lumen_subpoints.append(child.text)
-                    lumen_points.append(lumen_subpoints)
-                    lumen[frame_number] = lumen_subpoints
-
-    main_window.data['lumen'] = split_x_y(lumen_points)
+
+def read_xml(main_window, path, frames=None):
+    """Reads lumen contours, phases and resolution from an xml contour file"""
+    lumen, phases, resolution = parse_xml(path, frames)
+    main_window.data['lumen'] = lumen
     main_window.data['phases'] = phases
-    main_window.metadata['resolution'] = res_x
+    main_window.metadata['resolution'] = resolution
+
+
+def parse_xml(path, frames=None, chunk_size=100000):
+    """
+    Streams the xml file with iterparse, the points of every frame are discarded once read.
+
+    Point strings are parsed with NumPy in chunks of many frames. Returns (x, y) lists of lumen points per frame, the
+    phases and the resolution of the frames in frames (all frames up to NumberOfFrames by default).
+    """
+    num_frames = None
+    resolution = None
+    frame_numbers = []
+    phases = []
+    num_points = []
+    points = []  # 'x,y' strings of the frames not parsed yet
+    parsed = []  # integer arrays of the frames parsed so far
+    for _, element in ET.iterparse(path):  # end events only, elements are complete
+        if element.tag == 'Fm':
+            frame_numbers.append(int(element.findtext('Num')))
+            phases.append(element.findtext('Phase') or '-')  # old contour files may not have phase attribute
+            frame_points = [
+                point.text
+                for contour in element.iter('Ctr')
+                if contour.findtext('Type') == 'L'  # lumen, other contour types are ignored
+                for point in contour.iter('p')
+            ]
+            num_points.append(len(frame_points))
+            points.extend(frame_points)
+            if len(points) > chunk_size:
+                parsed.append(parse_points(points))
+                points = []
+            element.clear()  # drops the points, keeps memory low for long pullbacks
+        elif element.tag == 'NumberOfFrames':
+            num_frames = int(element.text)
+        elif element.tag == 'XCalibration':
+            resolution = float(element.text)
+
+    if frames is None:
+        frames = range(num_frames)
+    parsed.append(parse_points(points))
+    values = np.concatenate(parsed)
+    frame_values = np.split(values, np.cumsum(num_points)[:-1])
+    selected = [i for i, frame in enumerate(frame_numbers) if frame in frames]
 
+    return (
+        ([frame_values[i][:, 0].tolist() for i in selected], [frame_values[i][:, 1].tolist() for i in selected]),
+        [phases[i] for i in selected],
+        resolution,
+    )
 
-def split_x_y(points):
-    """Splits comma separated points into separate x and y lists"""
 
-    points_x = []
-    points_y = []
-    for i in range(0, len(points)):
-        points_x.append(map(lambda x: int(x.split(',')[0]), points[i]))
-        points_y.append(map(lambda x: int(x.split(',')[1]), points[i]))
+def parse_points(points):
+    """Parses 'x,y' strings into an integer array of shape (n, 2)"""
+    if not points:
+        return np.empty((0, 2), dtype=int)
+    text = ','.join(points)
+    values = np.fromstring(text, dtype=int, sep=',')
+    if len(values) != 2 * len(points):  # decimal points, not written by the GUI or the vendor software
+        values = np.fromstring(text, dtype=float, sep=',').astype(int)
 
-    return points_x, points_y
+    return values.reshape(-1, 2)
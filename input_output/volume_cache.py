@@ -0,0 +1,239 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import threading
+
+import hydra
+import numpy as np
+import pydicom as dcm
+from omegaconf import DictConfig
+from loguru import logger
+from tqdm import tqdm
+
+from input_output.image_source import DicomFrameSource, decode_in_parallel, dicom_memmap, open_dicom, read_dicom_header
+from input_output.metadata import read_pullback_length, read_pullback_rate, read_resolution
+
+CACHE_VERSION = 2  # increase when the stored layout or the key changes, old entries are then never hit and evicted
+KEY_BLOCKS = 16  # blocks of the pixel data hashed into the key (first and last included)
+KEY_BLOCK_SIZE = 2**16  # in bytes
+
+
+class VolumeCache:
+    """
+    Persistent cache of decoded grayscale volumes of compressed DICOM pullbacks.
+
+    Every volume is stored as a raw .npy file next to a small JSON header (shape, dtype and metadata such as resolution,
+    pullback rate and pullback length) and memory-mapped on later opens instead of being decoded again. Entries are
+    keyed by path, size, modification time, header and a sample of the pixel data of the DICOM. The least recently
+    used volumes are evicted once the cache exceeds its size limit.
+    """
+
+    def __init__(self, cache_dir, max_size_mb):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 2**20  # in bytes
+        self.size = None  # total size on disk, determined on first write
+        self.size_lock = threading.Lock()  # volumes are written from background threads
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_name, pixel_data_offset):
+        """
+        Cache key of a pullback, changes if the file is moved, touched or modified.
+
+        Besides path, size and modification time only the header and a few evenly spaced blocks of the pixel data are
+        hashed, hashing the whole file would take seconds for a large pullback on a network share.
+        """
+        stat = os.stat(file_name)
+        key_hash = hashlib.blake2b(digest_size=16)
+        key_hash.update(f'{CACHE_VERSION} {os.path.abspath(file_name)} {stat.st_size} {stat.st_mtime_ns}'.encode())
+        with open(file_name, 'rb') as dicom_file:
+            key_hash.update(dicom_file.read(pixel_data_offset))
+            last_block = max(stat.st_size - KEY_BLOCK_SIZE, pixel_data_offset)
+            for offset in np.linspace(pixel_data_offset, last_block, KEY_BLOCKS).astype(np.int64):
+                dicom_file.seek(offset)
+                key_hash.update(dicom_file.read(KEY_BLOCK_SIZE))
+        return key_hash.hexdigest()
+
+    def paths(self, key):
+        """Paths of the volume and its JSON header"""
+        stem = os.path.join(self.cache_dir, key[:2], key)
+        return f'{stem}.npy', f'{stem}.json'
+
+    def get(self, key):
+        """Returns the cached volume (read-only memmap) and its metadata or None, marks the volume as recently used"""
+        volume_path, header_path = self.paths(key)
+        try:
+            with open(header_path) as header_file:
+                header = json.load(header_file)
+            volume = np.load(volume_path, mmap_mode='r')
+            os.utime(volume_path)  # modification time is used for LRU eviction
+        except (OSError, ValueError):  # missing (e.g. evicted by another process) or corrupted
+            return None
+        if list(volume.shape) != header['shape']:
+            return None
+
+        return volume, header['metadata']
+
+    def put(self, key, frames, metadata):
+        """Decodes the frames into the cache, the volume only becomes visible once complete"""
+        volume_path, header_path = self.paths(key)
+        os.makedirs(os.path.dirname(volume_path), exist_ok=True)
+        tmp_suffix = f'{os.getpid()}.{threading.get_ident()}.tmp'
+        header = {'shape': list(frames.shape), 'dtype': str(frames.dtype), 'metadata': metadata}
+        try:
+            volume = np.lib.format.open_memmap(f'{volume_path}.{tmp_suffix}', 'w+', frames.dtype, tuple(frames.shape))
+            if isinstance(frames, DicomFrameSource):  # decode directly, the viewer's cached frames would be evicted
+                decode_in_parallel(frames.decode, range(len(frames)), volume, frames.decode_threads)
+            else:
+                volume[:] = frames
+            volume.flush()
+            del volume
+            with open(f'{header_path}.{tmp_suffix}', 'w') as header_file:
+                json.dump(header, header_file)
+            os.replace(f'{header_path}.{tmp_suffix}', header_path)
+            os.replace(f'{volume_path}.{tmp_suffix}', volume_path)  # atomic, readers never see partial volumes
+        finally:
+            for tmp_path in (f'{volume_path}.{tmp_suffix}', f'{header_path}.{tmp_suffix}'):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        with self.size_lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.entries())
+            else:
+                self.size += os.path.getsize(volume_path)
+            if self.size > self.max_size:
+                self.evict()
+
+    def put_in_background(self, key, frames, metadata):
+        """Caches the volume in a daemon thread, e.g. while the pullback is being viewed"""
+
+        def put():
+            start_time = time.perf_counter()
+            try:
+                self.put(key, frames, metadata)
+            except Exception as error:  # caching is optional, the pullback is decoded again next time
+                logger.warning(f'Could not cache decoded volume: {error}')
+                return
+            logger.info(f'Cached decoded volume of {len(frames)} frames in {time.perf_counter() - start_time:.1f} s')
+
+        thread = threading.Thread(target=put, name='volume_cache', daemon=True)
+        thread.start()
+
+        return thread
+
+    def entries(self):
+        """Yields (path, size, last use) of all cached volumes"""
+        for sub_dir in os.scandir(self.cache_dir):
+            if sub_dir.is_dir():
+                for entry in os.scandir(sub_dir.path):
+                    if entry.name.endswith('.npy'):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """Removes least recently used volumes until the cache is at 90% of its size limit"""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for path, size, _ in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            for evicted_path in (path, f'{os.path.splitext(path)[0]}.json'):
+                try:
+                    os.remove(evicted_path)
+                except FileNotFoundError:  # already evicted by another process
+                    pass
+            self.size -= size
+            num_evicted += 1
+        for tmp_path in glob.glob(os.path.join(self.cache_dir, '*', '*.tmp')):  # left behind by closed viewers
+            try:
+                if time.time() - os.path.getmtime(tmp_path) > 24 * 3600:
+                    os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        logger.info(f'Evicted {num_evicted} volumes from volume cache {self.cache_dir}')
+
+
+def create_volume_cache(config):
+    """Volume cache configured in display, None if disabled"""
+    if config.display.volume_cache_dir is None:
+        return None
+    return VolumeCache(config.display.volume_cache_dir, config.display.volume_cache_size_mb)
+
+
+def open_dicom_cached(file_name, volume_cache, cache_size=256, read_ahead=16, decode_threads=None):
+    """
+    Opens a DICOM like open_dicom, compressed pullbacks are served from the volume cache if available.
+
+    Returns (dicom, images, cached metadata, key), cached metadata is None on a cache miss and key is None if the
+    pullback is not cached (cache disabled or uncompressed pullback which is memory-mapped anyway).
+    """
+    if volume_cache is None:
+        return (*open_dicom(file_name, cache_size, read_ahead, decode_threads), None, None)
+    header, pixel_data_offset = read_dicom_header(file_name)
+    images = dicom_memmap(file_name, header, pixel_data_offset)
+    if images is not None:
+        return header, images, None, None
+
+    key = None
+    if header.file_meta.get('TransferSyntaxUID') is not None:  # otherwise not a DICOM, fails below like open_dicom
+        key = volume_cache.key(file_name, pixel_data_offset)
+        cached = volume_cache.get(key)
+        if cached is not None:  # header is enough for the metadata, pixel data is not read at all
+            logger.info(f'Read decoded volume of {file_name} from volume cache')
+            return header, cached[0], cached[1], key
+
+    dicom = dcm.dcmread(file_name, force=True)
+    return dicom, DicomFrameSource(dicom, cache_size, read_ahead, decode_threads), None, key
+
+
+def volume_metadata(metadata):
+    """JSON-serialisable metadata stored with a cached volume"""
+    return {
+        'resolution': metadata.get('resolution'),
+        'pullback_rate': metadata.get('pullback_rate'),
+        'pullback_length': (
+            None if metadata.get('pullback_length') is None else np.asarray(metadata['pullback_length']).tolist()
+        ),
+    }
+
+
+@hydra.main(version_base=None, config_path='..', config_name='config')
+def prewarm_volume_cache(config: DictConfig) -> None:
+    """Decodes the compressed pullbacks of a worklist (one file per line) or of input_dir into the volume cache"""
+    volume_cache = create_volume_cache(config)
+    if volume_cache is None:
+        logger.error('Set display.volume_cache_dir to use the volume cache')
+        return
+    if config.display.volume_cache_worklist is not None:
+        with open(config.display.volume_cache_worklist) as worklist:
+            files = [line.strip() for line in worklist if line.strip()]
+    else:
+        files = glob.glob(config.segmentation.input_dir + '/NARCO_*/Run*/*', recursive=True)
+        files = [file for file in files if '_' not in os.path.basename(file)]  # exclude subdirs (all have _ in name)
+
+    num_cached = 0
+    for file in tqdm(files, desc='Caching', unit='files'):
+        try:
+            dicom, images, cached_metadata, key = open_dicom_cached(
+                file, volume_cache, read_ahead=0, decode_threads=config.display.decode_threads
+            )
+        except (AttributeError, OSError, dcm.errors.InvalidDicomError) as error:
+            logger.warning(f'Skipping {file}: {error}')
+            continue
+        if key is None or cached_metadata is not None:  # uncompressed or already cached
+            continue
+        pullback_rate = read_pullback_rate(dicom)  # missing values are asked for on the first open in the GUI
+        metadata = {'resolution': read_resolution(dicom), 'pullback_rate': pullback_rate}
+        if pullback_rate is not None:
+            metadata['pullback_length'] = read_pullback_length(dicom, pullback_rate, len(images))
+        volume_cache.put(key, images, volume_metadata(metadata))
+        images.close()
+        num_cached += 1
+    logger.info(f'Cached {num_cached} of {len(files)} pullbacks in {volume_cache.cache_dir}')
+
+
+if __name__ == '__main__':
+    prewarm_volume_cache()
@@ -1,6 +1,8 @@
 import xml.etree.ElementTree as et
+from xml.sax.saxutils import escape
 import os
 import datetime
+import threading
 
 from version import version_file_str
 
@@ -8,6 +10,9 @@ from version import version_file_str
 def write_xml(x, y, dims, resolution, speed, phases, out_path):
     """Write an xml file of contour data
 
+    The header is built with ElementTree, frames are streamed to the file with pre-formatted points (output is
+    identical to serialising the full tree).
+
     Args:
         x: list, where alternating entries are lists of lumen x points
         y: list, where alternating entries are lists of lumen y points
@@ -18,7 +23,28 @@ def write_xml(x, y, dims, resolution, speed, phases, out_path):
     Returns:
         None
     """
+    header, footer = et.tostring(header_tree(dims, resolution, speed, out_path), encoding='unicode').rsplit(
+        '</FrameState>', 1
+    )
+    out_file_name = out_path + f'_contours_{version_file_str}.xml'
+    tmp_file_name = f'{out_file_name}.{os.getpid()}.{threading.get_ident()}.tmp'  # replaces the file once complete
+    try:
+        # same encoding as ElementTree.write
+        with open(tmp_file_name, 'w', encoding='us-ascii', errors='xmlcharrefreplace', newline='\n') as out_file:
+            out_file.write(header)
+            for frame_index in range(dims[0]):
+                out_file.write(frame_xml(frame_index, x, y, phases))
+            out_file.write('</FrameState>' + footer)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_file_name, out_file_name)
+    finally:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+
 
+def header_tree(dims, resolution, speed, out_path):
+    """Analysis state up to the frame state, frames are added by the writer"""
     num_frames = dims[0]
     root = et.Element('AnalysisState')
     analysed_filename = et.SubElement(root, 'AnalyzedFileName')
@@ -85,30 +111,24 @@ def write_xml(x, y, dims, resolution, speed, phases, out_path):
     offset_x.text = str(109)
     offset_y = et.SubElement(frame_state, 'Yoffset')
     offset_y.text = str(3)
-    for frame_index in range(num_frames):
-        frame = et.SubElement(frame_state, 'Fm')
-        frame_number = et.SubElement(frame, 'Num')
-        frame_number.text = str(frame_index)
-        phase = et.SubElement(frame, 'Phase')
-        try:
-            phase.text = phases[frame_index]
-        except IndexError:  # old contour files may not have phases attr
-            phase.text = '-'
 
-        try:
-            contour = et.SubElement(frame, 'Ctr')
-            num_points = et.SubElement(contour, 'Npts')
-            num_points.text = str(len(x[frame_index]))
-            type = et.SubElement(contour, 'Type')
-            type.text = 'L'
-            hand_drawn = et.SubElement(contour, 'HandDrawn')
-            hand_drawn.text = 'T'
-            # iterative over the points in each contour
-            for k in range(len(x[frame_index])):
-                p = et.SubElement(contour, 'p')
-                p.text = str(int(x[frame_index][k])) + ',' + str(int(y[frame_index][k]))
-        except IndexError:
-            pass
+    return root
+
+
+def frame_xml(frame_index, x, y, phases):
+    """Serialised frame, as ElementTree writes it"""
+    try:
+        phase = phases[frame_index]
+    except IndexError:  # old contour files may not have phases attr
+        phase = '-'
+    phase = f'<Phase>{escape(phase)}</Phase>' if phase else '<Phase />'
+    if frame_index >= len(x):  # Npts without text, as the tree writer failed on the missing points
+        return f'<Fm><Num>{frame_index}</Num>{phase}<Ctr><Npts /></Ctr></Fm>'
+    points = ''.join(
+        f'<p>{int(x_point)},{int(y_point)}</p>' for x_point, y_point in zip(x[frame_index], y[frame_index])
+    )  # empty for frames without contour
 
-    tree = et.ElementTree(root)
-    tree.write(out_path + f'_contours_{version_file_str}.xml')
+    return (
+        f'<Fm><Num>{frame_index}</Num>{phase}<Ctr><Npts>{len(x[frame_index])}</Npts><Type>L</Type>'
+        f'<HandDrawn>T</HandDrawn>{points}</Ctr></Fm>'
+    )
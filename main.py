@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 import hydra
 import qdarktheme
 
@@ -19,4 +20,5 @@ def main(config: DictConfig) -> None:
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # spawned worker processes of a pyinstaller build run their task, not the GUI
     main()
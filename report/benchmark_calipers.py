@@ -0,0 +1,88 @@
+import math
+import time
+from itertools import combinations
+
+import numpy as np
+from loguru import logger
+from scipy.spatial import ConvexHull
+
+from gui.utils.geometry import interpolate_spline
+from report.polygon_metrics import caliper_widths
+
+
+def legacy_farthest_points(contour):
+    """Previous longest distance (all pairs of contour points), kept for comparison and as exact reference"""
+    max_distance = 0
+    for point1, point2 in combinations(contour.tolist(), 2):
+        max_distance = max(max_distance, math.dist(point1, point2))
+
+    return max_distance
+
+
+def legacy_closest_points(contour):
+    """Previous shortest distance (point i to point i + n / 2 only), kept for comparison"""
+    half = len(contour) // 2
+    return min(math.dist(contour[index], contour[index + half]) for index in range(half))
+
+
+def brute_force_min_width(contour):
+    """Exact minimum caliper width, largest distance of all points to every hull edge (the narrowest is flush)"""
+    equations = ConvexHull(contour).equations  # unit normal and offset of every hull edge, inside is negative
+    return (-(contour @ equations[:, :2].T + equations[:, 2])).max(axis=0).min()
+
+
+def synthetic_contours(num_frames=1000, num_points=500, seed=0):
+    """Interpolated contours (as in the GUI) through random knots, elongated and partly concave"""
+    random = np.random.default_rng(seed)
+    contours = []
+    while len(contours) < num_frames:
+        num_knots = random.integers(5, 20)
+        angles = np.sort(random.uniform(0, 2 * np.pi, num_knots))
+        radii = random.uniform(40, 120, num_knots)
+        x = 256 + radii * np.cos(angles) * random.uniform(0.5, 1.5)
+        y = 256 + radii * np.sin(angles)
+        contour = interpolate_spline([[*x, x[0]], [*y, y[0]]], num_points + 1)
+        if contour[0] is not None:  # knots too close for a spline
+            contours.append(np.column_stack(contour))
+
+    return np.stack(contours)
+
+
+def benchmark_calipers(num_frames=1000, num_points=500, num_legacy_frames=50):
+    """
+    Compares the rotating calipers with the previous all-pairs and opposite-point distances: accuracy against brute
+    force for every frame, latency for a single frame (frame change in the GUI) and for all frames (report)
+    """
+    contours = synthetic_contours(num_frames, num_points)
+    max_width, _, _, min_width, _, _ = caliper_widths(contours)
+    max_error = max(abs(legacy_farthest_points(contour) - width) for contour, width in zip(contours, max_width))
+    min_error = max(abs(brute_force_min_width(contour) - width) for contour, width in zip(contours, min_width))
+    assert max_error < 1e-9 and min_error < 1e-9
+    logger.info(f'Maximum/minimum width of {num_frames} frames exact (errors {max_error:.1e}/{min_error:.1e} px)')
+    difference = np.array([legacy_closest_points(contour) for contour in contours]) - min_width
+    logger.info(
+        f'Previous shortest distance differed from the minimum width by {difference.min():.1f} to '
+        f'{difference.max():.1f} px'
+    )
+
+    start_time = time.perf_counter()
+    for contour in contours[:num_legacy_frames]:
+        legacy_farthest_points(contour)
+        legacy_closest_points(contour)
+    legacy_seconds = (time.perf_counter() - start_time) / num_legacy_frames
+    start_time = time.perf_counter()
+    for frame in range(num_frames):
+        caliper_widths(contours[frame : frame + 1])
+    frame_seconds = (time.perf_counter() - start_time) / num_frames
+    start_time = time.perf_counter()
+    caliper_widths(contours)
+    batch_seconds = time.perf_counter() - start_time
+    logger.info(f'Previous distances: {legacy_seconds * 1000:.1f} ms per frame')
+    logger.info(
+        f'Rotating calipers: {frame_seconds * 1000:.2f} ms for a single frame '
+        f'(speed-up {legacy_seconds / frame_seconds:.0f}x), {batch_seconds:.2f} s for all {num_frames} frames'
+    )
+
+
+if __name__ == '__main__':
+    benchmark_calipers()
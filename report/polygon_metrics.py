@@ -0,0 +1,114 @@
+"""
+Lumen metrics of many contours at once.
+
+Contours are stacked into an array of shape (frames, points, 2), all interpolated contours have the same number of
+points (n_points_contour + 1, the last point closes the contour). Metrics are in pixels, multiply with the resolution
+for mm.
+"""
+
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+
+
+def stack_contours(contours):
+    """(frames, points, 2) array of contours given as (x, y)"""
+    return np.stack([np.column_stack(contour) for contour in contours]).astype(np.float64)
+
+
+def polygon_metrics(contours, center):
+    """
+    Area (shoelace), perimeter, centroid and the vector from center to the centroid of every contour.
+
+    Returns arrays of shape (frames,): area, perimeter, centroid_x, centroid_y, vector_length and vector_angle (degrees
+    in [0, 360), clockwise from the y axis of the image as in the report).
+    """
+    x, y = contours[..., 0], contours[..., 1]
+    x_next, y_next = np.roll(x, -1, axis=1), np.roll(y, -1, axis=1)  # wraps around, closes open contours
+    cross = x * y_next - x_next * y
+    signed_area = cross.sum(axis=1) / 2
+    perimeter = np.hypot(x_next - x, y_next - y).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid_x = ((x + x_next) * cross).sum(axis=1) / (6 * signed_area)
+        centroid_y = ((y + y_next) * cross).sum(axis=1) / (6 * signed_area)
+    degenerate = signed_area == 0  # e.g. all points on a line, mean of the points instead
+    centroid_x[degenerate] = x[degenerate].mean(axis=1)
+    centroid_y[degenerate] = y[degenerate].mean(axis=1)
+
+    vector_x = centroid_x - center[0]
+    vector_y = centroid_y - center[1]
+    vector_angle = np.degrees(np.arctan2(-vector_x, vector_y))  # angle between (0, 1) and the vector
+    vector_angle[vector_angle < 0] += 360
+
+    return np.abs(signed_area), perimeter, centroid_x, centroid_y, np.hypot(vector_x, vector_y), vector_angle
+
+
+def convex_hull(contour):
+    """Vertices of the convex hull of a contour (points, 2), counterclockwise"""
+    try:
+        return contour[ConvexHull(contour).vertices]
+    except QhullError:  # fewer than three distinct points or all points on a line, hull is a segment (or a point)
+        order = np.lexsort((contour[:, 1], contour[:, 0]))
+        return contour[[order[0], order[-1]]]
+
+
+def caliper_widths(contours):
+    """
+    Exact maximum and minimum caliper width (Feret diameter) of every contour by rotating calipers on its convex hull.
+
+    The calipers of all frames are rotated at once: the hull vertex opposite to every hull edge is found by merging
+    the edge angles (increasing around a convex hull) with the same angles turned by 180 degrees in one searchsorted.
+    Returns the maximum widths (frames,) with their two points as x (frames, 2) and y (frames, 2), then the minimum
+    widths with the vertex opposite to the flush hull edge and its projection onto that edge.
+    """
+    hulls = [convex_hull(contour) for contour in contours]
+    sizes = np.array([len(hull) for hull in hulls])
+    starts = np.cumsum(sizes) - sizes
+    vertices = np.concatenate(hulls)
+    index = np.arange(len(vertices))
+    frame = np.repeat(np.arange(len(hulls)), sizes)
+
+    def shift(indices, offset):  # vertices offset further along the same hull, wrapping around
+        return starts[frame] + (indices - starts[frame] + offset) % sizes[frame]
+
+    following = shift(index, 1)
+    edges = vertices[following] - vertices  # edge i runs from vertex i to vertex i + 1
+    lengths = np.hypot(edges[:, 0], edges[:, 1])
+    angles = np.arctan2(edges[:, 1], edges[:, 0])
+    turns = (angles[following] - angles) % (2 * np.pi)
+    turns[turns > 1.5 * np.pi] = 0  # rounding of (almost) collinear edges, turns of a convex hull are 0 to 180 degrees
+    turned = np.cumsum(turns) - turns  # restarted for every hull below
+    angles = angles[starts][frame] + turned - turned[starts][frame] + frame * 8 * np.pi  # increasing over all hulls
+
+    # every hull twice (angles and angles + 360 degrees), so the opposite vertex of the last edges wraps around
+    positions = np.concatenate([starts[frame] + index, starts[frame] + sizes[frame] + index])
+    merged_angles = np.empty(2 * len(vertices))
+    merged_angles[positions] = np.concatenate([angles, angles + 2 * np.pi])
+    merged_vertices = np.empty(2 * len(vertices), dtype=np.intp)
+    merged_vertices[positions] = np.concatenate([index, index])
+    opposite = merged_vertices[np.searchsorted(merged_angles, angles + np.pi)]
+    candidates = np.stack([shift(opposite, offset) for offset in (-1, 0, 1)], axis=1)  # guards rounding of angles
+
+    # minimum width: largest distance of the candidates to the line of every edge, smallest over the edges of a hull
+    offsets = vertices[candidates] - vertices[:, np.newaxis]
+    cross = edges[:, np.newaxis, 0] * offsets[..., 1] - edges[:, np.newaxis, 1] * offsets[..., 0]
+    distances = np.abs(cross) / np.maximum(lengths, 1e-12)[:, np.newaxis]  # 0 for the hull of a single point
+    best = np.argmax(distances, axis=1)
+    widths = distances[index, best]
+    edge = np.lexsort((widths, frame))[starts]  # narrowest edge of every hull
+    far_vertex = vertices[candidates[edge, best[edge]]]
+    along = np.einsum('ij,ij->i', far_vertex - vertices[edge], edges[edge]) / np.maximum(lengths[edge], 1e-12) ** 2
+    foot = vertices[edge] + along[:, np.newaxis] * edges[edge]
+    min_width = widths[edge]
+    min_points = np.stack([far_vertex, foot], axis=1)
+
+    # maximum width: longest of the antipodal pairs, both vertices of every edge with the candidates opposite to it
+    pair_starts = np.repeat(np.stack([index, following], axis=1), 3, axis=1)
+    pair_stops = np.concatenate([candidates, candidates], axis=1)
+    pair_distances = np.hypot(*np.moveaxis(vertices[pair_stops] - vertices[pair_starts], -1, 0))
+    best = np.argmax(pair_distances, axis=1)
+    diameters = pair_distances[index, best]
+    edge = np.lexsort((-diameters, frame))[starts]  # edge with the longest antipodal pair of every hull
+    max_width = diameters[edge]
+    max_points = np.stack([vertices[pair_starts[edge, best[edge]]], vertices[pair_stops[edge, best[edge]]]], axis=1)
+
+    return max_width, max_points[..., 0], max_points[..., 1], min_width, min_points[..., 0], min_points[..., 1]
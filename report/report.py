@@ -1,17 +1,26 @@
 import os
-import math
 import csv
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from loguru import logger
 from PyQt5.QtWidgets import QProgressDialog
 from PyQt5.QtCore import Qt
-from shapely.geometry import Polygon
-from itertools import combinations
 
 from gui.popup_windows.message_boxes import ErrorMessage, SuccessMessage
+from report.polygon_metrics import stack_contours, polygon_metrics, caliper_widths
+
+METRICS_CHUNK_SIZE = 256  # frames computed at once, the report can be cancelled between chunks
+FRAME_METRICS = [
+    'lumen_area',
+    'lumen_circumf',
+    'longest_distance',
+    'shortest_distance',
+    'elliptic_ratio',
+    'vector_length',
+    'vector_angle',
+]
+POINT_METRICS = ['lumen_centroid', 'farthest_point', 'nearest_point']  # stored as (x, y), each a list over frames
 
 
 def report(main_window, lower_limit=None, upper_limit=None, suppress_messages=False):
@@ -77,40 +86,19 @@ def compute_all(main_window, contoured_frames, suppress_messages, plot=True, sav
     lumen_circumf = main_window.data['lumen_circumf']
     centroid_x = main_window.data['lumen_centroid'][0]
     centroid_y = main_window.data['lumen_centroid'][1]
-    try:  # these entries were added later -> might be missing in older data dicts
-        elliptic_ratio = main_window.data['elliptic_ratio']
-        vector_length = main_window.data['vector_length']
-        vector_angle = main_window.data['vector_angle']
-    except KeyError:
-        elliptic_ratio = [0] * main_window.metadata['num_frames']
-        vector_length = [0] * main_window.metadata['num_frames']
-        vector_angle = [0] * main_window.metadata['num_frames']
-    lumen_x = [contour[0] if contour is not None else None for contour in main_window.display.full_contours]
-    lumen_y = [contour[1] if contour is not None else None for contour in main_window.display.full_contours]
-
-    for frame in contoured_frames:
-        if lumen_area[frame] and elliptic_ratio[frame] != 0:  # values already computed for this frame -> skip
-            continue
-
-        polygon = Polygon([(x, y) for x, y in zip(lumen_x[frame], lumen_y[frame])])
-        exterior_coords = polygon.exterior.coords
-
-        lumen_area[frame], lumen_circumf[frame], centroid_x[frame], centroid_y[frame] = compute_polygon_metrics(
-            main_window, polygon, frame
-        )
-        longest_distance[frame], farthest_x[frame], farthest_y[frame] = farthest_points(
-            main_window, exterior_coords, frame
-        )
-        shortest_distance[frame], nearest_x[frame], nearest_y[frame] = closest_points(main_window, polygon, frame)
-        if shortest_distance[frame] != 0:
-            elliptic_ratio[frame] = longest_distance[frame] / shortest_distance[frame]
-        vector_length[frame], vector_angle[frame] = centroid_center_vector(
-            main_window, centroid_x[frame], centroid_y[frame]
-        )
-        if not suppress_messages:
-            progress.setValue(frame)
-            if progress.wasCanceled():
-                return None
+    # these entries were added later -> might be missing in older data dicts
+    elliptic_ratio = main_window.data.setdefault('elliptic_ratio', [0] * main_window.metadata['num_frames'])
+    vector_length = main_window.data.setdefault('vector_length', [0] * main_window.metadata['num_frames'])
+    vector_angle = main_window.data.setdefault('vector_angle', [0] * main_window.metadata['num_frames'])
+    full_contours = main_window.display.complete_contours()  # loading may still be running in the background
+    lumen_x = [contour[0] if contour is not None else None for contour in full_contours]
+    lumen_y = [contour[1] if contour is not None else None for contour in full_contours]
+
+    frames = [frame for frame in main_window.metrics.stale(contoured_frames) if full_contours[frame] is not None]
+    if frames:  # metrics of unchanged contours are kept
+        contours = stack_contours([full_contours[frame] for frame in frames])
+        if not main_window.metrics.update(frames, contours, None if suppress_messages else progress):
+            return None
 
     report_data = pd.DataFrame()
     report_data['frame'] = [
@@ -127,9 +115,6 @@ def compute_all(main_window, contoured_frames, suppress_messages, plot=True, sav
     report_data['vector_angle'] = [vector_angle[frame] for frame in contoured_frames]
     report_data['measurement_1'] = [main_window.data['measure_lengths'][frame][0] for frame in contoured_frames]
     report_data['measurement_2'] = [main_window.data['measure_lengths'][frame][1] for frame in contoured_frames]
-    main_window.data['elliptic_ratio'] = elliptic_ratio
-    main_window.data['vector_length'] = vector_length
-    main_window.data['vector_angle'] = vector_angle
 
     if save_as_csv:  # write centered contours to .csv files
         save_csv_files(main_window, lumen_x, lumen_y, name='diastolic', frames=main_window.gated_frames_dia)
@@ -200,106 +185,116 @@ def compute_all(main_window, contoured_frames, suppress_messages, plot=True, sav
     return report_data
 
 
-def compute_polygon_metrics(main_window, polygon, frame):
-    """Computes lumen area and centroid from contour"""
-    lumen_area = polygon.area * main_window.metadata['resolution'] ** 2
-    lumen_circumf = polygon.length * main_window.metadata['resolution']
-    centroid_x = polygon.centroid.x
-    centroid_y = polygon.centroid.y
-    main_window.data['lumen_area'][frame] = lumen_area
-    main_window.data['lumen_circumf'][frame] = lumen_circumf
-    main_window.data['lumen_centroid'][0][frame] = centroid_x
-    main_window.data['lumen_centroid'][1][frame] = centroid_y
-
-    return lumen_area, lumen_circumf, centroid_x, centroid_y
-
-
-def centroid_center_vector(window, centroid_x, centroid_y):
-    """Returns the length and angle of a vector from the center of the image to the centroid"""
-    center_x = window.images.shape[1] / 2
-    center_y = window.images.shape[2] / 2
-
-    unit_vector = np.array([0, 1])
-    vector = np.array([centroid_x - center_x, centroid_y - center_y])
-
-    vector_length = np.linalg.norm(vector) * window.metadata['resolution']
-
-    vector_dot = np.dot(unit_vector, vector)
-    vector_det = np.linalg.det(np.array([unit_vector, vector]))
-    vector_angle = np.arctan2(vector_det, vector_dot)
-    vector_angle = np.degrees(vector_angle)
-
-    if vector_angle < 0:
-        vector_angle += 360
-
-    return vector_length, vector_angle
+class MetricsCache:
+    """
+    Keeps track of the frames whose metrics in data are up to date, shared by display, small display and report.
 
+    Metrics are keyed on the knot points they were computed from, so any edit of a contour invalidates them without
+    the edit paths having to reset anything (phase or measure edits do not).
+    """
 
-def farthest_points(main_window, exterior_coords, frame):
-    max_distance = 0
-    farthest_points = None
+    def __init__(self, main_window):
+        self.main_window = main_window
+        self.knots = {}  # knots of every frame with up-to-date metrics
 
-    for point1, point2 in combinations(exterior_coords, 2):
-        distance = math.dist(point1, point2)
-        if distance > max_distance:
-            max_distance = distance
-            farthest_points = (point1, point2)
-
-    longest_distance = max_distance * main_window.metadata['resolution']
-
-    # Separate x and y coordinates and append to the respective lists
-    x1, y1 = farthest_points[0]
-    x2, y2 = farthest_points[1]
-    farthest_point_x = [x1, x2]
-    farthest_point_y = [y1, y2]
-
-    main_window.data['longest_distance'][frame] = longest_distance
-    main_window.data['farthest_point'][0][frame] = farthest_point_x
-    main_window.data['farthest_point'][1][frame] = farthest_point_y
-
-    return longest_distance, farthest_point_x, farthest_point_y
-
-
-def closest_points(main_window, polygon, frame):
-    contour = polygon.exterior.coords
-    num_points = len(contour)
-    min_distance = math.inf
-    closest_points = None
-
-    index_1 = 0
-    index_2 = num_points // 2
-
-    while True:
-        distance = math.dist(contour[index_1], contour[index_2])
-        if distance < min_distance:
-            min_distance = distance
-            closest_points = (contour[index_1], contour[index_2])
-
-        index_1 += 1
-        index_2 += 1
-
-        if index_1 >= num_points // 2:
-            break
-
-    shortest_distance = min_distance * main_window.metadata['resolution']
-
-    # Separate x and y coordinates and append to the respective lists
-    try:
-        x1, y1 = closest_points[0]
-        x2, y2 = closest_points[1]
-        closest_point_x = [x1, x2]
-        closest_point_y = [y1, y2]
-    except TypeError:  # closest_points might be None for some very weird shapes
-        logger.warning('No closest points found, probably due to polygon shape')
-        closest_point_x = [0, 0]
-        closest_point_y = [0, 0]
-        shortest_distance = 0
+    def invalidate(self, frames=None):
+        """Forgets the metrics of the given frames (all frames by default, e.g. when data is replaced)"""
+        if frames is None:
+            self.knots = {}
+        else:
+            for frame in frames:
+                self.knots.pop(frame, None)
+
+    def stale(self, frames):
+        """Frames whose contour changed since its metrics were computed (or which were never computed)"""
+        return [frame for frame in frames if self.knots.get(frame) != self.frame_knots(frame)]
+
+    def update(self, frames, contours, progress=None):
+        """Computes and stores the metrics of the frames from their contours (frames, points, 2)"""
+        previous = [self.frame_metrics(frame) for frame in frames]
+        completed = compute_frame_metrics(self.main_window, frames, contours, progress)
+        # metrics are saved with the contours, only frames whose values changed (not e.g. read from the file) are saved
+        changed = [
+            frame for frame, values in zip(frames, previous) if not metrics_equal(values, self.frame_metrics(frame))
+        ]
+        if changed:
+            self.main_window.mark_dirty(changed)
+        if not completed:
+            return False
+        self.knots.update((frame, self.frame_knots(frame)) for frame in frames)
+
+        return True
+
+    def frame_metrics(self, frame):
+        """Metrics of a frame as stored in data, flattened (None if missing)"""
+        data = self.main_window.data
+        try:
+            values = [data[key][frame] for key in FRAME_METRICS]
+            values += [data[key][axis][frame] for key in POINT_METRICS for axis in (0, 1)]
+            return np.hstack([np.ravel(value) for value in values]).astype(np.float64)
+        except (KeyError, IndexError, TypeError, ValueError):  # e.g. entries missing in older data
+            return None
+
+    def frame_knots(self, frame):
+        lumen = self.main_window.data['lumen']
+        return tuple(lumen[0][frame]), tuple(lumen[1][frame])  # copies, knots are edited in place
+
+
+def metrics_equal(values_1, values_2):
+    """Whether two flattened metrics agree, up to the float32 precision of the npz contour store"""
+    if values_1 is None or values_2 is None or values_1.shape != values_2.shape:
+        return False
+    return np.allclose(values_1, values_2, rtol=1e-5, atol=1e-6, equal_nan=True)
+
+
+def compute_frame_metrics(main_window, frames, contours, progress=None):
+    """
+    Computes all metrics of the given frames from their contours (frames, points, 2) and stores them in data.
+
+    Metrics are computed for a chunk of frames at once, longest and shortest distance are the maximum and minimum
+    caliper width of the contour. Returns False if the progress dialog was cancelled (checked between chunks).
+    """
+    data = main_window.data
+    for key in ['elliptic_ratio', 'vector_length', 'vector_angle']:  # added later -> might be missing in older data
+        data.setdefault(key, [0] * main_window.metadata['num_frames'])
+    resolution = main_window.metadata['resolution']
+    center = (main_window.images.shape[1] / 2, main_window.images.shape[2] / 2)
+    chunks = range(0, len(frames), METRICS_CHUNK_SIZE)
+    if progress is not None:
+        progress.setMaximum(len(chunks))
+
+    for chunk, start in enumerate(chunks):
+        chunk_frames = frames[start : start + METRICS_CHUNK_SIZE]
+        chunk_contours = contours[start : start + METRICS_CHUNK_SIZE]
+        area, perimeter, centroid_x, centroid_y, vector_length, vector_angle = [
+            metric.tolist() for metric in polygon_metrics(chunk_contours, center)
+        ]
+        longest_distance, farthest_x, farthest_y, shortest_distance, nearest_x, nearest_y = [
+            metric.tolist() for metric in caliper_widths(chunk_contours)
+        ]
+
+        for index, frame in enumerate(chunk_frames):
+            data['lumen_area'][frame] = area[index] * resolution**2
+            data['lumen_circumf'][frame] = perimeter[index] * resolution
+            data['lumen_centroid'][0][frame] = centroid_x[index]
+            data['lumen_centroid'][1][frame] = centroid_y[index]
+            data['vector_length'][frame] = vector_length[index] * resolution
+            data['vector_angle'][frame] = vector_angle[index]
+            data['longest_distance'][frame] = longest_distance[index] * resolution
+            data['farthest_point'][0][frame] = farthest_x[index]
+            data['farthest_point'][1][frame] = farthest_y[index]
+            data['shortest_distance'][frame] = shortest_distance[index] * resolution
+            data['nearest_point'][0][frame] = nearest_x[index]
+            data['nearest_point'][1][frame] = nearest_y[index]
+            if data['shortest_distance'][frame] != 0:
+                data['elliptic_ratio'][frame] = data['longest_distance'][frame] / data['shortest_distance'][frame]
+        if progress is not None:
+            progress.setValue(chunk + 1)
+            if progress.wasCanceled():
+                return False
 
-    main_window.data['shortest_distance'][frame] = shortest_distance
-    main_window.data['nearest_point'][0][frame] = closest_point_x
-    main_window.data['nearest_point'][1][frame] = closest_point_y
+    return True
 
-    return shortest_distance, closest_point_x, closest_point_y
 
 def save_csv_files(main_window, lumen_x, lumen_y, name, frames):
     csv_out_dir = os.path.join(main_window.file_name + '_csv_files')
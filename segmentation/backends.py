@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+
+BACKEND_EXTENSIONS = {'keras': '.h5', 'onnx': '.onnx', 'tflite': '.tflite'}
+
+
+def converted_model_file(model_file, backend, quantise=False):
+    """Returns the path of the model exported for the given backend (next to the Keras .h5 file)"""
+    if backend == 'keras':
+        return model_file
+    suffix = '_int8' if quantise else ''
+    return os.path.splitext(model_file)[0] + suffix + BACKEND_EXTENSIONS[backend]
+
+
+def create_backend(backend, model_file):
+    """Creates the inference backend, runtimes are only imported when needed"""
+    if backend == 'keras':
+        return KerasBackend(model_file)
+    if backend == 'onnx':
+        return OnnxBackend(model_file)
+    if backend == 'tflite':
+        return TFLiteBackend(model_file)
+    raise ValueError(f'Unknown segmentation backend {backend}, choose from {list(BACKEND_EXTENSIONS)}')
+
+
+class KerasBackend:
+    """Runs the original Keras model with TensorFlow"""
+
+    def __init__(self, model_file):
+        import tensorflow as tf
+
+        custom_objects = {'BinaryCrossentropy': tf.keras.losses.BinaryCrossentropy}
+        self.model = tf.keras.models.load_model(model_file, custom_objects=custom_objects, compile=False)
+        self.input_shape = self.model.input_shape
+
+    def __call__(self, images, batch_size=None):
+        """Returns the lumen probability map of shape (frames, rows, cols)"""
+        if batch_size is None:
+            # calling model() instead of model.predict() leads to smaller memory leak
+            prediction = self.model(images, training=False)
+        else:
+            prediction = self.model.predict(images, batch_size=batch_size, verbose=0)
+
+        return np.asarray(prediction[0])[..., 0]  # first output is the fused U2-Net output
+
+
+class OnnxBackend:
+    """Runs the exported model with ONNX Runtime on the CPU"""
+
+    def __init__(self, model_file):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_shape = tuple(dim if isinstance(dim, int) else None for dim in model_input.shape)
+
+    def __call__(self, images, batch_size=None):
+        if len(self.input_shape) == 4:  # explicit channel dimension
+            images = images[..., np.newaxis]
+        prediction = self.session.run(None, {self.input_name: images})
+
+        return prediction[0][..., 0]
+
+
+class TFLiteBackend:
+    """Runs the exported (optionally int8 quantised) model with the TFLite interpreter"""
+
+    def __init__(self, model_file):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:  # fall back to the interpreter shipped with TensorFlow
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=model_file, num_threads=os.cpu_count())
+        self.input = self.interpreter.get_input_details()[0]
+        # output order is not guaranteed by the converter, tensor names keep the order of the Keras outputs
+        self.output = sorted(self.interpreter.get_output_details(), key=lambda details: details['name'])[0]
+        self.input_shape = tuple(dim if dim > 0 else None for dim in self.input['shape_signature'])
+        self.allocated_shape = None
+
+    def __call__(self, images, batch_size=None):
+        if len(self.input_shape) == 4:
+            images = images[..., np.newaxis]
+        if self.allocated_shape != images.shape:
+            self.interpreter.resize_tensor_input(self.input['index'], images.shape)
+            self.interpreter.allocate_tensors()
+            self.allocated_shape = images.shape
+        scale, zero_point = self.input['quantization']
+        if scale:  # quantised input tensor
+            images = np.round(images / scale + zero_point).astype(self.input['dtype'])
+        self.interpreter.set_tensor(self.input['index'], images)
+        self.interpreter.invoke()
+        prediction = self.interpreter.get_tensor(self.output['index'])
+        scale, zero_point = self.output['quantization']
+        if scale:
+            prediction = (prediction.astype(np.float32) - zero_point) * scale
+
+        return prediction[..., 0]
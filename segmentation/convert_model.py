@@ -0,0 +1,150 @@
+import os
+import glob
+import time
+import hydra
+
+import numpy as np
+from omegaconf import DictConfig
+from loguru import logger
+
+from input_output.image_source import DicomFrameSource, open_dicom
+from segmentation.backends import converted_model_file, create_backend
+from segmentation.predict import normalisation
+from segmentation.segment_files import read_pullback
+
+
+@hydra.main(version_base=None, config_path='..', config_name='config')
+def convert_model(config: DictConfig) -> None:
+    """Exports the Keras model to ONNX and TFLite (optionally int8 quantised) and checks parity with Keras"""
+    import tensorflow as tf
+
+    model_file = config.segmentation.model_file
+    quantise = config.segmentation.quantise
+    custom_objects = {'BinaryCrossentropy': tf.keras.losses.BinaryCrossentropy}
+    model = tf.keras.models.load_model(model_file, custom_objects=custom_objects, compile=False)
+    calibration_frames = sample_frames(config.segmentation.input_dir, config.segmentation.calibration_frames)
+    image_shape = calibration_frames.shape[1:3]
+
+    converted_files = {
+        'onnx': export_onnx(model, image_shape, model_file, calibration_frames if quantise else None),
+        'tflite': export_tflite(model, model_file, calibration_frames if quantise else None),
+    }
+    parity_check(model_file, converted_files, calibration_frames, config.segmentation.batch_size)
+
+
+def sample_frames(input_dir, num_frames):
+    """Samples normalised frames evenly from local pullbacks for int8 calibration and the parity check"""
+    files = glob.glob(input_dir + '/NARCO_*/Run*/*', recursive=True)
+    files = [file for file in files if '_' not in os.path.basename(file)]  # exclude subdirs (all have _ in name)
+    frames = []
+    for file in files:
+        try:  # compressed frames are only decoded when sampled
+            _, image = open_dicom(file, cache_size=0, read_ahead=0)
+        except (AttributeError, IsADirectoryError):  # NIfTi (memory-mapped if uncompressed) or not a pullback
+            image = read_pullback(file)
+        if image is None:
+            continue
+        indices = np.linspace(0, image.shape[0] - 1, max(1, num_frames // len(files)), dtype=int)
+        frames.append(normalisation(image[indices]))
+        if isinstance(image, DicomFrameSource):
+            image.close()
+        if sum(len(chunk) for chunk in frames) >= num_frames:
+            break
+    if not frames:
+        raise FileNotFoundError(f'No pullbacks found in {input_dir} to calibrate the model')
+
+    return np.concatenate(frames)[:num_frames]
+
+
+def export_onnx(model, image_shape, model_file, calibration_frames=None):
+    """Exports the model to ONNX, int8 quantisation is calibrated on the given frames"""
+    import tensorflow as tf
+    import tf2onnx
+
+    input_shape = (None, *image_shape, *model.input_shape[3:])  # keep channel dimension if the model has one
+    input_signature = [tf.TensorSpec(input_shape, tf.float32, name='image')]
+    float_file = converted_model_file(model_file, 'onnx')
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=17, output_path=float_file)
+    logger.info(f'Exported ONNX model to {float_file}')
+    if calibration_frames is None:
+        return float_file
+
+    from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self):
+            self.frames = iter(calibration_frames)
+
+        def get_next(self):
+            frame = next(self.frames, None)
+            return None if frame is None else {'image': model_input(frame, len(input_shape))}
+
+    out_file = converted_model_file(model_file, 'onnx', quantise=True)
+    quantize_static(float_file, out_file, FrameReader(), weight_type=QuantType.QInt8, activation_type=QuantType.QInt8)
+    logger.info(f'Exported int8 quantised ONNX model to {out_file}')
+
+    return out_file
+
+
+def export_tflite(model, model_file, calibration_frames=None):
+    """Exports the model to TFLite, int8 quantisation is calibrated on the given frames"""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if calibration_frames is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: (
+            [model_input(frame, len(model.input_shape))] for frame in calibration_frames
+        )
+    out_file = converted_model_file(model_file, 'tflite', quantise=calibration_frames is not None)
+    with open(out_file, 'wb') as tflite_file:
+        tflite_file.write(converter.convert())
+    logger.info(f'Exported TFLite model to {out_file}')
+
+    return out_file
+
+
+def model_input(frame, input_rank):
+    """Batch of one frame with channel dimension if the model expects one"""
+    frame = frame[np.newaxis]
+    return frame[..., np.newaxis] if input_rank == 4 else frame
+
+
+def parity_check(model_file, converted_files, frames, batch_size):
+    """Reports Dice difference to the Keras masks and frames/s for every backend"""
+    reference, frames_per_second = run_backend('keras', model_file, frames, batch_size)
+    logger.info(f'keras: {frames_per_second:.1f} frames/s')
+    for backend, converted_file in converted_files.items():
+        try:
+            prediction, frames_per_second = run_backend(backend, converted_file, frames, batch_size)
+        except ImportError as error:
+            logger.warning(f'Skipping parity check for {backend}: {error}')
+            continue
+        dice_scores = [dice(reference[i] > 0.5, prediction[i] > 0.5) for i in range(len(frames))]
+        logger.info(
+            f'{backend}: {frames_per_second:.1f} frames/s, mean Dice to keras {np.mean(dice_scores):.4f} '
+            f'(min {np.min(dice_scores):.4f})'
+        )
+
+
+def run_backend(backend, model_file, frames, batch_size):
+    model = create_backend(backend, model_file)
+    model(frames[:batch_size])  # warm-up
+    prediction = np.zeros(frames.shape, dtype=np.float32)
+    start_time = time.perf_counter()
+    for start in range(0, len(frames), batch_size):
+        prediction[start : start + batch_size] = model(frames[start : start + batch_size])
+
+    return prediction, len(frames) / (time.perf_counter() - start_time)
+
+
+def dice(mask_1, mask_2):
+    """Dice coefficient of two binary masks"""
+    total = np.count_nonzero(mask_1) + np.count_nonzero(mask_2)
+    if total == 0:
+        return 1.0
+    return 2 * np.count_nonzero(np.logical_and(mask_1, mask_2)) / total
+
+
+if __name__ == '__main__':
+    convert_model()
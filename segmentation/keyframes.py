@@ -0,0 +1,140 @@
+import time
+
+import numpy as np
+from loguru import logger
+
+from segmentation.segment import mask_to_contours, resample_contours
+
+
+def keyframe_segmentation(predictor, images, lower_limit, upper_limit, config):
+    """
+    Segments every k-th frame and interpolates the knot points of the frames in between.
+
+    Frames in between are segmented for real if they are not similar enough to the nearest keyframe or if lumen
+    area or centroid jump between the two keyframes. Keyframes are inferred batch by batch, (start, stop, contours)
+    is yielded for every keyframe interval as soon as both of its keyframes are done. The achieved speed-up is logged,
+    the time of the whole run (without the consumer of the intervals) against inferring every frame at the measured
+    time per inferred frame.
+    """
+    interval = config.segmentation.keyframe_interval
+    if lower_limit >= upper_limit:
+        return
+    keyframes = list(range(lower_limit, upper_limit, interval))
+    if keyframes[-1] != upper_limit - 1:
+        keyframes.append(upper_limit - 1)
+
+    start_time = time.perf_counter()
+    busy = 0  # time spent in this generator
+    timing = {'inference': 0}  # time spent inferring masks and extracting contours
+    key_contours = {}
+    num_inferred = len(keyframes)
+    next_interval = 0  # index of the first keyframe of the next interval to yield
+    for start in range(0, len(keyframes), predictor.batch_size):
+        frames = keyframes[start : start + predictor.batch_size]
+        contours = infer_contours(predictor, images[frames], config, timing)
+        key_contours.update({frame: (contours[0][i], contours[1][i]) for i, frame in enumerate(frames)})
+        while next_interval + 1 < len(keyframes) and keyframes[next_interval + 1] in key_contours:
+            first, last = keyframes[next_interval], keyframes[next_interval + 1]
+            lumen, num_interval_inferred = segment_interval(
+                predictor, images, first, last, key_contours, config, timing
+            )
+            num_inferred += num_interval_inferred
+            next_interval += 1
+            busy += time.perf_counter() - start_time
+            yield first, last, lumen
+            start_time = time.perf_counter()
+    busy += time.perf_counter() - start_time
+    yield keyframes[-1], upper_limit, ([key_contours[keyframes[-1]][0]], [key_contours[keyframes[-1]][1]])
+
+    num_frames = upper_limit - lower_limit
+    full_inference = timing['inference'] / num_inferred * num_frames  # estimate for segmenting every frame
+    logger.info(
+        f'Keyframe segmentation took {busy:.2f} s for {num_frames} frames, speed-up {full_inference / busy:.1f}x '
+        f'(estimated {full_inference:.2f} s to infer every frame), inferred fraction {num_inferred / num_frames:.0%}'
+    )
+
+
+def segment_interval(predictor, images, first, last, key_contours, config, timing):
+    """Contours of frames first to last - 1 and the number of frames in between that were inferred"""
+    lumen = ([key_contours[first][0]], [key_contours[first][1]])
+    between = range(first + 1, last)
+    if between and contours_disagree(key_contours[first], key_contours[last], config):
+        to_infer = list(between)
+    else:
+        to_infer = [
+            frame
+            for frame in between
+            if frame_similarity(images[frame], images[first if frame - first <= last - frame else last])
+            < config.segmentation.keyframe_similarity
+        ]
+    inferred = {}
+    if to_infer:
+        contours = infer_contours(predictor, images[to_infer], config, timing)
+        inferred = {frame: (contours[0][i], contours[1][i]) for i, frame in enumerate(to_infer)}
+
+    for frame in between:
+        if frame in inferred:
+            x, y = inferred[frame]
+        else:
+            weight = (frame - first) / (last - first)
+            x, y = interpolate_contours(
+                key_contours[first], key_contours[last], weight, config.display.n_interactive_points
+            )
+        lumen[0].append(x)
+        lumen[1].append(y)
+
+    return lumen, len(to_infer)
+
+
+def infer_contours(predictor, images, config, timing):
+    """Masks and contours of the frames, the time taken is added to timing['inference']"""
+    start_time = time.perf_counter()
+    masks = predictor(images, 0, len(images))
+    contours = mask_to_contours(None, masks, 0, len(images), config=config)
+    timing['inference'] += time.perf_counter() - start_time
+
+    return contours
+
+
+def contours_disagree(contour_1, contour_2, config):
+    """Keyframe contours disagree if either is missing or lumen area or centroid jump between them"""
+    if not contour_1[0] or not contour_2[0]:
+        return True
+    area_1, centroid_1 = area_centroid(*contour_1)
+    area_2, centroid_2 = area_centroid(*contour_2)
+    area_change = abs(area_1 - area_2) / max(area_1, area_2, 1)
+    centroid_shift = np.linalg.norm(centroid_1 - centroid_2)
+
+    return (
+        area_change > config.segmentation.keyframe_area_change
+        or centroid_shift > config.segmentation.keyframe_centroid_shift
+    )
+
+
+def area_centroid(x, y):
+    """Area (shoelace formula) and vertex centroid of a polygon"""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    area = 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+    return area, np.array([x.mean(), y.mean()])
+
+
+def frame_similarity(frame_1, frame_2, step=4):
+    """Cheap image similarity: correlation coefficient of subsampled frames"""
+    frame_1 = frame_1[::step, ::step].astype(np.float32).ravel()
+    frame_2 = frame_2[::step, ::step].astype(np.float32).ravel()
+    if frame_1.std() == 0 or frame_2.std() == 0:
+        return 0.0
+    return float(np.corrcoef(frame_1, frame_2)[0, 1])
+
+
+def interpolate_contours(contour_1, contour_2, weight, num_points):
+    """Linear interpolation between two knot point contours after resampling both to num_points by arc length"""
+    points_1, points_2 = resample_contours(
+        [np.column_stack(contour_1).astype(float), np.column_stack(contour_2).astype(float)], num_points
+    )[:, :-1]
+    # align start points so corresponding knots are interpolated
+    shift = np.argmin([np.sum((points_1 - np.roll(points_2, -i, axis=0)) ** 2) for i in range(num_points)])
+    points = (1 - weight) * points_1 + weight * np.roll(points_2, -shift, axis=0)
+    points = np.vstack([points, points[:1]])  # close contour, last knot is ignored by the periodic spline
+
+    return points[:, 0].tolist(), points[:, 1].tolist()
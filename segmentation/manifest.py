@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import socket
+import threading
+import uuid
+from datetime import datetime
+
+from loguru import logger
+
+DONE = 'done'
+FAILED = 'failed'
+INVALID = 'invalid'  # not a DICOM or NIfTi pullback
+
+
+class Manifest:
+    """
+    Append-only JSONL record of batch segmentation runs, one line per processed file.
+
+    Files are claimed with lock files (created atomically by hard-linking, which also works on shared filesystems), so
+    several processes or machines can work through the same input directory. Locks of files being processed are
+    touched regularly, locks not touched for lock_timeout are considered stale (e.g. left behind by a crashed worker)
+    and are taken over by renaming them away first, so only one worker can take over a lock.
+    """
+
+    def __init__(self, manifest_file, input_dir, lock_timeout_min=120):
+        self.manifest_file = manifest_file
+        self.input_dir = input_dir
+        self.lock_dir = f'{manifest_file}.locks'
+        self.lock_timeout = lock_timeout_min * 60  # in seconds
+        self.write_lock = threading.Lock()  # records are written from the pipeline threads
+        self.claimed = {}  # lock content (unique token) of every file claimed by this process
+        self.records = {}  # latest record of every file, lines appended by other workers are read incrementally
+        self.records_offset = 0  # position in the manifest up to which lines were read
+        self.heartbeat = None  # thread touching the locks of claimed files
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def name(self, file):
+        """Path relative to the input directory, identical for all machines working on the same share"""
+        return os.path.relpath(file, self.input_dir)
+
+    def latest_records(self):
+        """Latest record of every file in the manifest, only lines appended since the last call are read"""
+        try:
+            with open(self.manifest_file, 'rb') as in_file:
+                in_file.seek(self.records_offset)
+                for line in in_file:
+                    if not line.endswith(b'\n'):  # still being written, read again next time
+                        break
+                    self.records_offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # partially written line of a crashed worker
+                        continue
+                    self.records[record['file']] = record
+        except FileNotFoundError:
+            pass
+
+        return self.records
+
+    def pending(self, files, model_hash, version):
+        """Files without a successful run for this model and version (invalid files are not retried)"""
+        records = self.latest_records()
+        pending = [file for file in files if not completed(records.get(self.name(file)), model_hash, version)]
+        logger.info(f'Skipping {len(files) - len(pending)} files already processed according to {self.manifest_file}')
+
+        return pending
+
+    def claim_pending(self, files, model_hash, version):
+        """Lazily claims files, skipping files locked by or finished by other workers in the meantime"""
+        for file in files:
+            if not self.claim(file):
+                continue
+            if completed(self.latest_records().get(self.name(file)), model_hash, version):  # reads new lines only
+                self.release(file)
+                continue
+            yield file
+
+    def record(self, file, status, model_hash, version, seconds=None, num_frames=None, error=None):
+        record = {
+            'file': self.name(file),
+            'status': status,
+            'model_hash': model_hash,
+            'version': version,
+            'seconds': None if seconds is None else round(seconds, 2),
+            'frames': num_frames,
+            'error': error,
+            'host': socket.gethostname(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+        }
+        with self.write_lock:
+            with open(self.manifest_file, 'a') as out_file:  # single write per line, appends do not interleave
+                out_file.write(json.dumps(record) + '\n')
+                out_file.flush()
+                os.fsync(out_file.fileno())
+        self.release(file)
+
+    def lock_file(self, file):
+        name_hash = hashlib.blake2b(self.name(file).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.lock_dir, f'{name_hash}.lock')
+
+    def claim(self, file):
+        """Returns True if the file was claimed by this process, False if another worker holds the lock"""
+        lock_file = self.lock_file(file)
+        token = f'{self.name(file)} {socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}\n'
+        for _ in range(2):  # second attempt after taking over a stale lock
+            if create_lock(lock_file, token):
+                break
+            if not self.take_over(file, lock_file):
+                return False
+        else:
+            return False
+        self.claimed[file] = token
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.touch_locks, name='lock_heartbeat', daemon=True)
+            self.heartbeat.start()
+
+        return True
+
+    def take_over(self, file, lock_file):
+        """Removes the lock if it is stale, returns False if another worker holds it"""
+        try:
+            with open(lock_file) as in_file:  # token and age of the same lock
+                stale_token = in_file.read()
+                age = time.time() - os.fstat(in_file.fileno()).st_mtime
+        except FileNotFoundError:  # released in the meantime
+            return True
+        if age < self.lock_timeout:
+            return False
+        # only one worker can rename the lock, but it may be the fresh lock of a worker which took over just before
+        moved_file = f'{lock_file}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.stale'
+        try:
+            os.rename(lock_file, moved_file)
+        except FileNotFoundError:
+            return True
+        with open(moved_file) as in_file:
+            moved_token = in_file.read()
+        if moved_token != stale_token:
+            try:
+                os.link(moved_file, lock_file)  # put the fresh lock back unless the file was claimed again
+            except FileExistsError:
+                pass
+            os.remove(moved_file)
+            return False
+        os.remove(moved_file)
+        logger.warning(f'Took over stale lock of {file} ({age / 60:.0f} min old)')
+
+        return True
+
+    def touch_locks(self):
+        """Refreshes the locks of the claimed files, so files taking longer than lock_timeout are not taken over"""
+        while True:
+            time.sleep(self.lock_timeout / 4)
+            for file in list(self.claimed.copy()):
+                try:
+                    os.utime(self.lock_file(file))
+                except FileNotFoundError:  # released in the meantime
+                    pass
+
+    def release(self, file):
+        if self.claimed.pop(file, None) is not None:
+            try:
+                os.remove(self.lock_file(file))
+            except FileNotFoundError:
+                pass
+
+    def release_all(self):
+        """Releases the locks of files claimed but not recorded, e.g. after an interrupted run"""
+        for file in list(self.claimed.copy()):
+            self.release(file)
+
+
+def create_lock(lock_file, token):
+    """Creates the lock with its token, False if it exists (hard-linking is atomic, also on shared filesystems)"""
+    tmp_file = f'{lock_file}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_file, 'w') as out_file:
+        out_file.write(token)
+    try:
+        os.link(tmp_file, lock_file)  # unlike O_EXCL, the lock is never seen without its token
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_file)
+
+    return True
+
+
+def completed(record, model_hash, version):
+    if record is None:
+        return False
+    if record['status'] == INVALID:
+        return True
+    return record['status'] == DONE and record['model_hash'] == model_hash and record['version'] == version
+
+
+def in_shard(file, shard):
+    """Stable partition of files into shards, shard is given as 'i/n' (zero-based i)"""
+    if shard is None:
+        return True
+    index, num_shards = (int(part) for part in str(shard).split('/'))
+    if not 0 <= index < num_shards:
+        raise ValueError(f'Invalid shard {shard}, expected i/n with 0 <= i < n')
+
+    return zlib.crc32(file.encode()) % num_shards == index
@@ -0,0 +1,98 @@
+import os
+import hashlib
+
+import numpy as np
+from loguru import logger
+
+
+class MaskCache:
+    """
+    Content-addressed on-disk cache of segmentation masks.
+
+    Masks are keyed by model hash, pixel hash of the frame and preprocessing version, so re-opening a study,
+    re-running after a crash or widening the frame range only segments new or changed frames.
+    The least recently used masks are evicted once the cache exceeds its size limit.
+    """
+
+    def __init__(self, cache_dir, max_size_mb, model_hash, preprocessing_version, size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 2**20  # in bytes
+        self.prefix = f'{model_hash}_{preprocessing_version}'.encode()
+        self.size = size  # total size on disk, determined on first write if unknown, then kept up to date
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, frame):
+        """Cache key of a single frame"""
+        frame = np.ascontiguousarray(frame)
+        frame_hash = hashlib.blake2b(self.prefix, digest_size=16)
+        frame_hash.update(f'{frame.dtype}{frame.shape}'.encode())
+        frame_hash.update(frame.data)
+        return frame_hash.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.npz')
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """Returns the cached mask or None, marks the mask as recently used"""
+        path = self.path(key)
+        try:
+            with np.load(path) as cached:
+                mask = cached['mask']
+            os.utime(path)  # modification time is used for LRU eviction
+        except (OSError, KeyError, ValueError):  # missing (e.g. evicted by another process) or corrupted
+            return None
+
+        return mask
+
+    def put(self, key, mask):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as out_file:
+            np.savez_compressed(out_file, mask=mask)
+        os.replace(tmp_path, path)  # atomic, readers never see partially written masks
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        """Yields (path, size, last use) of all cached masks"""
+        for sub_dir in os.scandir(self.cache_dir):
+            if sub_dir.is_dir():
+                for entry in os.scandir(sub_dir.path):
+                    if entry.name.endswith('.npz'):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """Removes least recently used masks until the cache is at 90% of its size limit"""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for path, size, _ in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # already evicted by another process
+                pass
+            self.size -= size
+            num_evicted += 1
+        logger.info(f'Evicted {num_evicted} masks from mask cache {self.cache_dir}')
+
+
+def file_hash(file_name):
+    """SHA-256 of the file content"""
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(2**20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
@@ -1,68 +1,171 @@
+import os
+import tempfile
+import threading
+
 import numpy as np
-import tensorflow as tf
 from loguru import logger
-from PyQt5.QtWidgets import QProgressDialog
-from PyQt5.QtCore import Qt
+
+from segmentation.backends import create_backend, converted_model_file
+from segmentation.mask_cache import MaskCache, file_hash
+
+PREPROCESSING_VERSION = 1  # increase when normalisation or mask encoding changes (invalidates cached masks)
+
+_models = {}  # models loaded in this process, keyed on backend, model file path, mtime and size
+_models_lock = threading.Lock()
+_model_hashes = {}
+
+
+def model_key(model_file):
+    """Returns a key identifying the current version of the model file"""
+    stat = os.stat(model_file)
+    return os.path.abspath(model_file), stat.st_mtime_ns, stat.st_size
+
+
+def model_hash(model_file):
+    """Content hash of the model file, only recomputed when the file changes"""
+    key = model_key(model_file)
+    if key not in _model_hashes:
+        _model_hashes[key] = file_hash(model_file)
+
+    return _model_hashes[key]
+
+
+def load_model(model_file, image_shape=None, batch_size=1, backend='keras'):
+    """Loads the model once per process and warms it up with a dummy batch at the real input shape"""
+    key = (backend, *model_key(model_file))
+    with _models_lock:
+        if key not in _models:
+            logger.info(f'Loading model {model_file} ({backend} backend)')
+            model = create_backend(backend, model_file)
+            if image_shape is None:
+                image_shape = tuple(dim or 512 for dim in model.input_shape[1:3])
+            model(np.zeros((batch_size, *image_shape), dtype=np.float32))  # warm-up
+            for old_key in [old_key for old_key in _models if old_key[:2] == key[:2]]:  # model file has changed
+                del _models[old_key]
+            _models[key] = model
+            logger.info('Model loaded and warmed up')
+
+    return _models[key]
 
 
 class Predict:
     def __init__(self, main_window, config=None) -> None:
         self.main_window = main_window
         config = main_window.config if config is None else config
-        self.model_file = config.segmentation.model_file
+        self.backend = config.segmentation.backend
+        self.model_file = converted_model_file(
+            config.segmentation.model_file, self.backend, config.segmentation.quantise
+        )
         self.batch_size = config.segmentation.batch_size
         self.conserve_memory = config.segmentation.conserve_memory
+        self.memory_budget = config.segmentation.memory_budget_mb * 2**20  # in bytes
+        self.binary_mask = config.segmentation.binary_mask
+        self.cache_dir = config.segmentation.cache_dir
+        self.cache_size_mb = config.segmentation.cache_size_mb
+        self.cache = None  # created on first use and kept, a new one would scan the cache directory again
+        self.preload_thread = None
 
     def __call__(self, images, lower_limit, upper_limit) -> None:
-        self.images = images
-        self.lower_limit = lower_limit
-        self.upper_limit = upper_limit
-        self.normalisation()
-        mask = self.inference()
+        """Returns uint8 masks for frames lower_limit to upper_limit (first mask belongs to lower_limit)"""
+        mask = self.allocate_mask((upper_limit - lower_limit, *images.shape[1:3]))
+        for start, stop, batch_mask in self.batches(images, lower_limit, upper_limit):
+            mask[start - lower_limit : stop - lower_limit] = batch_mask
 
         return mask
 
-    def normalisation(self):
-        """Min-max normalisation of the images"""
-        self.images = (self.images - self.images.max(axis=(1, 2), keepdims=True)) / (
-            self.images.max(axis=(1, 2), keepdims=True) - self.images.min(axis=(1, 2), keepdims=True)
+    def preload(self, image_shape=None):
+        """Loads and warms up the model in a background thread, e.g. while the pullback is still being read"""
+        if self.preload_thread is not None and self.preload_thread.is_alive():
+            return
+        self.preload_thread = threading.Thread(
+            target=self.load_model, args=(image_shape,), name='model_preload', daemon=True
         )
+        self.preload_thread.start()
 
-    def inference(self):
-        custom_objects = {'BinaryCrossentropy': tf.keras.losses.BinaryCrossentropy}
-        model = tf.keras.models.load_model(self.model_file, custom_objects=custom_objects, compile=False)
-        mask = np.zeros_like(self.images)
+    def load_model(self, image_shape=None):
+        try:
+            return load_model(self.model_file, image_shape, self.batch_size, self.backend)
+        except (OSError, ValueError, ImportError) as error:
+            logger.error(f'Could not load model {self.model_file}: {error}')
+            return None
 
+    def batches(self, images, lower_limit, upper_limit):
+        """Streams (start, stop, masks) for consecutive chunks, cached masks are used without running the model"""
+        mask_cache = self.mask_cache()
+        if mask_cache is None:
+            yield from self.infer(images, lower_limit, upper_limit)
+            return
+
+        model = None
+        chunk_size = self.chunk_size(images.shape[1:3])
+        num_cached = 0
+        for start in range(lower_limit, upper_limit, chunk_size):
+            stop = min(start + chunk_size, upper_limit)
+            chunk = images[start:stop]  # read (or decoded) once, for the keys and for inference
+            keys = [mask_cache.key(frame) for frame in chunk]
+            masks = [mask_cache.get(key) for key in keys]  # None if not cached (or evicted in the meantime)
+            missing = [index for index, mask in enumerate(masks) if mask is None]
+            if missing:
+                if model is None:
+                    model = load_model(self.model_file, images.shape[1:3], self.batch_size, self.backend)
+                for index, mask in zip(missing, self.predict(model, chunk[missing])):
+                    mask_cache.put(keys[index], mask)
+                    masks[index] = mask
+            num_cached += len(masks) - len(missing)
+            yield start, stop, np.stack(masks)
+        logger.info(f'Took {num_cached} of {upper_limit - lower_limit} masks from mask cache')
+
+    def infer(self, images, lower_limit, upper_limit):
+        """Runs the model chunk by chunk, normalising each chunk just before inference"""
+        model = load_model(self.model_file, images.shape[1:3], self.batch_size, self.backend)
+        chunk_size = self.chunk_size(images.shape[1:3])
+
+        for start in range(lower_limit, upper_limit, chunk_size):
+            stop = min(start + chunk_size, upper_limit)
+            yield start, stop, self.predict(model, images[start:stop])
+
+    def predict(self, model, chunk):
+        prediction = model(normalisation(chunk), batch_size=None if self.conserve_memory else self.batch_size)
+        return self.to_mask(prediction)
+
+    def mask_cache(self):
+        if self.cache_dir is None:
+            return None
+        mask_type = 'binary' if self.binary_mask else 'probability'
+        current_model_hash, version = model_hash(self.model_file), f'{PREPROCESSING_VERSION}_{mask_type}'
+        if self.cache is None or self.cache.prefix != f'{current_model_hash}_{version}'.encode():
+            size = None if self.cache is None else self.cache.size  # model file changed, same cache directory
+            self.cache = MaskCache(self.cache_dir, self.cache_size_mb, current_model_hash, version, size)
+
+        return self.cache
+
+    def chunk_size(self, image_shape):
+        """Number of frames normalised at once, bounded by the memory budget (float32 input and output)"""
+        frames_in_budget = max(1, int(self.memory_budget // (np.prod(image_shape) * 4 * 2)))
         if self.conserve_memory:
-            if self.main_window is not None:
-                progress = QProgressDialog(self.main_window)
-                progress.setWindowFlags(Qt.Dialog)
-                progress.setModal(True)
-                progress.setMinimum(self.lower_limit)
-                progress.setMaximum(self.upper_limit)
-                progress.setMinimumDuration(1000)
-                progress.resize(500, 100)
-                progress.setWindowTitle('Automatic segmentation')
-                progress.setLabelText(f'Please wait, segmenting frames {self.lower_limit + 1} to {self.upper_limit + 1}...')
-                progress.show()
-            else:
-                progress = None
-
-            for frame in range(self.lower_limit, self.upper_limit, self.batch_size):
-                if progress is not None:
-                    progress.setValue(frame)
-                # calling model() instead of model.predict() leads to smaller memory leak
-                pred = model(self.images[frame : frame + self.batch_size, :, :], training=False)
-                mask[frame : frame + self.batch_size, :, :] = np.array(pred)[0, :, :, :, 0]
-                if progress is not None and progress.wasCanceled():
-                    progress.close()
-                    return None
-            if progress is not None:
-                progress.close()
-        else:
-            prediction = model.predict(
-                self.images[self.lower_limit : self.upper_limit, :, :], batch_size=self.batch_size, verbose=1
-            )
-            mask[self.lower_limit : self.upper_limit, :, :] = np.array(prediction)[0, :, :, :, 0]
+            return min(self.batch_size, frames_in_budget)
+        return frames_in_budget
 
-        return mask
+    def allocate_mask(self, shape):
+        """Output masks are kept in RAM if they fit the memory budget, otherwise in a temporary memory map"""
+        if np.prod(shape) <= self.memory_budget:
+            return np.zeros(shape, dtype=np.uint8)
+        logger.info('Masks exceed memory budget, writing them to a temporary memory map')
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=shape)
+
+    def to_mask(self, prediction):
+        """Converts model output to compact uint8 masks (binary or probability scaled to 0-255)"""
+        if self.binary_mask:
+            return (prediction > 0.5).astype(np.uint8)
+        return np.round(np.clip(prediction, 0, 1) * 255).astype(np.uint8)
+
+
+def normalisation(images):
+    """Min-max normalisation of a chunk of frames in float32"""
+    images = images.astype(np.float32)
+    frame_max = images.max(axis=(1, 2), keepdims=True)
+    frame_range = np.maximum(frame_max - images.min(axis=(1, 2), keepdims=True), np.finfo(np.float32).eps)
+    images -= frame_max
+    images /= frame_range
+
+    return images
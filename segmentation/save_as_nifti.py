@@ -1,20 +1,26 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import SimpleITK as sitk
 from loguru import logger
-from PyQt5.QtWidgets import QProgressDialog, QApplication
-from PyQt5.QtCore import Qt
-from skimage.draw import polygon2mask
+from PyQt5.QtWidgets import QProgressDialog
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, pyqtSlot
 
 from gui.popup_windows.message_boxes import ErrorMessage
 
+COMPRESSION_LEVELS = {'none': None, 'fast': 1, 'max': 9}  # gzip level, uncompressed files are written as .nii
+
 
 def save_as_nifti(main_window, mode=None):
+    """Exports the chosen frames and their masks as NIfTi files in a background thread"""
     main_window.status_bar.showMessage('Saving frames as NIfTi files...')
     if not main_window.image_displayed:
         ErrorMessage(main_window, 'Cannot save as NIfTi before reading input file')
         return
+    if main_window.nifti_export_job is not None:
+        ErrorMessage(main_window, 'NIfTi export is already running')
+        return
 
     out_path = os.path.join(main_window.config.save.nifti_dir, f'{mode}_frames')
     if mode == 'contoured':
@@ -28,65 +34,202 @@ def save_as_nifti(main_window, mode=None):
             if main_window.data['lumen'][0][frame] and main_window.data['phases'][frame] in ['D', 'S']
         ]
     elif mode == 'all':
-        frames_to_save = range(main_window.metadata['num_frames'])
+        frames_to_save = list(range(main_window.metadata['num_frames']))
     else:
         return  # nothing to save
 
     if frames_to_save:
-        main_window.status_bar.showMessage('Saving frames as NIfTi files...')
-        file_name = os.path.splitext(os.path.basename(main_window.file_name))[0]  # remove file extension
-        os.makedirs(out_path, exist_ok=True)
-        mask = contours_to_mask(main_window.images[frames_to_save], frames_to_save, main_window.display.full_contours)
-
-        progress = QProgressDialog()
-        progress.setWindowFlags(Qt.Dialog)
-        progress.setModal(True)
-        progress.setMinimum(0)
-        progress_max = len(frames_to_save) * main_window.config.save.save_2d + main_window.config.save.save_3d
-        progress.setMaximum(progress_max)
-        progress.resize(500, 100)
-        progress.setWindowTitle('Saving frames as NIfTi files...')
-        progress.show()
-
-        if main_window.config.save.save_2d:
-            for i, frame in enumerate(frames_to_save):  # save individual frames as NIfTi
-                progress.setValue(i)
-                QApplication.processEvents()
-                if progress.wasCanceled():
-                    break
-                if main_window.data['lumen'][0][frame]:  # only save mask if contour exists
-                    sitk.WriteImage(
-                        sitk.GetImageFromArray(mask[i, :, :]),
-                        os.path.join(out_path, f'{file_name}_frame_{frame}_seg.nii.gz'),
-                    )
-                sitk.WriteImage(
-                    sitk.GetImageFromArray(main_window.images[frame, :, :]),
-                    os.path.join(out_path, f'{file_name}_frame_{frame}_img.nii.gz'),
-                )
-        if main_window.config.save.save_3d:
-            if any(main_window.data['lumen'][0]):  # only save mask if any contour exists
-                sitk.WriteImage(sitk.GetImageFromArray(mask), os.path.join(out_path, f'{file_name}_seg.nii.gz'))
-            sitk.WriteImage(
-                sitk.GetImageFromArray(main_window.images[frames_to_save]),
-                os.path.join(out_path, f'{file_name}_img.nii.gz'),
-            )
-            progress.setValue(len(frames_to_save) * main_window.config.save.save_2d + 1)
-            QApplication.processEvents()
-
-        progress.close()
+        main_window.nifti_export_job = BackgroundNiftiExport(main_window, frames_to_save, out_path)
+    else:
         main_window.status_bar.showMessage(main_window.waiting_status)
 
 
-def contours_to_mask(images, contoured_frames, contours):
-    """Convert IVUS contours to numpy mask"""
-    image_shape = images.shape[1:3]
-    mask = np.zeros_like(images)
-    for i, frame in enumerate(contoured_frames):
+class NiftiExportWorker(QObject):
+    """Rasterises the masks and writes all NIfTi files with a pool of writer threads"""
+
+    file_written = pyqtSignal(int)  # number of files written so far
+    finished = pyqtSignal(bool)  # True if all files were written
+    failed = pyqtSignal(str)
+
+    def __init__(self, images, frames_to_save, contours, contoured, out_path, file_name, config):
+        super().__init__()
+        self.images = images
+        self.frames_to_save = frames_to_save
+        self.contours = contours  # snapshot taken in the main thread, edits during the export do not interfere
+        self.contoured = contoured
+        self.out_path = out_path
+        self.file_name = file_name
+        self.save_2d = config.save.save_2d
+        self.save_3d = config.save.save_3d
+        self.compression_level = COMPRESSION_LEVELS[config.save.nifti_compression]
+        self.extension = '.nii' if self.compression_level is None else '.nii.gz'
+        self.num_writers = config.save.nifti_writers or os.cpu_count()
+        self.cancelled = False
+
+    def run(self):
+        completed = False
         try:
-            lumen_polygon = [[x, y] for x, y in zip(contours[frame][1], contours[frame][0])]
-            mask[i, :, :] += polygon2mask(image_shape, lumen_polygon).astype(np.uint8)
-        except (TypeError, ValueError):  # frame has no lumen contours
-            pass
-    mask = np.clip(mask, a_min=0, a_max=1)  # enforce correct value range
+            os.makedirs(self.out_path, exist_ok=True)
+            mask = contours_to_mask(self.images.shape[1:3], self.frames_to_save, self.contours)
+            with ThreadPoolExecutor(self.num_writers) as pool:
+                writes = [
+                    pool.submit(write_nifti, array, file_name, self.compression_level)
+                    for array, file_name in self.files(mask)
+                ]
+                for num_written, write in enumerate(as_completed(writes), start=1):
+                    write.result()
+                    self.file_written.emit(num_written)
+                    if self.cancelled:
+                        for write in writes:
+                            write.cancel()  # files already being written are finished
+                        break
+                else:
+                    completed = True
+        except (OSError, RuntimeError) as error:  # SimpleITK raises RuntimeError for failed writes
+            logger.exception(error)
+            self.failed.emit(str(error))
+        self.finished.emit(completed)
+
+    def files(self, mask):
+        """(array, file name) of every file to write, arrays are views where possible instead of copies"""
+        files = []
+        if self.save_3d:  # largest files first, so they do not finish last on a single writer
+            first, last = self.frames_to_save[0], self.frames_to_save[-1]
+            if last - first + 1 == len(self.frames_to_save):  # contiguous frames
+                volume = self.images[first : last + 1]
+            else:
+                volume = self.images[self.frames_to_save]
+            if any(self.contoured):  # only save mask if any contour exists
+                files.append((mask, self.out_file('seg')))
+            files.append((volume, self.out_file('img')))
+        if self.save_2d:  # save individual frames as NIfTi
+            for i, frame in enumerate(self.frames_to_save):
+                if self.contoured[i]:  # only save mask if contour exists
+                    files.append((mask[i], self.out_file(f'frame_{frame}_seg')))
+                files.append((self.images[frame], self.out_file(f'frame_{frame}_img')))
+
+        return files
+
+    def out_file(self, suffix):
+        return os.path.join(self.out_path, f'{self.file_name}_{suffix}{self.extension}')
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BackgroundNiftiExport(QObject):
+    """Owns the export thread and reports its progress without blocking the GUI"""
+
+    def __init__(self, main_window, frames_to_save, out_path):
+        super().__init__(main_window)
+        self.main_window = main_window
+        config = main_window.config
+        file_name = os.path.splitext(os.path.basename(main_window.file_name))[0]  # remove file extension
+        lumen_x = main_window.data['lumen'][0]
+        contoured = [bool(lumen_x[frame]) for frame in frames_to_save]
+        num_files = config.save.save_3d * (1 + any(contoured)) + config.save.save_2d * (
+            len(frames_to_save) + sum(contoured)
+        )
+
+        self.progress = QProgressDialog(main_window)
+        self.progress.setWindowFlags(Qt.Dialog)
+        self.progress.setWindowModality(Qt.NonModal)
+        self.progress.setMinimum(0)
+        self.progress.setMaximum(num_files)
+        self.progress.resize(500, 100)
+        self.progress.setWindowTitle('Saving frames as NIfTi files...')
+        self.progress.setLabelText(f'Writing {num_files} NIfTi files to {out_path}...')
+        self.progress.show()
+
+        self.thread = QThread()
+        self.worker = NiftiExportWorker(
+            main_window.images,
+            frames_to_save,
+            list(main_window.display.complete_contours()),
+            contoured,
+            out_path,
+            file_name,
+            config,
+        )
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.file_written.connect(self.progress.setValue)
+        self.worker.failed.connect(self.failed)
+        self.worker.finished.connect(self.finished)
+        self.worker.finished.connect(self.thread.quit, Qt.DirectConnection)  # finished slot waits for the thread
+        self.progress.canceled.connect(self.worker.cancel, Qt.DirectConnection)
+        self.thread.start()
+
+    @pyqtSlot(str)
+    def failed(self, message):
+        ErrorMessage(self.main_window, f'Saving NIfTi files failed: {message}')
+
+    @pyqtSlot(bool)
+    def finished(self, completed):
+        self.progress.close()
+        self.thread.wait()
+        self.main_window.nifti_export_job = None
+        logger.info(f'NIfTi export {"finished" if completed else "stopped"}')
+        self.main_window.status_bar.showMessage(self.main_window.waiting_status)
+
+
+def write_nifti(array, file_name, compression_level=None):
+    """Writes the array as NIfTi file, uncompressed if compression_level is None (SimpleITK releases the GIL)"""
+    image = sitk.GetImageFromArray(array)
+    if compression_level is None:
+        sitk.WriteImage(image, file_name, useCompression=False)
+    else:
+        sitk.WriteImage(image, file_name, useCompression=True, compressionLevel=compression_level)
+
+
+def contours_to_mask(image_shape, contoured_frames, contours, out=None, num_workers=None):
+    """
+    Convert IVUS contours to numpy mask (one uint8 frame per contoured frame).
+
+    Frames are filled with a vectorised scanline fill, split across threads. Pass out (e.g. a memory-mapped array) to
+    write the mask straight into it.
+    """
+    mask = np.zeros((len(contoured_frames), *image_shape), dtype=np.uint8) if out is None else out
+    num_workers = num_workers or os.cpu_count()
+
+    def fill(indices):
+        for i in indices:
+            if out is not None:
+                mask[i] = 0
+            contour = contours[contoured_frames[i]]
+            if contour is None or contour[0] is None or len(contour[0]) < 3:  # frame has no lumen contours
+                continue
+            fill_polygon(mask[i], np.asarray(contour[0], dtype=float), np.asarray(contour[1], dtype=float))
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        list(pool.map(fill, np.array_split(np.arange(len(contoured_frames)), num_workers * 4)))
 
     return mask
+
+
+def fill_polygon(mask, x, y):
+    """Sets all pixels whose centre lies inside the polygon to 1 (even-odd rule, like skimage.draw.polygon2mask)"""
+    rows, cols = mask.shape
+    x_next, y_next = np.roll(x, -1), np.roll(y, -1)
+    # every edge crosses the pixel rows in [min(y), max(y)), so shared vertices are only counted once
+    first_row = np.clip(np.ceil(np.minimum(y, y_next)), 0, rows).astype(int)
+    last_row = np.clip(np.ceil(np.maximum(y, y_next)), 0, rows).astype(int)
+    num_crossings = np.maximum(last_row - first_row, 0)  # horizontal edges never cross
+    if not num_crossings.any():
+        return
+    edge = np.repeat(np.arange(len(x)), num_crossings)
+    row = first_row[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(num_crossings) - num_crossings, num_crossings)
+    crossing = x[edge] + (row - y[edge]) / (y_next[edge] - y[edge]) * (x_next[edge] - x[edge])
+
+    order = np.lexsort((crossing, row))  # consecutive crossings in a row enclose the inside of the polygon
+    row, crossing = row[order], crossing[order]
+    span_row = row[0::2]
+    span_start = np.clip(np.ceil(crossing[0::2]), 0, cols).astype(int)
+    span_stop = np.clip(np.ceil(crossing[1::2]), 0, cols).astype(int)
+
+    top, bottom = span_row.min(), span_row.max() + 1
+    span_row -= top
+    starts = np.bincount(span_row * (cols + 1) + span_start, minlength=(bottom - top) * (cols + 1))
+    stops = np.bincount(span_row * (cols + 1) + span_stop, minlength=(bottom - top) * (cols + 1))
+    inside = np.cumsum((starts - stops).reshape(bottom - top, cols + 1)[:, :cols], axis=1) > 0
+    mask[top:bottom] |= inside.view(np.uint8)
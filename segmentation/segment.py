@@ -1,106 +1,325 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import matplotlib.path as mplPath
 from loguru import logger
+from scipy import ndimage
 from skimage import measure
+from PyQt5.QtWidgets import QProgressDialog
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, pyqtSlot
 
 from gui.popup_windows.message_boxes import ErrorMessage, SuccessMessage
 from gui.popup_windows.frame_range_dialog import FrameRangeDialog
 
+_contour_pool = None
+
 
 def segment(main_window):
-    """Automatic segmentation of IVUS images"""
-    main_window.status_bar.showMessage('Segmenting frames...')
+    """Automatic segmentation of IVUS images, runs in a worker thread while the GUI stays responsive"""
     if not main_window.image_displayed:
         ErrorMessage(main_window, 'Cannot perform automatic segmentation before reading input file')
-        main_window.status_bar.showMessage(main_window.waiting_status)
+        return
+    if main_window.segmentation_job is not None:
+        ErrorMessage(main_window, 'Automatic segmentation is already running')
         return
 
     segment_dialog = FrameRangeDialog(main_window)
 
     if segment_dialog.exec_():
         lower_limit, upper_limit = segment_dialog.getInputs()
-        masks = main_window.predictor(main_window.images, lower_limit, upper_limit)
-        if masks is not None:
-            main_window.data['lumen'] = mask_to_contours(main_window, masks, lower_limit, upper_limit)
-            main_window.data['lumen_area'] = [0] * main_window.metadata[
-                'num_frames'
-            ]  # ensure all metrics are recalculated for the report
-            main_window.contours_drawn = True
-            main_window.display.set_data(main_window.data['lumen'], main_window.images)
-            main_window.hide_contours_box.setChecked(False)
+        main_window.status_bar.showMessage(f'Segmenting frames {lower_limit + 1} to {upper_limit}...')
+        main_window.contours_drawn = True
+        main_window.hide_contours_box.setChecked(False)
+        main_window.segmentation_job = BackgroundSegmentation(main_window, lower_limit, upper_limit)
+
+
+class SegmentationWorker(QObject):
+    """Segments frames batch by batch, emitting the contours of every finished batch"""
+
+    batch_done = pyqtSignal(int, int, object)  # first frame, last frame + 1, (x, y) contours
+    finished = pyqtSignal(bool)  # True if all frames were segmented
+    failed = pyqtSignal(str)
+
+    def __init__(self, predictor, images, lower_limit, upper_limit, config):
+        super().__init__()
+        self.predictor = predictor
+        self.images = images
+        self.lower_limit = lower_limit
+        self.upper_limit = upper_limit
+        self.config = config
+        self.cancelled = False
+
+    def run(self):
+        completed = False
+        try:
+            batches = contour_batches(self.predictor, self.images, self.lower_limit, self.upper_limit, self.config)
+            for start, stop, contours in batches:
+                self.batch_done.emit(start, stop, contours)
+                if self.cancelled:
+                    break
+            else:
+                completed = True
+        except Exception as error:  # any inference error is reported in the GUI instead of ending the thread silently
+            logger.exception(error)
+            self.failed.emit(str(error))
+        self.finished.emit(completed)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BackgroundSegmentation(QObject):
+    """Owns the segmentation thread and displays contours in the main thread as each batch finishes"""
+
+    def __init__(self, main_window, lower_limit, upper_limit):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.lower_limit = lower_limit
+        self.upper_limit = upper_limit
+        self.num_segmented = 0
+
+        self.progress = QProgressDialog(main_window)
+        self.progress.setWindowFlags(Qt.Dialog)
+        self.progress.setWindowModality(Qt.NonModal)  # user can keep navigating and editing
+        self.progress.setMinimum(lower_limit)
+        self.progress.setMaximum(upper_limit)
+        self.progress.resize(500, 100)
+        self.progress.setWindowTitle('Automatic segmentation')
+        self.progress.setLabelText(f'Segmenting frames {lower_limit + 1} to {upper_limit}...')
+        self.progress.setCancelButtonText('Stop (keep segmented frames)')
+        self.progress.show()
+
+        self.thread = QThread()
+        self.worker = SegmentationWorker(
+            main_window.predictor, main_window.images, lower_limit, upper_limit, main_window.config
+        )
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.batch_done.connect(self.batch_done)
+        self.worker.failed.connect(self.failed)
+        self.worker.finished.connect(self.finished)
+        self.worker.finished.connect(self.thread.quit, Qt.DirectConnection)  # finished slot waits for the thread
+        self.progress.canceled.connect(self.worker.cancel, Qt.DirectConnection)
+        self.thread.start()
+
+    @pyqtSlot(int, int, object)
+    def batch_done(self, start, stop, contours):
+        if self.main_window.segmentation_job is not self:  # queued after the job was stopped
+            return
+        for frame in range(start, stop):
+            self.main_window.data['lumen'][0][frame] = contours[0][frame - start]
+            self.main_window.data['lumen'][1][frame] = contours[1][frame - start]
+        self.main_window.mark_dirty(range(start, stop))
+        self.main_window.display.update_contours(range(start, stop))
+        self.num_segmented += stop - start
+        if not self.worker.cancelled:
+            self.progress.setValue(stop)
+
+    @pyqtSlot(str)
+    def failed(self, message):
+        ErrorMessage(self.main_window, f'Automatic segmentation failed: {message}')
+
+    @pyqtSlot(bool)
+    def finished(self, completed):
+        self.progress.close()
+        self.thread.wait()
+        if self.main_window.segmentation_job is self:
+            self.main_window.segmentation_job = None
+        logger.info(f'Segmented {self.num_segmented} of {self.upper_limit - self.lower_limit} frames')
+        if completed:
+            SuccessMessage(self.main_window, 'Automatic segmentation')
+        self.main_window.status_bar.showMessage(self.main_window.waiting_status)
+
+
+def contour_batches(predictor, images, lower_limit, upper_limit, config):
+    """Yields (start, stop, contours) for consecutive batches, using keyframe segmentation if configured"""
+    if config.segmentation.keyframe_interval > 1:
+        from segmentation.keyframes import keyframe_segmentation  # keyframes module builds on mask_to_contours
+
+        yield from keyframe_segmentation(predictor, images, lower_limit, upper_limit, config)
+        return
 
-    SuccessMessage(main_window, 'Automatic segmentation')
-    main_window.status_bar.showMessage(main_window.waiting_status)
+    # contours of a batch are extracted in the process pool while the model runs on the next batch
+    num_workers = config.segmentation.n_workers or os.cpu_count()
+    pool = contour_pool(num_workers)
+    pending = deque()  # bounded, at most 2 * num_workers batches of masks are held in memory
+    for start, stop, masks in predictor.batches(images, lower_limit, upper_limit):
+        pending.append((start, stop, pool.submit(mask_to_contours, None, masks, start, stop, config)))
+        while pending and (len(pending) > 2 * num_workers or pending[0][2].done()):
+            start, stop, contours = pending.popleft()
+            yield start, stop, contours.result()
+    for start, stop, contours in pending:
+        yield start, stop, contours.result()
+
+
+def contour_pool(num_workers=None):
+    """Process pool for contour extraction, created on first use and shared by all segmentation runs"""
+    global _contour_pool
+    if _contour_pool is None:
+        # spawn instead of fork, forking a process with a loaded model (and its threads) is unsafe
+        _contour_pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    return _contour_pool
 
 
 def mask_to_contours(main_window, masks, lower_limit, upper_limit, config=None):
-    """Extracts contours from masked images. Returns x and y coordinates"""
-    if main_window is None:
+    """Extracts contours from masked images (first mask belongs to lower_limit). Returns x and y coordinates"""
+    if main_window is None:  # only return contours for frames lower_limit to upper_limit
         lumen = (
-                [[] for _ in range(upper_limit - lower_limit)],
-                [[] for _ in range(upper_limit - lower_limit)],
-            )
+            [[] for _ in range(upper_limit - lower_limit)],
+            [[] for _ in range(upper_limit - lower_limit)],
+        )
+        offset = lower_limit
     else:
         lumen = main_window.data['lumen']
         config = main_window.config
+        offset = 0
     num_points = config.display.n_interactive_points
-    image_shape = masks.shape[1:3]
-    counter = 0
+    masks = masks[: upper_limit - lower_limit]
+
+    contours = lumen_contours(masks)
+    found = [index for index, contour in enumerate(contours) if contour is not None and len(contour) > 2]
     for frame in range(lower_limit, upper_limit):
-        if np.sum(masks[frame, :, :]) > 0:
-            counter += 1
-            contours_frame = label_contours(masks[frame, :, :])
-            keep_lumen_x, keep_lumen_y = downsample(keep_largest_contour(contours_frame, image_shape), num_points)
-            lumen[0][frame] = keep_lumen_x
-            lumen[1][frame] = keep_lumen_y
-        else:
-            lumen[0][frame] = []
-            lumen[1][frame] = []
-    logger.info(f'Found contours in {counter} frames')
+        lumen[0][frame - offset] = []
+        lumen[1][frame - offset] = []
+    if found:
+        knots = resample_contours([contours[index] for index in found], num_points, config.display.knot_spacing)
+        for index, frame_knots in zip(found, knots):
+            lumen[0][lower_limit + index - offset] = frame_knots[:, 1].tolist()  # x is the column
+            lumen[1][lower_limit + index - offset] = frame_knots[:, 0].tolist()
+    logger.debug(f'Found contours in {len(found)} frames')
     return lumen
 
 
-def label_contours(image):
-    """generate contours for labels"""
-    contours = measure.find_contours(image)
-    lumen = []
-    for contour in contours:
-        lumen.append(np.array((contour[:, 0], contour[:, 1])))
+def lumen_contours(masks):
+    """
+    Boundary (row, col) of the lumen in every frame, None if there is no lumen or it does not contain the image centre.
 
-    return lumen
+    All frames are thresholded and labelled in one pass (with 2D connectivity, so components do not connect across
+    frames). Only the longest boundary of the component containing the image centre is traced, at the same iso-level
+    as before (midpoint between minimum and maximum of each mask).
+    """
+    num_frames, rows, cols = masks.shape
+    centre = (rows // 2, cols // 2)
+    minimum = masks.min(axis=(1, 2)).astype(float)
+    maximum = masks.max(axis=(1, 2)).astype(float)
+    level = (minimum + maximum) / 2
+    foreground = masks > level[:, np.newaxis, np.newaxis]
 
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)  # 4-connectivity like find_contours for high values
+    labels, _ = ndimage.label(foreground, structure=structure)
+    centre_labels = labels[:, centre[0], centre[1]]
 
-def keep_largest_contour(contours, image_shape):
-    max_length = 0
-    keep_contour = [[], []]
-    for contour in contours:
-        if keep_valid_contour(contour, image_shape):
-            if len(contour[0]) > max_length:
-                keep_contour = [[list(contour[1, :])], [list(contour[0, :])]]  # to match format expected by downsample
-                max_length = len(contour[0])
+    contours = [None] * num_frames
+    for frame in range(num_frames):
+        if centre_labels[frame]:
+            frame_labels, label = labels[frame], centre_labels[frame]
+        elif enclosed(foreground[frame], centre):  # centre lies in a hole of the lumen
+            frame_labels, _ = ndimage.label(ndimage.binary_fill_holes(foreground[frame]), structure=structure[1])
+            label = frame_labels[centre]
+            if not label:
+                continue
+        else:
+            continue
 
-    return keep_contour
+        region = frame_labels == label
+        rows_in_region = np.flatnonzero(region.any(axis=1))
+        cols_in_region = np.flatnonzero(region.any(axis=0))
+        # bounding box with a background border for tracing
+        row_slice = slice(max(rows_in_region[0] - 1, 0), rows_in_region[-1] + 2)
+        col_slice = slice(max(cols_in_region[0] - 1, 0), cols_in_region[-1] + 2)
+        crop = masks[frame, row_slice, col_slice].astype(float)
+        other = foreground[frame, row_slice, col_slice] & ~region[row_slice, col_slice]
+        crop[other] = minimum[frame]  # do not trace other components within the bounding box
+        traced = measure.find_contours(crop, level[frame])
+        if traced:
+            contours[frame] = max(traced, key=len) + (row_slice.start, col_slice.start)
 
+    return contours
 
-def keep_valid_contour(contour, image_shape):
-    """Contour is valid if it contains the centroid of the image"""
-    bbPath = mplPath.Path(np.transpose(contour))
-    centroid = [image_shape[0] // 2, image_shape[1] // 2]
-    return bbPath.contains_point(centroid)
 
+def enclosed(foreground, centre):
+    """Cheap necessary condition for the centre lying in a hole: foreground on all four sides"""
+    row, col = centre
+    return (
+        foreground[row, :col].any()
+        and foreground[row, col:].any()
+        and foreground[:row, col].any()
+        and foreground[row:, col].any()
+    )
 
-def downsample(contours, num_points):
-    """Downsamples input contour data by selecting n points from original contour"""
+
+def downsample(contours, num_points, spacing='arc_length'):
+    """Downsamples input contour data to num_points knots (plus closing point) placed along the original contour"""
     num_frames = len(contours[0])
     downsampled = [[] for _ in range(num_frames)], [[] for _ in range(num_frames)]
-
-    for frame in range(num_frames):
-        if len(contours[0][frame]) > num_points * 1.2:
-            points_to_sample = range(0, len(contours[0][frame]), len(contours[0][frame]) // num_points)
-            for axis in range(2):
-                downsampled[axis][frame] = [contours[axis][frame][point] for point in points_to_sample]
+    frames = [frame for frame in range(num_frames) if len(contours[0][frame]) > 2]
+    if frames:
+        knots = resample_contours(
+            [np.column_stack([contours[0][frame], contours[1][frame]]) for frame in frames], num_points, spacing
+        )
+        for frame, frame_knots in zip(frames, knots):
+            downsampled[0][frame] = frame_knots[:, 0].tolist()
+            downsampled[1][frame] = frame_knots[:, 1].tolist()
 
     if num_frames == 1:
         downsampled = [downsampled[0][0], downsampled[1][0]]  # remove unnecessary dimension
 
     return downsampled
+
+
+def resample_contours(contours, num_points, spacing='arc_length'):
+    """
+    Places exactly num_points knots along closed contours, evenly by arc length or denser where the contour bends.
+
+    Contours are an array (points, 2), a stack (frames, points, 2) or a list of arrays with different point counts
+    (padded to a stack, repeated points add no length), all frames are resampled in one vectorised pass.
+    Returns (num_points + 1, 2) per contour, the last knot repeats the first since the periodic spline ignores it.
+    """
+    if isinstance(contours, np.ndarray) and contours.ndim == 2:
+        return resample_contours(contours[np.newaxis], num_points, spacing)[0]
+    if not isinstance(contours, np.ndarray):
+        max_points = max(len(contour) for contour in contours)
+        padding = [np.repeat(contour[-1:], max_points - len(contour), axis=0) for contour in contours]
+        contours = np.stack([np.concatenate([contour, pad]) for contour, pad in zip(contours, padding)])
+    points = contours.astype(float)
+    closed = np.concatenate([points, points[:, :1]], axis=1)
+    segments = np.diff(closed, axis=1)
+    lengths = np.linalg.norm(segments, axis=2)  # (frames, points)
+
+    if spacing == 'curvature':  # weight segments by the turning angle at their end points
+        direction = np.arctan2(segments[..., 1], segments[..., 0])
+        turning = np.abs(np.angle(np.exp(1j * (direction - np.roll(direction, 1, axis=1)))))
+        turning[lengths == 0] = 0  # padding and duplicated points do not bend the contour
+        turning = (turning + np.roll(turning, -1, axis=1)) / 2
+        mean_turning = np.sum(turning * lengths, axis=1, keepdims=True) / np.maximum(
+            np.sum(lengths, axis=1, keepdims=True), 1e-12
+        )
+        weights = lengths * (1 + turning / np.maximum(mean_turning, 1e-12))
+    elif spacing == 'arc_length':
+        weights = lengths
+    else:
+        raise ValueError(f'Unknown knot spacing {spacing}, choose from arc_length or curvature')
+
+    cumulative = np.concatenate([np.zeros((len(points), 1)), np.cumsum(weights, axis=1)], axis=1)
+    total = np.maximum(cumulative[:, -1:], 1e-12)
+    cumulative /= total  # in [0, 1] for every contour
+    targets = np.broadcast_to(np.arange(num_points) / num_points, (len(points), num_points))
+
+    # searchsorted on all contours at once, each row is shifted into its own interval
+    rows = np.arange(len(points))[:, np.newaxis] * 2
+    index = np.searchsorted((cumulative + rows).ravel(), (targets + rows).ravel(), side='right')
+    index = index.reshape(targets.shape) - np.arange(len(points))[:, np.newaxis] * cumulative.shape[1]
+    index = np.clip(index, 1, cumulative.shape[1] - 1)
+
+    start = np.take_along_axis(cumulative, index - 1, axis=1)
+    stop = np.take_along_axis(cumulative, index, axis=1)
+    fraction = np.where(stop > start, (targets - start) / np.maximum(stop - start, 1e-12), 0)[..., np.newaxis]
+    start_points = np.take_along_axis(closed, (index - 1)[..., np.newaxis], axis=1)
+    stop_points = np.take_along_axis(closed, index[..., np.newaxis], axis=1)
+    knots = start_points + fraction * (stop_points - start_points)
+
+    return np.concatenate([knots, knots[:, :1]], axis=1)
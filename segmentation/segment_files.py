@@ -2,6 +2,10 @@ import os
 import glob
 import hydra
 import json
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import pydicom as dcm
 import SimpleITK as sitk
@@ -10,65 +14,233 @@ from omegaconf import DictConfig
 from loguru import logger
 from tqdm import tqdm
 
-from version import version_file_str
-from segmentation.predict import Predict
-from segmentation.segment import mask_to_contours
+from version import __version__, version_file_str
+from input_output.catalogue import Catalogue, catalogue_file
+from input_output.contour_store import write_store
+from input_output.image_source import decode_volume, dicom_memmap, nifti_memmap, read_dicom_header
+from segmentation.manifest import DONE, FAILED, INVALID, Manifest, in_shard
+from segmentation.predict import Predict, model_hash
+from segmentation.segment import contour_batches, mask_to_contours
 
 
 @hydra.main(version_base=None, config_path='..', config_name='config')
 def segment_files(config: DictConfig) -> None:
+    """
+    Segments all pullbacks in input_dir as a pipeline: the next pullbacks are read while the current one is in the
+    model, contour extraction and JSON writing run in a process pool. Every outcome is recorded in a manifest, files
+    finished in earlier runs are skipped and files are claimed with lock files, so several workers can share the
+    input directory (optionally partitioned with segmentation.shard=i/n).
+    """
     input_dir = config.segmentation.input_dir
+    shard = config.segmentation.shard
     files = glob.glob(input_dir + '/NARCO_*/Run*/*', recursive=True)
     files = [file for file in files if '_' not in os.path.basename(file)]  # exclude subdirs (all have _ in name)
-    logger.info(f'Found {len(files)} files to segment')
+    if config.catalogue.use_in_segment_files:
+        files = catalogued_pullbacks(files, config)
+    manifest_file = config.segmentation.manifest_file or os.path.join(input_dir, 'segment_files_manifest.jsonl')
+    manifest = Manifest(manifest_file, input_dir, config.segmentation.lock_timeout_min)
+    files = [file for file in files if in_shard(manifest.name(file), shard)]
+    logger.info(f'Found {len(files)} files to segment' + (f' in shard {shard}' if shard else ''))
     predictor = Predict(main_window=None, config=config)
+    predictor.preload()  # model is loaded once per process while the first file is read
+    try:
+        run = {'model_hash': model_hash(predictor.model_file), 'version': __version__}
+    except OSError as error:
+        logger.error(f'Could not read model {predictor.model_file}: {error}')
+        return
+    files = manifest.pending(files, **run)
 
-    for file in tqdm(files, desc='Segmenting files', unit='files', leave=False):
-        try:
-            image = dcm.read_file(os.path.join(input_dir, file), force=True).pixel_array
-            if image.ndim == 4:  # 3 channel input
-                image = image[:, :, :, 0]
-        except (AttributeError, IsADirectoryError):
-            try:  # NIfTi
-                input_image = sitk.ReadImage(os.path.join(input_dir, file))
-                image = sitk.GetArrayFromImage(input_image)
-            except:
+    progress_bars = {
+        'read': tqdm(total=len(files), desc='Reading', unit='files', position=0),
+        'segment': tqdm(desc='Segmenting', unit='frames', position=1),
+        'contour': tqdm(desc='Contours', unit='frames', position=2),
+        'write': tqdm(total=len(files), desc='Writing', unit='files', position=3),
+    }
+    try:
+        run_pipeline(files, manifest, run, predictor, config, progress_bars)
+    finally:
+        manifest.release_all()  # files claimed but not recorded (e.g. interrupted run) can be taken by other workers
+        for progress_bar in progress_bars.values():
+            progress_bar.close()
+
+
+def catalogued_pullbacks(files, config):
+    """Updates the catalogue (only new or changed headers are read) and keeps the DICOM and NIfTi pullbacks"""
+    catalogue = Catalogue(catalogue_file(config))
+    try:
+        catalogue.scan(config.segmentation.input_dir, config.catalogue.n_workers)
+        pullbacks = {pullback['path'] for pullback in catalogue.pullbacks(config.segmentation.input_dir)}
+    finally:
+        catalogue.close()
+    skipped = [file for file in files if os.path.abspath(file) not in pullbacks]
+    if skipped:
+        logger.info(f'Skipping {len(skipped)} files that are not DICOM or NIfTi pullbacks according to the catalogue')
+
+    return [file for file in files if os.path.abspath(file) in pullbacks]
+
+
+def run_pipeline(files, manifest, run, predictor, config, progress_bars):
+    """Reads, segments and writes the files, recording the outcome of every file in the manifest"""
+    prefetch_files = max(1, config.segmentation.prefetch_files)
+    num_workers = config.segmentation.n_workers or os.cpu_count()
+    max_pending = 2 * num_workers  # caps masks waiting for contour extraction
+    # spawn instead of fork, forking a process with a loaded model (and its threads) is unsafe
+    contour_pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    read_pool = ThreadPoolExecutor(prefetch_files, thread_name_prefix='read')
+    decode_threads = config.display.decode_threads  # per pullback read, compressed frames are decoded in parallel
+    gather_pool = ThreadPoolExecutor(1, thread_name_prefix='gather')  # waits for the contours of a file in order
+
+    with contour_pool, read_pool, gather_pool:  # gather pool shuts down first, it submits to the contour pool
+        writes = []
+        pending = set()  # contour extraction futures, bounded by max_pending
+        reads = deque()  # bounded by prefetch_files, every entry holds a decoded pullback
+        remaining = manifest.claim_pending(files, **run)  # files are claimed one at a time just before reading
+        for file in remaining:
+            reads.append((file, time.perf_counter(), read_pool.submit(read_pullback, file, decode_threads)))
+            if len(reads) == prefetch_files:
+                break
+
+        while reads:
+            file, start_time, read = reads.popleft()
+            next_file = next(remaining, None)
+            if next_file is not None:  # keep the read pool busy while this pullback is in the model
+                next_read = read_pool.submit(read_pullback, next_file, decode_threads)
+                reads.append((next_file, time.perf_counter(), next_read))
+            progress_bars['read'].update()
+            try:
+                image = read.result()
+            except Exception as error:  # e.g. truncated file or unsupported transfer syntax
+                logger.error(f'Reading {file} failed: {error}')
+                manifest.record(file, FAILED, **run, error=f'read: {error!r}')
+                progress_bars['write'].update()
+                continue
+            if image is None:
                 logger.info(f'Skipping file {file} as it is not a valid IVUS file (DICOM or NIfTi supported)')
+                manifest.record(file, INVALID, **run)
+                progress_bars['write'].update()
+                continue
+
+            logger.info(f'Segmenting file {file}')
+            parts = []
+            try:
+                for start, stop, part in segment_parts(predictor, image, config, contour_pool):
+                    progress_bars['segment'].update(stop - start)
+                    if isinstance(part, Future):
+                        part.add_done_callback(
+                            lambda _, num_frames=stop - start: progress_bars['contour'].update(num_frames)
+                        )
+                        pending.add(part)
+                        if len(pending) >= max_pending:
+                            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    else:
+                        progress_bars['contour'].update(stop - start)
+                    parts.append(part)
+            except Exception as error:  # recorded per file, one corrupt pullback must not end an overnight run
+                logger.exception(f'Segmentation of {file} failed: {error}')
+                manifest.record(file, FAILED, **run, error=f'segment: {error!r}')
+                progress_bars['write'].update()
                 continue
 
-        logger.info(f'Segmenting file {file}')
-        lower_limit = 0
-        upper_limit = image.shape[0]
-        try:
-            masks = predictor(image, lower_limit, upper_limit)
-        except:
-            continue
-        contours = mask_to_contours(None, masks, lower_limit, upper_limit, config=config)
-
-        data = {}
-        for key in [
-            'lumen_area',
-            'lumen_circumf',
-            'longest_distance',
-            'shortest_distance',
-            'elliptic_ratio',
-            'vector_length',
-            'vector_angle',
-        ]:
-            data[key] = [0] * image.shape[0]
-        for key in ['lumen_centroid', 'farthest_point', 'nearest_point']:
-            data[key] = (
-                [[] for _ in range(image.shape[0])],
-                [[] for _ in range(image.shape[0])],
+            write = gather_pool.submit(
+                gather_and_write, contour_pool, file, image.shape[0], parts, config.save.contour_format
+            )
+            write.add_done_callback(
+                lambda write, file=file, start_time=start_time, num_frames=image.shape[0]: write_done(
+                    write, file, time.perf_counter() - start_time, num_frames, manifest, run, progress_bars['write']
+                )
             )
-        data['lumen'] = contours
-        data['phases'] = ['-'] * image.shape[0]
-        data['measures'] = [[None, None] for _ in range(image.shape[0])]
-        data['measure_lengths'] = [[np.nan, np.nan] for _ in range(image.shape[0])]
+            writes.append(write)
+        wait(writes)
+
 
-        with open(os.path.join(input_dir, f'{file}_contours_{version_file_str}.json'), 'w') as out_file:
+def segment_parts(predictor, image, config, contour_pool):
+    """
+    Yields (start, stop, contours) for consecutive chunks of the pullback. Contour extraction runs in the process
+    pool unless keyframe segmentation is used (which needs the contours of its keyframes), in which case the
+    contours are yielded directly instead of as a future.
+    """
+    if config.segmentation.keyframe_interval > 1:
+        yield from contour_batches(predictor, image, 0, image.shape[0], config)
+        return
+    for start, stop, masks in predictor.batches(image, 0, image.shape[0]):
+        yield start, stop, contour_pool.submit(mask_to_contours, None, masks, start, stop, config)
+
+
+def gather_and_write(contour_pool, file, num_frames, parts, contour_format='json'):
+    """Collects the contours of all chunks (resolving futures) and writes them in the process pool"""
+    contours = ([], [])
+    for part in parts:
+        if isinstance(part, Future):
+            part = part.result()
+        contours[0].extend(part[0])
+        contours[1].extend(part[1])
+
+    contour_pool.submit(write_contours_file, file, num_frames, contours, contour_format).result()
+
+
+def write_contours_file(file, num_frames, contours, contour_format='json'):
+    """Writes contours of all frames to a JSON file (or npz store) next to the pullback"""
+    data = {}
+    for key in [
+        'lumen_area',
+        'lumen_circumf',
+        'longest_distance',
+        'shortest_distance',
+        'elliptic_ratio',
+        'vector_length',
+        'vector_angle',
+    ]:
+        data[key] = [0] * num_frames
+    for key in ['lumen_centroid', 'farthest_point', 'nearest_point']:
+        data[key] = (
+            [[] for _ in range(num_frames)],
+            [[] for _ in range(num_frames)],
+        )
+    data['lumen'] = contours
+    data['phases'] = ['-'] * num_frames
+    data['measures'] = [[None, None] for _ in range(num_frames)]
+    data['measure_lengths'] = [[np.nan, np.nan] for _ in range(num_frames)]
+
+    if contour_format == 'npz':
+        write_store(data, f'{file}_contours_{version_file_str}.npz')
+    else:
+        with open(f'{file}_contours_{version_file_str}.json', 'w') as out_file:
             json.dump(data, out_file)
 
 
+def write_done(write, file, seconds, num_frames, manifest, run, write_bar):
+    """Records the outcome of a file once its contours are written (or contour extraction failed)"""
+    error = write.exception()
+    if error is None:
+        manifest.record(file, DONE, **run, seconds=seconds, num_frames=num_frames)
+    else:
+        logger.error(f'Writing contours of {file} failed: {error}')
+        manifest.record(file, FAILED, **run, seconds=seconds, num_frames=num_frames, error=f'write: {error!r}')
+    write_bar.update()
+
+
+def read_pullback(file, decode_threads=None):
+    """Reads the grayscale frames of a DICOM or NIfTi pullback, returns None for other files"""
+    try:
+        image = dicom_memmap(file, *read_dicom_header(file))  # uncompressed pixel data is mapped without copying
+        if image is None:
+            dicom = dcm.read_file(file, force=True)
+            if dicom.file_meta.TransferSyntaxUID.is_compressed:  # frames are decoded in parallel
+                image = decode_volume(dicom, decode_threads)
+            else:
+                image = dicom.pixel_array
+                if image.ndim == 4:  # 3 channel input
+                    image = image[:, :, :, 0]
+    except (AttributeError, IsADirectoryError):
+        try:  # NIfTi
+            image = nifti_memmap(file)
+            if image is None:
+                image = sitk.GetArrayFromImage(sitk.ReadImage(file))
+        except RuntimeError:
+            return None
+
+    return image
+
+
 if __name__ == '__main__':
     segment_files()
@@ -0,0 +1,77 @@
+import numpy as np
+from omegaconf import OmegaConf
+
+from report.polygon_metrics import polygon_metrics
+from segmentation.keyframes import keyframe_segmentation
+from segmentation.segment import mask_to_contours
+
+
+class ThresholdPredictor:
+    """Stands in for the model, the lumen of the synthetic pullback is its bright disc"""
+
+    batch_size = 4
+
+    def __init__(self):
+        self.inferred = []  # number of frames of every call
+
+    def __call__(self, images, lower_limit, upper_limit):
+        self.inferred.append(upper_limit - lower_limit)
+        return (images[lower_limit:upper_limit] > 100).astype(np.uint8) * 255
+
+
+def sample_pullback(num_frames=60, size=128, seed=0):
+    """Disc drifting and widening smoothly along the pullback with speckle noise"""
+    random = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:size, :size]
+    frames = np.arange(num_frames)
+    radii = 25 + 10 * np.sin(frames / num_frames * np.pi)
+    centres = size / 2 + 4 * np.stack([np.cos(frames / 20), np.sin(frames / 20)], axis=1)
+    distances = np.hypot(cols - centres[:, 0, None, None], rows - centres[:, 1, None, None])
+    discs = distances < radii[:, None, None]
+
+    return (discs * 180 + random.integers(0, 40, discs.shape)).astype(np.uint8)
+
+
+def config(keyframe_interval):
+    return OmegaConf.create(
+        {
+            'display': {'n_interactive_points': 20, 'knot_spacing': 'arc_length'},
+            'segmentation': {
+                'keyframe_interval': keyframe_interval,
+                'keyframe_similarity': 0.8,
+                'keyframe_area_change': 0.2,
+                'keyframe_centroid_shift': 20,
+            },
+        }
+    )
+
+
+def metrics(lumen):
+    contours = np.stack([np.column_stack(contour) for contour in zip(*lumen)])
+    area, _, centroid_x, centroid_y, _, _ = polygon_metrics(contours, center=(0, 0))
+    return area, np.column_stack([centroid_x, centroid_y])
+
+
+def test_interpolated_contours_match_full_inference():
+    images = sample_pullback()
+    predictor = ThresholdPredictor()
+    lumen = ([], [])
+    for start, stop, contours in keyframe_segmentation(predictor, images, 0, len(images), config(5)):
+        assert start == len(lumen[0]) and stop - start == len(contours[0])
+        lumen[0].extend(contours[0])
+        lumen[1].extend(contours[1])
+    assert sum(predictor.inferred) < len(images) / 2
+
+    full_lumen = mask_to_contours(None, ThresholdPredictor()(images, 0, len(images)), 0, len(images), config(1))
+    area, centroid = metrics(lumen)
+    full_area, full_centroid = metrics(full_lumen)
+    assert np.abs(area / full_area - 1).max() < 0.05
+    assert np.linalg.norm(centroid - full_centroid, axis=1).max() < 1
+
+
+def test_intervals_are_yielded_before_all_keyframes_are_inferred():
+    images = sample_pullback()
+    predictor = ThresholdPredictor()
+    intervals = keyframe_segmentation(predictor, images, 0, len(images), config(5))
+    next(intervals)
+    assert sum(predictor.inferred) <= 2 * predictor.batch_size  # first keyframe batch and the first interval
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from report.polygon_metrics import caliper_widths, polygon_metrics
+
+
+def all_pairs_max_width(contour):
+    """Longest distance between any two points"""
+    differences = contour[:, np.newaxis] - contour[np.newaxis]
+    return np.hypot(differences[..., 0], differences[..., 1]).max()
+
+
+def brute_force_min_width(contour):
+    """Narrowest extent over the directions of all point pairs, the minimum width is flush to one of them"""
+    directions = (contour[:, np.newaxis] - contour[np.newaxis]).reshape(-1, 2)
+    lengths = np.hypot(directions[:, 0], directions[:, 1])
+    if not (lengths > 0).any():  # a single point
+        return 0.0
+    normals = np.stack([-directions[:, 1], directions[:, 0]], axis=1)[lengths > 0] / lengths[lengths > 0, np.newaxis]
+    projections = normals @ contour.T
+
+    return (projections.max(axis=1) - projections.min(axis=1)).min()
+
+
+def random_contours(num_frames, num_points, seed):
+    """Star-shaped polygons around random centres, elongated and concave"""
+    random = np.random.default_rng(seed)
+    angles = np.sort(random.uniform(0, 2 * np.pi, (num_frames, num_points)), axis=1)
+    radii = random.uniform(20, 100, (num_frames, num_points))
+    stretch = random.uniform(0.3, 2, (num_frames, 1))
+    centres = random.uniform(100, 400, (num_frames, 1, 2))
+
+    return np.stack([radii * np.cos(angles) * stretch, radii * np.sin(angles)], axis=-1) + centres
+
+
+def assert_widths(contours):
+    max_width, max_x, max_y, min_width, min_x, min_y = caliper_widths(contours)
+    for frame, contour in enumerate(contours):
+        assert max_width[frame] == pytest.approx(all_pairs_max_width(contour), abs=1e-9)
+        assert min_width[frame] == pytest.approx(brute_force_min_width(contour), abs=1e-9)
+    # the returned points span the widths
+    np.testing.assert_allclose(np.hypot(np.diff(max_x)[:, 0], np.diff(max_y)[:, 0]), max_width, atol=1e-9)
+    np.testing.assert_allclose(np.hypot(np.diff(min_x)[:, 0], np.diff(min_y)[:, 0]), min_width, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_contours(seed):
+    assert_widths(random_contours(num_frames=40, num_points=30, seed=seed))
+
+
+def test_random_points():
+    random = np.random.default_rng(0)
+    assert_widths(random.uniform(0, 100, (40, 25, 2)))  # hull of a point cloud, most points inside
+
+
+def test_square():
+    side = np.linspace(0, 10, 6)
+    square = np.concatenate(
+        [
+            np.column_stack([side, np.zeros(6)]),
+            np.column_stack([np.full(6, 10), side]),
+            np.column_stack([side[::-1], np.full(6, 10)]),
+            np.column_stack([np.zeros(6), side[::-1]]),
+        ]
+    )
+    max_width, _, _, min_width, _, _ = caliper_widths(square[np.newaxis])
+    assert max_width[0] == pytest.approx(10 * np.sqrt(2))
+    assert min_width[0] == pytest.approx(10)
+
+
+def test_degenerate_contours():
+    num_points = 20
+    collinear = np.column_stack([np.linspace(0, 30, num_points), np.linspace(5, 45, num_points)])
+    single_point = np.full((num_points, 2), 7.5)
+    contours = np.stack([collinear, single_point, random_contours(1, num_points, seed=0)[0]])
+    max_width, max_x, max_y, min_width, _, _ = caliper_widths(contours)
+    assert max_width[0] == pytest.approx(50)
+    assert sorted(max_x[0]) == pytest.approx([0, 30])
+    assert min_width[0] == pytest.approx(0, abs=1e-9)
+    assert max_width[1] == 0 and min_width[1] == 0
+    assert_widths(contours)  # degenerate frames do not disturb the other frames
+
+
+def test_polygon_metrics_square():
+    square = np.array([[[0, 0], [4, 0], [4, 2], [0, 2], [0, 0]]], dtype=np.float64)
+    area, perimeter, centroid_x, centroid_y, vector_length, _ = polygon_metrics(square, center=(2, 4))
+    assert area[0] == pytest.approx(8)
+    assert perimeter[0] == pytest.approx(12)
+    assert (centroid_x[0], centroid_y[0]) == pytest.approx((2, 1))
+    assert vector_length[0] == pytest.approx(3)